@@ -91,6 +91,13 @@ The repository of older versions of applications from the main demo repository.
 #
 # allow_disabled_algorithms = True
 
+# Verifying APK signatures with apksigner or jarsigner means starting
+# Java for each APK.  When Java 11 or newer is available, fdroidserver
+# keeps one Java process running to verify all of them instead.  This
+# turns that off, and runs apksigner or jarsigner for each APK.
+#
+# verify_worker = False
+
 # Normally, all apps are collected into a single app repository, like on
 # https://f-droid.org. For certain situations, it is better to make a repo
 # that is made up of APKs only from a single app. For example, an automated
@@ -0,0 +1,153 @@
+/*
+ * VerifyWorker.java - verify many APK signatures in a single JVM
+ *
+ * Copyright (C) 2020, The F-Droid Project
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as published
+ * by the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU Affero General Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ *
+ * This is run by fdroidserver/common.py with the source launcher of
+ * Java 11 or newer, so there is nothing to compile:
+ *
+ *   java -cp /path/to/apksigner.jar VerifyWorker.java apksigner
+ *   java -Djava.security.properties=... VerifyWorker.java jarsigner
+ *
+ * It prints "READY" once it is started, then reads one request per
+ * line from stdin, the minimum SDK version (or "-") and the path of
+ * the APK separated by a tab, and answers each with a line that is
+ * either "OK" or "FAIL".  Only "OK" is trusted, anything else makes
+ * fdroidserver run apksigner or jarsigner on that APK like before, so
+ * the real error gets reported.
+ *
+ * The "apksigner" mode uses the same ApkVerifier as `apksigner verify`.
+ * The "jarsigner" mode does what `jarsigner -strict -verify` checks
+ * for the exit code 4 that verify_old_apk_signature() accepts: every
+ * entry is signed, and the signer certificates are allowed to sign code.
+ */
+
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.InputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+import java.security.CodeSigner;
+import java.security.Security;
+import java.security.cert.Certificate;
+import java.security.cert.X509Certificate;
+import java.util.Enumeration;
+import java.util.List;
+import java.util.Locale;
+import java.util.jar.JarEntry;
+import java.util.jar.JarFile;
+
+public class VerifyWorker {
+
+    public static void main(String[] args) throws Exception {
+        String mode = args.length > 0 ? args[0] : "apksigner";
+        // make sure java.security.properties is loaded before the file goes away
+        Security.getProperty("jdk.jar.disabledAlgorithms");
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        PrintStream out = new PrintStream(System.out, false, "UTF-8");
+        out.println("READY");
+        out.flush();
+
+        String line;
+        while ((line = in.readLine()) != null) {
+            int tab = line.indexOf('\t');
+            boolean verified = false;
+            if (tab > 0) {
+                String minSdkVersion = line.substring(0, tab);
+                File apk = new File(line.substring(tab + 1));
+                try {
+                    if ("jarsigner".equals(mode)) {
+                        verified = verifyJar(apk);
+                    } else {
+                        verified = verifyApk(apk, minSdkVersion);
+                    }
+                } catch (Throwable e) {
+                    verified = false;
+                }
+            }
+            out.println(verified ? "OK" : "FAIL");
+            out.flush();
+        }
+    }
+
+    static boolean verifyApk(File apk, String minSdkVersion) throws Exception {
+        com.android.apksig.ApkVerifier.Builder builder = new com.android.apksig.ApkVerifier.Builder(apk);
+        if (!"-".equals(minSdkVersion)) {
+            builder.setMinCheckedPlatformVersion(Integer.parseInt(minSdkVersion));
+        }
+        return builder.build().verify().isVerified();
+    }
+
+    static boolean isSignatureRelated(String name) {
+        String upper = name.toUpperCase(Locale.ENGLISH);
+        if (!upper.startsWith("META-INF/") || upper.indexOf('/', 9) >= 0) {
+            return false;
+        }
+        return upper.equals("META-INF/MANIFEST.MF") || upper.endsWith(".SF")
+                || upper.endsWith(".RSA") || upper.endsWith(".DSA") || upper.endsWith(".EC")
+                || upper.startsWith("META-INF/SIG-");
+    }
+
+    static boolean canSignCode(X509Certificate cert) throws Exception {
+        boolean[] keyUsage = cert.getKeyUsage();
+        if (keyUsage != null && !(keyUsage[0] || (keyUsage.length > 1 && keyUsage[1]))) {
+            return false;
+        }
+        List<String> extendedKeyUsage = cert.getExtendedKeyUsage();
+        if (extendedKeyUsage != null && !extendedKeyUsage.contains("2.5.29.37.0")
+                && !extendedKeyUsage.contains("1.3.6.1.5.5.7.3.3")) {
+            return false;
+        }
+        // jarsigner also checks the Netscape Cert Type, so leave those to it
+        return cert.getExtensionValue("2.16.840.1.113730.1.1") == null;
+    }
+
+    static boolean verifyJar(File apk) throws Exception {
+        boolean signed = false;
+        byte[] buffer = new byte[65536];
+        try (JarFile jar = new JarFile(apk, true)) {
+            if (jar.getManifest() == null) {
+                return false;
+            }
+            Enumeration<JarEntry> entries = jar.entries();
+            while (entries.hasMoreElements()) {
+                JarEntry entry = entries.nextElement();
+                // the signature is only checked while reading the whole entry
+                try (InputStream is = jar.getInputStream(entry)) {
+                    while (is.read(buffer) != -1) {
+                    }
+                }
+                if (entry.isDirectory() || isSignatureRelated(entry.getName())) {
+                    continue;
+                }
+                CodeSigner[] signers = entry.getCodeSigners();
+                if (signers == null || signers.length == 0) {
+                    return false;
+                }
+                for (CodeSigner signer : signers) {
+                    Certificate cert = signer.getSignerCertPath().getCertificates().get(0);
+                    if (cert instanceof X509Certificate && !canSignCode((X509Certificate) cert)) {
+                        return false;
+                    }
+                }
+                signed = true;
+            }
+        }
+        return signed;
+    }
+}
@@ -1016,7 +1016,8 @@ def main():
 
     # Read all app and srclib metadata
     pkgs = common.read_pkg_args(options.appid, True)
-    allapps = metadata.read_metadata(not options.onserver, pkgs, options.refresh, sort_by_time=True)
+    allapps = metadata.read_metadata(not options.onserver, pkgs, options.refresh, sort_by_time=True,
+                                     appids=pkgs)
     apps = common.read_app_args(options.appid, allapps, True)
 
     for appid, app in list(apps.items()):
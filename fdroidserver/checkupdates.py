@@ -17,6 +17,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
+import hashlib
+import json
 import os
 import re
 import urllib.request
@@ -24,19 +27,83 @@ import urllib.error
 import time
 import subprocess
 import sys
+import tempfile
 from argparse import ArgumentParser
 import traceback
 import html
 from distutils.version import LooseVersion
 import logging
 import copy
+import threading
 import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from . import _
 from . import common
 from . import metadata
 from .exception import VCSException, NoSubmodulesException, FDroidException, MetaDataException
 
+# Minimum number of seconds between two requests to the same host when
+# checking with --jobs, so a big run does not hammer github.com et al.
+HOST_REQUEST_INTERVAL = 1.0
+
+
+def get_url_host(url):
+    """Return the host name of a URL or of an scp-like git address"""
+    m = re.match(r'[^/@:]+@([^/:]+):', url)  # git@gitlab.com:foo/bar.git
+    if m:
+        return m.group(1).lower()
+    return urllib.parse.urlparse(url).hostname
+
+
+class HostRateLimiter:
+    """Space out the upstream requests that go to the same host
+
+    Worker threads call wait() right before they fetch something, it
+    sleeps until at least interval seconds passed since the last
+    request that was let through to that host.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = dict()
+
+    def wait(self, url):
+        host = get_url_host(url)
+        if not host:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        if start > now:
+            logging.debug("...waiting %.1fs for %s" % (start - now, host))
+            time.sleep(start - now)
+
+
+host_rate_limiter = None
+
+
+def _wait_for_host(url):
+    if host_rate_limiter and url:
+        host_rate_limiter.wait(url)
+
+
+def _wait_for_repo_host(app):
+    if app.RepoType == 'srclib':
+        srclib = (metadata.srclibs or dict()).get(app.Repo)
+        _wait_for_host(srclib['Repo'] if srclib else None)
+    else:
+        _wait_for_host(app.Repo)
+
+
+def _get_build_dir(app):
+    if app.RepoType == 'srclib':
+        return os.path.join('build', 'srclib', app.Repo)
+    return os.path.join('build', app.id)
+
 
 # Check for a new version by looking at a document retrieved via HTTP.
 # The app's Update Check Data field is used to provide the information
@@ -63,6 +130,7 @@ def check_http(app):
         vercode = None
         if len(urlcode) > 0:
             logging.debug("...requesting {0}".format(urlcode))
+            _wait_for_host(urlcode)
             req = urllib.request.Request(urlcode, None)
             resp = urllib.request.urlopen(req, None, 20)  # nosec B310 scheme is filtered above
             page = resp.read().decode('utf-8')
@@ -76,6 +144,7 @@ def check_http(app):
         if len(urlver) > 0:
             if urlver != '.':
                 logging.debug("...requesting {0}".format(urlver))
+                _wait_for_host(urlver)
                 req = urllib.request.Request(urlver, None)
                 resp = urllib.request.urlopen(req, None, 20)  # nosec B310 scheme is filtered above
                 page = resp.read().decode('utf-8')
@@ -97,6 +166,183 @@ def check_http(app):
         return (None, msg)
 
 
+class UpstreamCache:
+    """Remember what upstream looked like at the last check of each app
+
+    For each app, this keeps a cheap fingerprint of its upstream (see
+    get_upstream_fingerprint()), a hash of the metadata fields that the
+    check depends on, and what the check found.  When neither changed
+    since, check_app() reuses that instead of fetching and parsing.
+
+    Getting the fingerprint costs one git ls-remote or one HTTP HEAD
+    request per app on every run, which --no-upstream-cache avoids.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+        self.context = self._get_context()
+        if os.path.exists(path):
+            try:
+                with open(path) as fp:
+                    data = json.load(fp)
+                if data.get('version') == self.VERSION and data.get('context') == self.context:
+                    self.entries = data['entries']
+            except (ValueError, KeyError, AttributeError) as e:
+                logging.debug(_('Ignoring broken {path}: {error}')
+                              .format(path=path, error=str(e)))
+
+    @staticmethod
+    def _get_context():
+        """What the results depend on, other than the app and its upstream
+
+        Like for metadata.MetadataCache, the source files that find the
+        versions stand in for a version of fdroidserver, so fixes to
+        them are not hidden behind old results.
+        """
+        sources = []
+        for module in (sys.modules[__name__], common):
+            st = os.stat(module.__file__)
+            sources.append([os.path.basename(module.__file__), st.st_size, st.st_mtime_ns])
+        return sources
+
+    @staticmethod
+    def get_key(app):
+        """Hash the metadata fields of app that the result of a check depends on"""
+        last_build = app.get_last_build()
+        fields = [app.id, app.RepoType, app.Repo, app.UpdateCheckMode, app.UpdateCheckData,
+                  app.UpdateCheckIgnore, app.UpdateCheckName, last_build.gradle,
+                  bool(last_build.submodules)]
+        return hashlib.sha256(json.dumps(fields).encode('utf-8')).hexdigest()
+
+    def get(self, app, upstream):
+        """Return the result of the last check of app if upstream is unchanged, else None"""
+        entry = self.entries.get(app.id)
+        if entry and entry['key'] == self.get_key(app) and entry['upstream'] == upstream:
+            self.hits += 1
+            return entry['result']
+        self.misses += 1
+        return None
+
+    def put(self, app, upstream, result):
+        self.entries[app.id] = {'key': self.get_key(app), 'upstream': upstream, 'result': result}
+        self.changed = True
+
+    def save(self, appids=None):
+        """Write the cache if it changed, only keeping appids if given"""
+        logging.debug(_('Upstream cache: {hits} unchanged, {misses} changed or new')
+                      .format(hits=self.hits, misses=self.misses))
+        if appids is not None:
+            for appid in set(self.entries) - set(appids):
+                del self.entries[appid]
+                self.changed = True
+        if not self.changed or not os.path.isdir(os.path.dirname(self.path)):
+            return
+        data = json.dumps({'version': self.VERSION, 'context': self.context, 'entries': self.entries})
+        common.write_file_atomically(self.path, data.encode('utf-8'))
+        self.changed = False
+
+
+upstream_cache = None
+
+
+def _get_git_fingerprint(app):
+    if app.RepoType == 'srclib':
+        srclib = (metadata.srclibs or dict()).get(app.Repo)
+        if not srclib:
+            return None
+        repotype, url = srclib['RepoType'], srclib['Repo']
+    else:
+        repotype, url = app.RepoType, app.Repo
+    if repotype != 'git' or not url:
+        return None
+    vcs = common.getvcs('git', url, _get_build_dir(app))
+    _wait_for_host(url)
+    p = vcs.git(['ls-remote', '--', url], output=False)
+    if p.returncode != 0:
+        logging.debug("...git ls-remote failed: " + p.output)
+        return None
+    return 'git ' + hashlib.sha256(p.output.encode('utf-8')).hexdigest()
+
+
+def _get_http_fingerprint(app):
+    try:
+        urlcode, codeex, urlver, verex = app.UpdateCheckData.split('|')
+    except (AttributeError, ValueError):
+        return None
+    validators = []
+    for url in (urlcode, urlver):
+        if url in ('', '.'):
+            continue
+        if urllib.parse.urlparse(url).scheme != 'https':
+            return None
+        _wait_for_host(url)
+        req = urllib.request.Request(url, None, method='HEAD')
+        try:
+            resp = urllib.request.urlopen(req, None, 20)  # nosec B310 scheme is filtered above
+        except Exception as e:
+            logging.debug("...HEAD {0} failed: {1}".format(url, e))
+            return None
+        validator = resp.headers.get('ETag') or resp.headers.get('Last-Modified')
+        if not validator:
+            return None
+        validators.append([url, validator])
+    if not validators:
+        return None
+    return 'http ' + hashlib.sha256(json.dumps(validators).encode('utf-8')).hexdigest()
+
+
+def get_upstream_fingerprint(app):
+    """Cheaply fingerprint the upstream state that check_app() looks at
+
+    For the Tags and RepoManifest modes, this is a hash of all the refs
+    that git ls-remote lists, for the HTTP mode, of the ETag or
+    Last-Modified headers of the UpdateCheckData URLs.  Returns None
+    without making any request when there is no cheap way to tell for
+    this app, like for RepoTrunk, which only works with git-svn, then
+    it is always checked.
+    """
+    mode = app.UpdateCheckMode
+    if mode == 'HTTP':
+        return _get_http_fingerprint(app)
+    if mode.startswith('Tags') or mode.startswith('RepoManifest'):
+        return _get_git_fingerprint(app)
+    return None
+
+
+def _is_manifest_file(path):
+    """Whether check_tags() needs the file at path to find the version in a tag"""
+    parts = path.split('/')
+    if parts[-1] in ('AndroidManifest.xml', 'pom.xml', 'build.gradle',
+                     'build-extras.gradle', 'build.gradle.kts'):
+        return True
+    # string resources, for android:versionName="@string/..."
+    return parts[-1].endswith('.xml') and len(parts) > 2 \
+        and parts[-2] == 'values' and 'res' in parts[:-2]
+
+
+@contextlib.contextmanager
+def _tag_tree(vcs, reader, build_dir, tag):
+    """Provide a directory with the files of tag that check_tags() looks at
+
+    With a GitTreeReader, only the manifest, gradle and string resource
+    files of the tag are exported from the git objects into a scratch
+    directory, instead of checking out and cleaning the whole tree.
+    """
+    if reader is None:
+        vcs.gotorevision(tag)
+        yield build_dir
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        reader.export(tag, tmpdir, _is_manifest_file)
+        yield tmpdir
+
+
 # Check for a new version by looking at the tags in the source repo.
 # Whether this can be used reliably or not depends on
 # the development procedures used by the project's developers. Use it with
@@ -123,6 +369,7 @@ def check_tags(app, pattern):
         # Set up vcs interface and make sure we have the latest code...
         vcs = common.getvcs(app.RepoType, app.Repo, build_dir)
 
+        _wait_for_repo_host(app)
         vcs.gotorevision(None)
 
         last_build = app.get_last_build()
@@ -154,26 +401,32 @@ def check_tags(app, pattern):
             tags = tags[:5]
             logging.debug("Latest tags: " + ','.join(tags))
 
-        for tag in tags:
-            logging.debug("Check tag: '{0}'".format(tag))
-            vcs.gotorevision(tag)
-
-            for subdir in possible_subdirs(app):
-                if subdir == '.':
-                    root_dir = build_dir
-                else:
-                    root_dir = os.path.join(build_dir, subdir)
-                paths = common.manifest_paths(root_dir, last_build.gradle)
-                version, vercode, package = common.parse_androidmanifests(paths, app)
-                if vercode:
-                    logging.debug("Manifest exists in subdir '{0}'. Found version {1} ({2})"
-                                  .format(subdir, version, vercode))
-                    i_vercode = common.version_code_string_to_int(vercode)
-                    if i_vercode > common.version_code_string_to_int(hcode):
-                        hpak = package
-                        htag = tag
-                        hcode = str(i_vercode)
-                        hver = version
+        reader = None
+        if repotype == 'git' and not last_build.submodules:
+            reader = common.GitTreeReader(build_dir)
+        try:
+            for tag in tags:
+                logging.debug("Check tag: '{0}'".format(tag))
+                with _tag_tree(vcs, reader, build_dir, tag) as tag_dir:
+                    for subdir in possible_subdirs(app, tag_dir):
+                        if subdir == '.':
+                            root_dir = tag_dir
+                        else:
+                            root_dir = os.path.join(tag_dir, subdir)
+                        paths = common.manifest_paths(root_dir, last_build.gradle)
+                        version, vercode, package = common.parse_androidmanifests(paths, app)
+                        if vercode:
+                            logging.debug("Manifest exists in subdir '{0}'. Found version {1} ({2})"
+                                          .format(subdir, version, vercode))
+                            i_vercode = common.version_code_string_to_int(vercode)
+                            if i_vercode > common.version_code_string_to_int(hcode):
+                                hpak = package
+                                htag = tag
+                                hcode = str(i_vercode)
+                                hver = version
+        finally:
+            if reader:
+                reader.close()
 
         if not hpak:
             return (None, "Couldn't find package ID", None)
@@ -209,6 +462,7 @@ def check_repomanifest(app, branch=None):
         # Set up vcs interface and make sure we have the latest code...
         vcs = common.getvcs(app.RepoType, app.Repo, build_dir)
 
+        _wait_for_repo_host(app)
         if repotype == 'git':
             if branch:
                 branch = 'origin/' + branch
@@ -274,6 +528,7 @@ def check_repotrunk(app):
         # Set up vcs interface and make sure we have the latest code...
         vcs = common.getvcs(app.RepoType, app.Repo, build_dir)
 
+        _wait_for_repo_host(app)
         vcs.gotorevision(None)
 
         ref = vcs.getref()
@@ -340,12 +595,10 @@ def dirs_with_manifest(startdir):
 
 # Tries to find a new subdir starting from the root build_dir. Returns said
 # subdir relative to the build dir if found, None otherwise.
-def possible_subdirs(app):
+def possible_subdirs(app, build_dir=None):
 
-    if app.RepoType == 'srclib':
-        build_dir = os.path.join('build', 'srclib', app.Repo)
-    else:
-        build_dir = os.path.join('build', app.id)
+    if build_dir is None:
+        build_dir = _get_build_dir(app)
 
     last_build = app.get_last_build()
 
@@ -383,6 +636,7 @@ def fetch_autoname(app, tag):
 
     try:
         vcs = common.getvcs(app.RepoType, app.Repo, build_dir)
+        _wait_for_repo_host(app)
         vcs.gotorevision(tag)
     except VCSException:
         return None
@@ -399,6 +653,10 @@ def fetch_autoname(app, tag):
         new_name = common.fetch_real_name(root_dir, last_build.gradle)
         if new_name is not None:
             break
+    return _set_autoname(app, new_name)
+
+
+def _set_autoname(app, new_name):
     commitmsg = None
     if new_name:
         logging.debug("...got autoname '" + new_name + "'")
@@ -412,7 +670,13 @@ def fetch_autoname(app, tag):
     return commitmsg
 
 
-def checkupdates_app(app):
+def check_app(app):
+    """Check app for updates and apply them to the app object
+
+    Nothing is written to disk here, so this can run in a worker
+    thread.  Returns the commit message when the metadata needs to be
+    written back, otherwise None.
+    """
 
     # If a change is made, commitmsg should be set to a description of it.
     # Only if this is set will changes be written back to the metadata.
@@ -422,8 +686,17 @@ def checkupdates_app(app):
     msg = None
     vercode = None
     noverok = False
+    upstream = None
+    cached = None
+    if upstream_cache is not None:
+        upstream = get_upstream_fingerprint(app)
+        if upstream and not options.force:
+            cached = upstream_cache.get(app, upstream)
     mode = app.UpdateCheckMode
-    if mode.startswith('Tags'):
+    if cached:
+        logging.info("...upstream unchanged since the last check")
+        version, vercode, tag = cached['version'], cached['vercode'], cached['tag']
+    elif mode.startswith('Tags'):
         pattern = mode[5:] if len(mode) > 4 else None
         (version, vercode, tag) = check_tags(app, pattern)
         if version == 'Unknown':
@@ -449,6 +722,7 @@ def checkupdates_app(app):
     else:
         version = None
         msg = 'Invalid update check method'
+    checked_version, checked_vercode = version, vercode
 
     if version and vercode and app.VercodeOperation:
         if not common.VERCODE_OPERATION_RE.match(app.VercodeOperation):
@@ -481,7 +755,15 @@ def checkupdates_app(app):
         app.CurrentVersionCode = str(int(vercode))
         updating = True
 
-    commitmsg = fetch_autoname(app, tag)
+    if cached:
+        commitmsg = _set_autoname(app, cached['autoname'])
+    else:
+        commitmsg = fetch_autoname(app, tag)
+        if upstream and checked_version is not None:
+            upstream_cache.put(app, upstream, {'version': checked_version,
+                                               'vercode': checked_vercode,
+                                               'tag': tag,
+                                               'autoname': app.AutoName})
 
     if updating:
         name = _getappname(app)
@@ -531,16 +813,180 @@ def checkupdates_app(app):
         else:
             logging.warning('Invalid auto update mode "' + mode + '" on ' + app.id)
 
+    return commitmsg
+
+
+class BatchCommitter:
+    """Commit metadata files through one long-lived git fast-import process
+
+    Running git commit for each updated app means a fork and a full
+    index refresh every time.  This streams the same commits, one per
+    app with the same message and author, into a single fast-import on
+    top of the current branch, and only syncs the index of the
+    committed files at the end.  Commit hooks and signing do not run.
+    A branch has to be checked out, it may be one without commits yet.
+    """
+
+    def __init__(self, author=None):
+        p = subprocess.run(['git', 'symbolic-ref', '-q', 'HEAD'], stdout=subprocess.PIPE)
+        if p.returncode != 0:
+            raise FDroidException(_('--batch-commits needs a branch checked out, HEAD is detached'))
+        self.ref = p.stdout.decode('utf-8').strip()
+        p = subprocess.run(['git', 'rev-parse', '-q', '--verify', 'HEAD'], stdout=subprocess.PIPE)
+        # an unborn branch gets its first commit without a parent
+        self.parent = p.stdout.decode('utf-8').strip() if p.returncode == 0 else None
+        self.prefix = subprocess.check_output(['git', 'rev-parse', '--show-prefix']).decode('utf-8').strip()
+        self.committer = self._get_ident('GIT_COMMITTER_IDENT')
+        if author is None:
+            self.author = self._get_ident('GIT_AUTHOR_IDENT')
+        elif re.match(r'^[^<>\n]+ <[^<>\n]*>$', author):
+            self.author = author
+        else:
+            raise FDroidException(_('auto_author must look like "Name <email>" for --batch-commits'))
+        self.paths = []
+        self.process = subprocess.Popen(['git', 'fast-import', '--quiet', '--date-format=now'],
+                                        stdin=subprocess.PIPE)
+
+    @staticmethod
+    def _get_ident(var):
+        # "Name <email> 1234567890 +0000", without the timestamp
+        return subprocess.check_output(['git', 'var', var]).decode('utf-8').strip().rsplit(' ', 2)[0]
+
+    @staticmethod
+    def _get_mode(path):
+        """Get the mode that path is tracked with, so committing it does not change it"""
+        output = subprocess.check_output(['git', 'ls-files', '-s', '--', path]).decode('utf-8')
+        mode = output.split(' ', 1)[0] if output else '100644'
+        if mode not in ('100644', '100755'):
+            raise FDroidException(_('{path} is not a regular file in git, cannot use --batch-commits')
+                                  .format(path=path))
+        return mode
+
+    @staticmethod
+    def _data(content):
+        return ('data %d\n' % len(content)).encode('utf-8') + content + b'\n'
+
+    def commit(self, path, message):
+        """Commit the current content of path, relative to the working directory"""
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        treepath = os.path.normpath(os.path.join(self.prefix, path))
+        cmd = ('commit {ref}\nauthor {author} now\ncommitter {committer} now\n'
+               .format(ref=self.ref, author=self.author, committer=self.committer)).encode('utf-8')
+        cmd += self._data(message.encode('utf-8'))
+        if self.parent:
+            cmd += ('from %s\n' % self.parent).encode('utf-8')
+            self.parent = None
+        cmd += ('M %s inline %s\n' % (self._get_mode(path), treepath)).encode('utf-8') \
+            + self._data(content) + b'\n'
+        self.process.stdin.write(cmd)
+        self.paths.append(path)
+
+    def close(self):
+        """Wait for fast-import to update the branch, then sync the index"""
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise FDroidException(_('git fast-import failed, the updated metadata is not committed'))
+        if self.paths and subprocess.call(['git', 'reset', '-q', '--'] + self.paths) != 0:
+            raise FDroidException("Git reset failed")
+
+
+batch_committer = None
+
+
+def write_app_update(app, commitmsg):
+    """Write back the metadata of an updated app, and commit it with --commit"""
+    metadata.write_metadata(app.metadatapath, app)
+    if options.commit:
+        logging.info("Commiting update for " + app.metadatapath)
+        if batch_committer:
+            batch_committer.commit(app.metadatapath, commitmsg)
+            return
+        gitcmd = ["git", "commit", "-m", commitmsg]
+        if 'auto_author' in config:
+            gitcmd.extend(['--author', config['auto_author']])
+        gitcmd.extend(["--", app.metadatapath])
+        if subprocess.call(gitcmd) != 0:
+            raise FDroidException("Git commit failed")
+
+
+def checkupdates_app(app):
+    commitmsg = check_app(app)
     if commitmsg:
-        metadata.write_metadata(app.metadatapath, app)
-        if options.commit:
-            logging.info("Commiting update for " + app.metadatapath)
-            gitcmd = ["git", "commit", "-m", commitmsg]
-            if 'auto_author' in config:
-                gitcmd.extend(['--author', config['auto_author']])
-            gitcmd.extend(["--", app.metadatapath])
-            if subprocess.call(gitcmd) != 0:
-                raise FDroidException("Git commit failed")
+        write_app_update(app, commitmsg)
+
+
+class _ThreadLogBuffer(logging.Filter):
+    """Hold back the log records of the threads that have a buffer set"""
+
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        # every handler runs the filter, keep each record only once
+        if not records or records[-1] is not record:
+            records.append(record)
+        return False
+
+
+class CheckPool:
+    """Run check_app() for many apps in a pool of worker threads
+
+    All apps that share a VCS checkout (i.e. the same srclib) end up
+    in the same group, which one worker processes in order, so no two
+    threads ever touch the same build directory.  The log of each app
+    is held back and replayed by result(), so the output looks like a
+    serial run.  Writing the metadata and committing it is left to the
+    caller, which does that from the main thread in app order.
+    """
+
+    def __init__(self, apps, jobs):
+        groups = OrderedDict()
+        for appid, app in apps.items():
+            groups.setdefault(_get_build_dir(app), []).append((appid, app))
+        self.logbuffer = _ThreadLogBuffer()
+        self.handlers = list(logging.getLogger().handlers)
+        for handler in self.handlers:
+            handler.addFilter(self.logbuffer)
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.futures = dict()
+        for group in groups.values():
+            future = self.executor.submit(self._check_group, group)
+            for appid, app in group:
+                self.futures[appid] = future
+
+    def _check_group(self, group):
+        results = dict()
+        for appid, app in group:
+            records = []
+            self.logbuffer.local.records = records
+            try:
+                results[appid] = (check_app(app), None, records)
+            except Exception as e:
+                results[appid] = (None, e, records)
+            finally:
+                self.logbuffer.local.records = None
+        return results
+
+    def result(self, appid):
+        """Wait for the check of appid, replay its log and return its commit message"""
+        commitmsg, error, records = self.futures.pop(appid).result()[appid]
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+        if error is not None:
+            raise error
+        return commitmsg
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        for handler in self.handlers:
+            handler.removeFilter(self.logbuffer)
 
 
 def status_update_json(processed, failed):
@@ -594,7 +1040,7 @@ start_timestamp = time.gmtime()
 
 def main():
 
-    global config, options
+    global config, options, host_rate_limiter, upstream_cache, batch_committer
 
     # Parse command line...
     parser = ArgumentParser(usage="%(prog)s [options] [APPID [APPID ...]]")
@@ -606,10 +1052,19 @@ def main():
                         help=_("Only process apps with auto-updates"))
     parser.add_argument("--commit", action="store_true", default=False,
                         help=_("Commit changes"))
+    parser.add_argument("--batch-commits", action="store_true", default=False,
+                        help=_("With --commit, create all commits through one git fast-import"))
     parser.add_argument("--allow-dirty", action="store_true", default=False,
                         help=_("Run on git repo that has uncommitted changes"))
     parser.add_argument("--gplay", action="store_true", default=False,
                         help=_("Only print differences with the Play Store"))
+    parser.add_argument("--force", action="store_true", default=False,
+                        help=_("Check all apps, even when nothing changed upstream since the last check"))
+    parser.add_argument("--no-upstream-cache", action="store_true", default=False,
+                        help=_("Do not look for upstream changes since the last check, "
+                               "saving a git ls-remote or HTTP HEAD request per app"))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=_("Number of apps to check in parallel"))
     metadata.add_metadata_arguments(parser)
     options = parser.parse_args()
     metadata.warnings_action = options.W
@@ -622,8 +1077,8 @@ def main():
             logging.error(_('Build metadata git repo has uncommited changes!'))
             sys.exit(1)
 
-    # Get all apps...
-    allapps = metadata.read_metadata()
+    # Get all apps, or only the ones that were asked for...
+    allapps = metadata.read_metadata(appids=common.read_pkg_args(options.appid, False))
 
     apps = common.read_app_args(options.appid, allapps, False)
 
@@ -655,27 +1110,53 @@ def main():
         update_wiki(gplaylog, None)
         return
 
-    locallog = ''
-    processed = []
-    failed = dict()
+    checkapps = OrderedDict()
     for appid, app in apps.items():
-
         if options.autoonly and app.AutoUpdateMode in ('None', 'Static'):
             logging.debug(_("Nothing to do for {appid}.").format(appid=appid))
             continue
+        checkapps[appid] = app
 
-        msg = _("Processing {appid}").format(appid=appid)
-        logging.info(msg)
-        locallog += '* ' + msg + '\n'
+    if not options.no_upstream_cache:
+        upstream_cache = UpstreamCache(os.path.join('tmp', 'checkupdates.json'))
+    if options.commit and options.batch_commits:
+        batch_committer = BatchCommitter(config.get('auto_author'))
 
-        try:
-            checkupdates_app(app)
-            processed.append(appid)
-        except Exception as e:
-            msg = _("...checkupdate failed for {appid} : {error}").format(appid=appid, error=e)
-            logging.error(msg)
-            locallog += msg + '\n'
-            failed[appid] = str(e)
+    pool = None
+    if options.jobs > 1:
+        host_rate_limiter = HostRateLimiter(HOST_REQUEST_INTERVAL)
+        pool = CheckPool(checkapps, options.jobs)
+
+    locallog = ''
+    processed = []
+    failed = dict()
+    try:
+        for appid, app in checkapps.items():
+
+            msg = _("Processing {appid}").format(appid=appid)
+            logging.info(msg)
+            locallog += '* ' + msg + '\n'
+
+            try:
+                if pool:
+                    commitmsg = pool.result(appid)
+                else:
+                    commitmsg = check_app(app)
+                if commitmsg:
+                    write_app_update(app, commitmsg)
+                processed.append(appid)
+            except Exception as e:
+                msg = _("...checkupdate failed for {appid} : {error}").format(appid=appid, error=e)
+                logging.error(msg)
+                locallog += msg + '\n'
+                failed[appid] = str(e)
+    finally:
+        if pool:
+            pool.close()
+        if upstream_cache:
+            upstream_cache.save(None if options.appid else allapps.keys())
+        if batch_committer:
+            batch_committer.close()
 
     update_wiki(None, locallog)
     status_update_json(processed, failed)
@@ -26,15 +26,19 @@ import os
 import sys
 import re
 import ast
+import selectors
+import atexit
 import gzip
 import shutil
 import glob
 import stat
+import struct
 import subprocess
 import time
 import operator
 import logging
 import hashlib
+import importlib.util
 import socket
 import base64
 import urllib.parse
@@ -52,7 +56,6 @@ except ImportError:
 from binascii import hexlify
 from datetime import datetime, timedelta, timezone
 from distutils.version import LooseVersion
-from queue import Queue
 from zipfile import ZipFile
 
 from pyasn1.codec.der import decoder, encoder
@@ -64,7 +67,6 @@ import fdroidserver.lint
 from fdroidserver import _
 from fdroidserver.exception import FDroidException, VCSException, NoSubmodulesException,\
     BuildException, VerificationException, MetaDataException
-from .asynchronousfilereader import AsynchronousFileReader
 
 # The path to this fdroidserver distribution
 FDROID_PATH = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
@@ -77,6 +79,8 @@ VERCODE_OPERATION_RE = re.compile(r'^([ 0-9/*+-]|%c)+$')
 
 # A signature block file with a .DSA, .RSA, or .EC extension
 SIGNATURE_BLOCK_FILE_REGEX = re.compile(r'^META-INF/.*\.(DSA|EC|RSA)$')
+APK_SIGNATURE_SCHEME_V2_BLOCK_ID = 0x7109871a
+APK_SIGNATURE_SCHEME_V3_BLOCK_ID = 0xf05368c0
 APK_NAME_REGEX = re.compile(r'^([a-zA-Z][\w.]*)_(-?[0-9]+)_?([0-9a-f]{7})?\.apk')
 APK_ID_TRIPLET_REGEX = re.compile(r"^package: name='(\w[^']*)' versionCode='([^']+)' versionName='([^']*)'")
 STANDARD_FILE_NAME_REGEX = re.compile(r'^(\w[\w.]*)_(-?[0-9]+)\.\w+')
@@ -122,6 +126,7 @@ default_config = {
     'accepted_formats': ['txt', 'yml'],
     'sync_from_local_copy_dir': False,
     'allow_disabled_algorithms': False,
+    'verify_worker': True,
     'per_app_repos': False,
     'make_current_version_link': True,
     'current_version_name_source': 'Name',
@@ -709,6 +714,25 @@ def setup_status_output(start_timestamp):
     return output
 
 
+def write_file_atomically(path, data):
+    """Replace the file at path with data in one go, through a temporary file
+
+    Readers never see a partly written file.  The temporary file has a
+    unique name, so two processes writing the same path at once cannot
+    write into each other's file, the last one to finish wins.
+    """
+    fd, tmppath = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                   dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
 def write_running_status_json(output):
     write_status_json(output, pretty=True, name='running')
 
@@ -1049,6 +1073,87 @@ class vcs_git(vcs):
         return tags
 
 
+class GitTreeReader:
+    """Read the files of any revision straight from the git object database
+
+    This never touches the working tree, so it is a lot cheaper than
+    checking out each revision when only a handful of files are needed
+    from it.  GitPython serves all the reads of one reader through a
+    single long-lived ``git cat-file --batch`` process.
+    """
+
+    def __init__(self, repodir):
+        self.repo = git.Repo(repodir)
+
+    @staticmethod
+    def _get_dest_path(dest, filename):
+        """Get where the file goes below dest, None if it would end up outside of it
+
+        The trees come from upstream, so they cannot be trusted to only
+        have sane paths, and a symlink that is already there must not
+        lead a file out of dest.
+        """
+        parts = filename.split('/')
+        if any(part in ('', '.', '..') for part in parts):
+            return None
+        path = os.path.join(dest, *parts)
+        realdest = os.path.realpath(dest)
+        if os.path.commonpath([realdest, os.path.realpath(os.path.dirname(path))]) != realdest:
+            return None
+        return path
+
+    def export(self, rev, dest, match):
+        """Write the files of rev whose path matches to the same paths below dest
+
+        Paths that would end up outside of dest are skipped.  Symlinks
+        are written last, and files are never written through them.
+
+        :param match: called with the path of each file relative to
+                      the root of the repo, like 'app/build.gradle'
+        :returns: the number of files written
+        """
+        count = 0
+        symlinks = []
+        # ls-tree walks big trees much faster than GitPython's Tree.traverse()
+        for entry in self.repo.git.ls_tree('-r', '-z', '--full-tree', rev + '^{commit}').split('\0'):
+            if not entry:
+                continue
+            info, filename = entry.split('\t', 1)
+            mode, objtype, sha = info.split(' ')
+            if objtype != 'blob' or not match(filename):
+                continue
+            if mode == '120000':
+                symlinks.append((filename, sha))
+                continue
+            path = self._get_dest_path(dest, filename)
+            if path is None:
+                logging.warning(_('Skipping unsafe path in {rev}: {path}').format(rev=rev, path=filename))
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.islink(path):
+                os.remove(path)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o666)
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(self.repo.odb.stream(bytes.fromhex(sha)).read())
+            count += 1
+        for filename, sha in symlinks:
+            path = self._get_dest_path(dest, filename)
+            if path is None:
+                logging.warning(_('Skipping unsafe path in {rev}: {path}').format(rev=rev, path=filename))
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+            os.symlink(self.repo.odb.stream(bytes.fromhex(sha)).read().decode('utf-8'), path)
+            count += 1
+        return count
+
+    def close(self):
+        self.repo.close()
+
+
 class vcs_gitsvn(vcs):
 
     def repotype(self):
@@ -2203,6 +2308,83 @@ def check_system_clock(dt_obj, path):
                         + 'sudo date -s "' + str(dt_obj) + '"')
 
 
+class PackageIndex:
+    """look up the APKs and other files in the repos by packageName
+
+    This is built once from the lists of packages that `fdroid update`
+    scans, so the passes over all apps do not each have to search
+    through all of the packages for every app.  Each package belongs
+    to a repo section like 'repo' or 'archive', and section() returns
+    a view of only one of them.  The packages of a packageName are in
+    the same order as in the lists they came from, as long as packages
+    are only moved between sections with move(), which puts them at
+    the end like list.append() does.
+    """
+
+    def __init__(self, packages=(), repodir=None):
+        self._packages = dict()
+        self._versions = dict()
+        self._repodirs = dict()
+        self._repodir = None
+        self.update(packages, repodir)
+
+    def section(self, repodir):
+        """return a view of this index with only the packages in repodir"""
+        view = PackageIndex()
+        view._packages = self._packages
+        view._versions = self._versions
+        view._repodirs = self._repodirs
+        view._repodir = repodir
+        return view
+
+    def _in_section(self, package):
+        return self._repodir is None or self._repodirs[id(package)] == self._repodir
+
+    @staticmethod
+    def _remove_from(index, key, package):
+        packages = index[key]
+        for i, p in enumerate(packages):
+            if p is package:
+                del packages[i]
+                break
+        if not packages:
+            del index[key]
+
+    def add(self, package, repodir=None):
+        if repodir is None:
+            repodir = self._repodir
+        packageName = package.get('packageName')
+        self._packages.setdefault(packageName, []).append(package)
+        self._versions.setdefault((packageName, package.get('versionCode')), []).append(package)
+        self._repodirs[id(package)] = repodir
+
+    def update(self, packages, repodir=None):
+        for package in packages:
+            self.add(package, repodir)
+
+    def remove(self, package):
+        packageName = package.get('packageName')
+        self._remove_from(self._packages, packageName, package)
+        self._remove_from(self._versions, (packageName, package.get('versionCode')), package)
+        del self._repodirs[id(package)]
+
+    def move(self, package, repodir):
+        """move package to another repo section, after all that are there"""
+        self.remove(package)
+        self.add(package, repodir)
+
+    def get(self, packageName):
+        """return a list of all packages of packageName"""
+        return [p for p in self._packages.get(packageName, ()) if self._in_section(p)]
+
+    def get_version(self, packageName, versionCode):
+        """return a list of the packages of packageName with versionCode"""
+        return [p for p in self._versions.get((packageName, versionCode), ()) if self._in_section(p)]
+
+    def __contains__(self, packageName):
+        return any(self._in_section(p) for p in self._packages.get(packageName, ()))
+
+
 class KnownApks:
     """permanent store of existing APKs with the date they were added
 
@@ -2317,13 +2499,13 @@ def use_androguard():
 use_androguard.show_path = True
 
 
-def _get_androguard_APK(apkfile):
+def _get_androguard_APK(apkfile, raw=False):
     try:
         from androguard.core.bytecodes.apk import APK
     except ImportError:
         raise FDroidException("androguard library is not installed and aapt not present")
 
-    return APK(apkfile)
+    return APK(apkfile, raw=raw)
 
 
 def ensure_final_value(packageName, arsc, value):
@@ -2361,24 +2543,28 @@ def is_apk_and_debuggable_aapt(apkfile):
 
 def is_apk_and_debuggable_androguard(apkfile):
     """Parse only <application android:debuggable=""> from the APK"""
-    from androguard.core.bytecodes.axml import AXMLParser, format_value, START_TAG
     with ZipFile(apkfile) as apk:
-        with apk.open('AndroidManifest.xml') as manifest:
-            axml = AXMLParser(manifest.read())
-            while axml.is_valid():
-                _type = next(axml)
-                if _type == START_TAG and axml.getName() == 'application':
-                    for i in range(0, axml.getAttributeCount()):
-                        name = axml.getAttributeName(i)
-                        if name == 'debuggable':
-                            _type = axml.getAttributeValueType(i)
-                            _data = axml.getAttributeValueData(i)
-                            value = format_value(_type, _data, lambda _: axml.getAttributeValue(i))
-                            if value == 'true':
-                                return True
-                            else:
-                                return False
-                    break
+        return _is_manifest_debuggable(apk.read('AndroidManifest.xml'))
+
+
+def _is_manifest_debuggable(manifest):
+    """Parse only <application android:debuggable=""> from binary AndroidManifest.xml"""
+    from androguard.core.bytecodes.axml import AXMLParser, format_value, START_TAG
+    axml = AXMLParser(manifest)
+    while axml.is_valid():
+        _type = next(axml)
+        if _type == START_TAG and axml.getName() == 'application':
+            for i in range(0, axml.getAttributeCount()):
+                name = axml.getAttributeName(i)
+                if name == 'debuggable':
+                    _type = axml.getAttributeValueType(i)
+                    _data = axml.getAttributeValueData(i)
+                    value = format_value(_type, _data, lambda _: axml.getAttributeValue(i))
+                    if value == 'true':
+                        return True
+                    else:
+                        return False
+            break
     return False
 
 
@@ -2488,16 +2674,94 @@ def get_apk_id_aapt(apkfile):
 def get_native_code(apkfile):
     """aapt checks if there are architecture folders under the lib/ folder
     so we are simulating the same behaviour"""
+    with ZipFile(apkfile) as apk:
+        return _get_native_code_from_namelist(apk.namelist())
+
+
+def _get_native_code_from_namelist(namelist):
     arch_re = re.compile("^lib/(.*)/.*$")
     archset = set()
-    with ZipFile(apkfile) as apk:
-        for filename in apk.namelist():
-            m = arch_re.match(filename)
-            if m:
-                archset.add(m.group(1))
+    for filename in namelist:
+        m = arch_re.match(filename)
+        if m:
+            archset.add(m.group(1))
     return sorted(list(archset))
 
 
+class ApkInspector:
+    """A single parsed view of an APK file
+
+    Scanning an APK used to open and parse the file once for each
+    thing that was needed from it: the hash, the manifest, the
+    signing certificate, the native code, the icons, etc.  This hashes
+    the file in one streaming pass, then parses the ZIP central
+    directory once.  Everything else is served from that, and the
+    expensive parts are only done on demand.  The APK is never held
+    in memory as a whole, so many of them can be inspected in
+    parallel.
+
+    :param apkfile: path to the APK file
+    """
+
+    def __init__(self, apkfile):
+        self.path = apkfile
+        sha = hashlib.sha256()
+        size = 0
+        with open(apkfile, 'rb') as fp:
+            self.header = fp.read(4)
+            fp.seek(0)
+            while True:
+                chunk = fp.read(1024 * 1024)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                size += len(chunk)
+        self.sha256 = sha.hexdigest()
+        self.size = size
+        self.zip = ZipFile(apkfile)
+        self._namelist = None
+        self._androguard_apk = None
+        self._first_signer_certificate = None
+
+    def namelist(self):
+        if self._namelist is None:
+            self._namelist = self.zip.namelist()
+        return self._namelist
+
+    def read(self, name):
+        return self.zip.read(name)
+
+    def get_androguard_apk(self):
+        """Get an androguard APK instance, which is only parsed once"""
+        if self._androguard_apk is None:
+            self._androguard_apk = _get_androguard_APK(self.path)
+        return self._androguard_apk
+
+    def get_first_signer_certificate(self):
+        """Get the first signing certificate from the APK, DER-encoded
+
+        This is the same as get_first_signer_certificate(), but only
+        looks for it once.
+        """
+        if self._first_signer_certificate is None:
+            with open(self.path, 'rb') as fp:
+                self._first_signer_certificate = _get_first_signer_certificate(
+                    self.path, self.namelist(), self.read, fp)
+        return self._first_signer_certificate
+
+    def get_native_code(self):
+        return _get_native_code_from_namelist(self.namelist())
+
+    def is_debuggable(self):
+        """Returns True if the APK is debuggable, like is_apk_and_debuggable()"""
+        if get_file_extension(self.path) != 'apk':
+            return False
+        if use_androguard():
+            return _is_manifest_debuggable(self.read('AndroidManifest.xml'))
+        else:
+            return is_apk_and_debuggable_aapt(self.path)
+
+
 def get_minSdkVersion_aapt(apkfile):
     """Extract the minimum supported Android SDK from an APK using aapt
 
@@ -2567,34 +2831,27 @@ def FDroidPopenBytes(commands, cwd=None, envs=None, output=True, stderr_to_stdou
         raise BuildException("OSError while trying to execute "
                              + ' '.join(commands) + ': ' + str(e))
 
-    # TODO are these AsynchronousFileReader threads always exiting?
-    if not stderr_to_stdout and options.verbose:
-        stderr_queue = Queue()
-        stderr_reader = AsynchronousFileReader(p.stderr, stderr_queue)
-
-        while not stderr_reader.eof():
-            while not stderr_queue.empty():
-                line = stderr_queue.get()
-                sys.stderr.buffer.write(line)
-                sys.stderr.flush()
-
-            time.sleep(0.1)
-
-    stdout_queue = Queue()
-    stdout_reader = AsynchronousFileReader(p.stdout, stdout_queue)
+    # Read whatever is there as soon as it is there, until the pipes are
+    # closed.  A separate stderr is only shown with --verbose, but it is
+    # read anyway so the process cannot block on a full pipe.
     buf = io.BytesIO()
-
-    # Check the queue for output (until there is no more to get)
-    while not stdout_reader.eof():
-        while not stdout_queue.empty():
-            line = stdout_queue.get()
-            if output and options.verbose:
+    selector = selectors.DefaultSelector()
+    selector.register(p.stdout, selectors.EVENT_READ, output and options.verbose)
+    if not stderr_to_stdout:
+        selector.register(p.stderr, selectors.EVENT_READ, options.verbose)
+    while selector.get_map():
+        for key, events in selector.select():
+            data = os.read(key.fd, 65536)
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            if key.fileobj is p.stdout:
+                buf.write(data)
+            if key.data:
                 # Output directly to console
-                sys.stderr.buffer.write(line)
+                sys.stderr.buffer.write(data)
                 sys.stderr.flush()
-            buf.write(line)
-
-        time.sleep(0.1)
+    selector.close()
 
     result.returncode = p.wait()
     result.output = buf.getvalue()
@@ -2809,27 +3066,36 @@ def signer_fingerprint(cert_encoded):
 
 def get_first_signer_certificate(apkpath):
     """Get the first signing certificate from the APK,  DER-encoded"""
-    certs = None
+    with open(apkpath, 'rb') as fp:
+        with zipfile.ZipFile(fp, 'r') as apk:
+            return _get_first_signer_certificate(apkpath, apk.namelist(), apk.read, fp)
+
+
+def _get_first_signer_certificate(apkpath, namelist, read, fp):
+    """Find the first signing certificate using the given accessors
+
+    :param apkpath: the path of the APK, for the log messages
+    :param namelist: the list of the files in the APK
+    :param read: function to read a file from the APK
+    :param fp: the APK as a seekable binary file object, to read the
+      APK Signing Block from
+    """
     cert_encoded = None
-    with zipfile.ZipFile(apkpath, 'r') as apk:
-        cert_files = [n for n in apk.namelist() if SIGNATURE_BLOCK_FILE_REGEX.match(n)]
-        if len(cert_files) > 1:
-            logging.error(_("Found multiple JAR Signature Block Files in {path}").format(path=apkpath))
-            return None
-        elif len(cert_files) == 1:
-            cert_encoded = get_certificate(apk.read(cert_files[0]))
+    cert_files = [n for n in namelist if SIGNATURE_BLOCK_FILE_REGEX.match(n)]
+    if len(cert_files) > 1:
+        logging.error(_("Found multiple JAR Signature Block Files in {path}").format(path=apkpath))
+        return None
+    elif len(cert_files) == 1:
+        cert_encoded = get_certificate(read(cert_files[0]))
 
-    if not cert_encoded and use_androguard():
-        apkobject = _get_androguard_APK(apkpath)
-        certs = apkobject.get_certificates_der_v2()
-        if len(certs) > 0:
+    if not cert_encoded:
+        v2certs, v3certs = get_signing_block_certificates(fp)
+        if len(v2certs) > 0:
             logging.debug(_('Using APK Signature v2'))
-            cert_encoded = certs[0]
-        if not cert_encoded:
-            certs = apkobject.get_certificates_der_v3()
-            if len(certs) > 0:
-                logging.debug(_('Using APK Signature v3'))
-                cert_encoded = certs[0]
+            cert_encoded = v2certs[0]
+        elif len(v3certs) > 0:
+            logging.debug(_('Using APK Signature v3'))
+            cert_encoded = v3certs[0]
 
     if not cert_encoded:
         logging.error(_("No signing certificates found in {path}").format(path=apkpath))
@@ -2943,6 +3209,90 @@ def metadata_find_developer_signing_files(appid, vercode):
         return None
 
 
+class DeveloperSignatures:
+    """The developer signatures in metadata/<appid>/signatures/
+
+    This finds all of them with one scan of the metadata directory,
+    instead of globbing the signatures directory of every app that
+    is looked up, and then gives the same results as
+    metadata_find_developer_signature() and
+    metadata_find_developer_signing_files().  The fingerprints are
+    only read from the signature files when they are looked up, and
+    then kept.  Get the shared one with get_developer_signatures().
+    """
+
+    def __init__(self, metadatadir='metadata'):
+        self.metadatadir = metadatadir
+        self.sigdirs = dict()
+        self.fingerprints = dict()
+        if not os.path.isdir(metadatadir):
+            return
+        numre = re.compile('[0-9]+')
+        for appid in os.listdir(metadatadir):
+            appsigdir = os.path.join(metadatadir, appid, 'signatures')
+            if not os.path.isdir(appsigdir):
+                continue
+            versions = []
+            for ver in os.listdir(appsigdir):
+                if numre.match(ver):
+                    sigdir = os.path.join(appsigdir, ver)
+                    sigs = glob.glob(os.path.join(sigdir, '*.DSA')) + \
+                        glob.glob(os.path.join(sigdir, '*.EC')) + \
+                        glob.glob(os.path.join(sigdir, '*.RSA'))
+                    versions.append((ver, sigs))
+            self.sigdirs[appid] = versions
+
+    def get_fingerprint(self, appid):
+        """Like metadata_find_developer_signature(appid)"""
+        if appid not in self.fingerprints:
+            fingerprint = None
+            for ver, sigs in self.sigdirs.get(appid, []):
+                if len(sigs) > 1:
+                    raise FDroidException('ambiguous signatures, please make sure there is only one signature in \'{}\'. (The signature has to be the App maintainers signature for version of the APK.)'.format(os.path.join(self.metadatadir, appid, 'signatures', ver)))
+                if sigs:
+                    with open(sigs[0], 'rb') as f:
+                        fingerprint = signer_fingerprint(get_certificate(f.read()))
+                    break
+            self.fingerprints[appid] = fingerprint
+        return self.fingerprints[appid]
+
+    def get_signing_files(self, appid, vercode):
+        """Like metadata_find_developer_signing_files(appid, vercode)"""
+        if not vercode or not re.match('[0-9]+', str(vercode)):
+            # not in a directory that was scanned
+            return metadata_find_developer_signing_files(appid, vercode)
+        sigs = dict(self.sigdirs.get(appid, [])).get(str(vercode))
+        if sigs is None:
+            return None
+        ret = []
+        extre = re.compile(r'(\.DSA|\.EC|\.RSA)$')
+        for sig in sigs:
+            sf = extre.sub('.SF', sig)
+            if os.path.isfile(sf):
+                mf = os.path.join(os.path.dirname(sig), 'MANIFEST.MF')
+                if os.path.isfile(mf):
+                    ret.append((sig, sf, mf))
+        if len(ret) == 1:
+            return ret[0]
+        return None
+
+
+_developer_signatures = None
+_developer_signatures_dir = None
+
+
+def get_developer_signatures():
+    """Get the DeveloperSignatures of the metadata/ in the current directory
+
+    The scan is only done once per process and metadata directory.
+    """
+    global _developer_signatures, _developer_signatures_dir
+    if _developer_signatures is None or _developer_signatures_dir != os.path.abspath('metadata'):
+        _developer_signatures = DeveloperSignatures()
+        _developer_signatures_dir = os.path.abspath('metadata')
+    return _developer_signatures
+
+
 def apk_strip_signatures(signed_apk, strip_manifest=False):
     """Removes signatures from APK.
 
@@ -3113,6 +3463,10 @@ def verify_apks(signed_apk, unsigned_apk, tmp_dir):
 def verify_jar_signature(jar):
     """Verifies the signature of a given JAR file.
 
+    This is done in Python when the cryptography library is
+    installed, see verify_jar_signature_v1(), so no JVM has to be
+    started.  Otherwise, this falls back to jarsigner.
+
     jarsigner is very shitty: unsigned JARs pass as "verified"! So
     this has to turn on -strict then check for result 4, since this
     does not expect the signature to be from a CA-signed certificate.
@@ -3122,6 +3476,15 @@ def verify_jar_signature(jar):
     """
 
     error = _('JAR signature failed to verify: {path}').format(path=jar)
+    try:
+        verify_jar_signature_v1(jar)
+        logging.debug(_('JAR signature verified: {path}').format(path=jar))
+        return
+    except ImportError:
+        pass
+    except VerificationException as e:
+        raise VerificationException(error + '\n' + str(e))
+
     try:
         output = subprocess.check_output([config['jarsigner'], '-strict', '-verify', jar],
                                          stderr=subprocess.STDOUT)
@@ -3133,6 +3496,218 @@ def verify_jar_signature(jar):
             raise VerificationException(error + '\n' + e.output.decode('utf-8'))
 
 
+JAR_DIGEST_ALGORITHMS = {
+    'SHA1': hashlib.sha1,
+    'SHA256': hashlib.sha256,
+    'SHA384': hashlib.sha384,
+    'SHA512': hashlib.sha512,
+}
+
+
+def _split_jar_manifest(data):
+    """Split a JAR manifest or signature file into its raw sections
+
+    Each section includes the blank line that ends it, since that is
+    what the digests in the signature file are made over.
+
+    :returns: a list of (raw bytes, attributes) tuples, with the main
+      attributes first, and the attribute names in upper case.
+    """
+    sections = []
+    start = 0
+    attributes = dict()
+    name = None
+    lines = re.split(b'(\r\n|\r|\n)', data)
+    pos = 0
+    for i in range(0, len(lines), 2):
+        line = lines[i]
+        eol = lines[i + 1] if i + 1 < len(lines) else b''
+        pos += len(line) + len(eol)
+        if line.startswith(b' ') and name is not None:
+            attributes[name] += line[1:].decode('utf-8')
+            continue
+        if line == b'':
+            if attributes or (not sections and pos > start):
+                sections.append((data[start:pos], attributes))
+            attributes = dict()
+            name = None
+            start = pos
+            continue
+        if b':' not in line:
+            raise VerificationException(_('Invalid line in JAR manifest: {line}').format(line=line))
+        key, value = line.split(b':', 1)
+        name = key.decode('utf-8').strip().upper()
+        attributes[name] = value.decode('utf-8').lstrip(' ')
+    if attributes:
+        sections.append((data[start:], attributes))
+    return sections
+
+
+def _check_jar_digests(attributes, data, suffix='-DIGEST'):
+    """Check the <alg>-Digest attributes of a section against data
+
+    :returns: True if at least one digest was checked and they all match
+    """
+    checked = False
+    for key, value in attributes.items():
+        if not key.endswith(suffix):
+            continue
+        algorithm = key[:-len(suffix)].replace('-', '')
+        if algorithm not in JAR_DIGEST_ALGORITHMS:
+            continue  # MD5 and friends are disabled, like in jarsigner
+        if base64.b64decode(value) != JAR_DIGEST_ALGORITHMS[algorithm](data).digest():
+            return False
+        checked = True
+    return checked
+
+
+def _verify_jar_signature_block(block, signature_file):
+    """Verify the PKCS#7 signature of a JAR signature file
+
+    :returns: the DER-encoded signer certificate
+    """
+    from asn1crypto import cms
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import dsa, ec, padding, rsa
+
+    try:
+        signed_data = cms.ContentInfo.load(block)['content']
+        signer_info = signed_data['signer_infos'][0]
+        sid = signer_info['sid'].chosen
+        for certificate in signed_data['certificates']:
+            certificate = certificate.chosen
+            if certificate.issuer == sid['issuer'] and certificate.serial_number == sid['serial_number'].native:
+                break
+        else:
+            raise VerificationException(_('The signer certificate is missing'))
+        digest_algorithm = signer_info['digest_algorithm']['algorithm'].native
+        hash_algorithm = {
+            'sha1': hashes.SHA1,
+            'sha256': hashes.SHA256,
+            'sha384': hashes.SHA384,
+            'sha512': hashes.SHA512,
+        }.get(digest_algorithm)
+        if hash_algorithm is None:
+            raise VerificationException(_('Disabled digest algorithm: {algorithm}')
+                                        .format(algorithm=digest_algorithm))
+        signed = signature_file
+        if signer_info['signed_attrs']:
+            message_digest = None
+            for attribute in signer_info['signed_attrs']:
+                if attribute['type'].native == 'message_digest':
+                    message_digest = attribute['values'][0].native
+            if message_digest != getattr(hashlib, digest_algorithm)(signature_file).digest():
+                raise VerificationException(_('The signature file does not match its signature'))
+            signed = b'\x31' + signer_info['signed_attrs'].dump()[1:]
+        cert = x509.load_der_x509_certificate(certificate.dump())
+        public_key = cert.public_key()
+        signature = signer_info['signature'].native
+        if isinstance(public_key, rsa.RSAPublicKey):
+            if public_key.key_size < 1024:
+                raise VerificationException(_('Disabled key size: RSA {size}')
+                                            .format(size=public_key.key_size))
+            public_key.verify(signature, signed, padding.PKCS1v15(), hash_algorithm())
+        elif isinstance(public_key, dsa.DSAPublicKey):
+            public_key.verify(signature, signed, hash_algorithm())
+        elif isinstance(public_key, ec.EllipticCurvePublicKey):
+            public_key.verify(signature, signed, ec.ECDSA(hash_algorithm()))
+        else:
+            raise VerificationException(_('Unsupported signature key'))
+    except InvalidSignature:
+        raise VerificationException(_('The signature does not match the signature file'))
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        raise VerificationException(_('Could not parse the signature block: {error}').format(error=e))
+
+    key_usage = certificate.key_usage_value
+    if key_usage is not None and not key_usage.native & {'digital_signature', 'non_repudiation'}:
+        raise VerificationException(_('The signer certificate is not allowed to sign code'))
+    extended_key_usage = certificate.extended_key_usage_value
+    if extended_key_usage is not None \
+       and not set(extended_key_usage.native) & {'any_extended_key_usage', 'code_signing'}:
+        raise VerificationException(_('The signer certificate is not allowed to sign code'))
+    return certificate.dump()
+
+
+def verify_jar_signature_v1(jar):
+    """Verify the v1 JAR signature of a JAR or APK in Python
+
+    This checks what `jarsigner -strict -verify` does for the exit
+    code 4 that verify_jar_signature() accepts: every signature block
+    is a valid PKCS#7 signature of its .SF file, the .SF file matches
+    MANIFEST.MF, MANIFEST.MF matches the contents of every entry, and
+    no entry is left unsigned.  Like jarsigner, MD5 and MD2 digests and
+    RSA keys smaller than 1024 bits do not count.  An entry name that is
+    in the JAR twice is rejected, since only one of them can be signed.
+
+    :raises: ImportError if the cryptography library is not installed
+    :raises: VerificationException() if the JAR's signature could not be verified
+    """
+    # this is checked first, so that the jarsigner fallback can be used
+    for module in ('asn1crypto', 'cryptography'):
+        if not importlib.util.find_spec(module):
+            raise ImportError(module + ' is not installed')
+
+    with zipfile.ZipFile(jar) as zf:
+        namelist = zf.namelist()
+        seen = set()
+        for name in namelist:
+            if name in seen:
+                raise VerificationException(_('Duplicate entry: {name}').format(name=name))
+            seen.add(name)
+        if 'META-INF/MANIFEST.MF' not in namelist:
+            raise VerificationException(_('JAR is not signed: no META-INF/MANIFEST.MF'))
+        manifest = zf.read('META-INF/MANIFEST.MF')
+        manifest_sections = _split_jar_manifest(manifest)
+        entries = dict()
+        for raw, attributes in manifest_sections[1:]:
+            if 'NAME' in attributes:
+                entries[attributes['NAME']] = (raw, attributes)
+
+        blocks = [n for n in namelist if SIGNATURE_BLOCK_FILE_REGEX.match(n)]
+        if not blocks:
+            raise VerificationException(_('JAR is not signed: no signature block file'))
+        signed_names = None
+        for block in blocks:
+            sf_name = block.rsplit('.', 1)[0] + '.SF'
+            if sf_name not in namelist:
+                raise VerificationException(_('Missing signature file {name}').format(name=sf_name))
+            signature_file = zf.read(sf_name)
+            _verify_jar_signature_block(zf.read(block), signature_file)
+
+            sf_sections = _split_jar_manifest(signature_file)
+            main_attributes = sf_sections[0][1] if sf_sections else dict()
+            names = set()
+            if _check_jar_digests(main_attributes, manifest, '-DIGEST-MANIFEST'):
+                names = set(entries)
+            else:
+                if manifest_sections and any(k.endswith('-DIGEST-MANIFEST-MAIN-ATTRIBUTES')
+                                             for k in main_attributes):
+                    if not _check_jar_digests(main_attributes, manifest_sections[0][0],
+                                              '-DIGEST-MANIFEST-MAIN-ATTRIBUTES'):
+                        raise VerificationException(_('{name} does not match the main attributes of MANIFEST.MF')
+                                                    .format(name=sf_name))
+                for raw, attributes in sf_sections[1:]:
+                    name = attributes.get('NAME')
+                    if name not in entries or not _check_jar_digests(attributes, entries[name][0]):
+                        raise VerificationException(_('{name} does not match MANIFEST.MF for {entry}')
+                                                    .format(name=sf_name, entry=name))
+                    names.add(name)
+            signed_names = names if signed_names is None else signed_names & names
+
+        for info in zf.infolist():
+            name = info.filename
+            if name.endswith('/') or (name.upper().startswith('META-INF/') and '/' not in name[9:]
+                                      and re.match(r'(MANIFEST\.MF|.*\.(SF|RSA|DSA|EC)|SIG-.*)$',
+                                                   name[9:], re.IGNORECASE)):
+                continue
+            if name not in signed_names:
+                raise VerificationException(_('Unsigned entry: {name}').format(name=name))
+            if not _check_jar_digests(entries[name][1], zf.read(info)):
+                raise VerificationException(_('Digest mismatch: {name}').format(name=name))
+
+
 def verify_apk_signature(apk, min_sdk_version=None):
     """verify the signature on an APK
 
@@ -3143,6 +3718,10 @@ def verify_apk_signature(apk, min_sdk_version=None):
     :returns: boolean whether the APK was verified
     """
     if set_command_in_config('apksigner'):
+        worker = _get_verify_worker('apksigner')
+        if worker and worker.verify(apk, min_sdk_version):
+            logging.debug(_('APK signature verified: {path}').format(path=apk))
+            return True
         args = [config['apksigner'], 'verify']
         if min_sdk_version:
             args += ['--min-sdk-version=' + min_sdk_version]
@@ -3167,6 +3746,28 @@ def verify_apk_signature(apk, min_sdk_version=None):
     return False
 
 
+def _write_old_java_security():
+    """Write the java.security settings that allow the deprecated algorithms
+
+    Just to be safe, this never reuses the file, and locks down the
+    file permissions while in use.  That should prevent a bad actor
+    from changing the settings during operation.
+    """
+    _java_security = os.path.join(os.getcwd(), '.java.security')
+    if os.path.exists(_java_security):
+        os.remove(_java_security)
+    with open(_java_security, 'w') as fp:
+        fp.write('jdk.jar.disabledAlgorithms=MD2, RSA keySize < 1024')
+    os.chmod(_java_security, 0o400)
+    return _java_security
+
+
+def _remove_old_java_security(_java_security):
+    if os.path.exists(_java_security):
+        os.chmod(_java_security, 0o600)
+        os.remove(_java_security)
+
+
 def verify_old_apk_signature(apk):
     """verify the signature on an archived APK, supporting deprecated algorithms
 
@@ -3177,21 +3778,16 @@ def verify_old_apk_signature(apk):
     jarsigner passes unsigned APKs as "verified"! So this has to turn
     on -strict then check for result 4.
 
-    Just to be safe, this never reuses the file, and locks down the
-    file permissions while in use.  That should prevent a bad actor
-    from changing the settings during operation.
-
     :returns: boolean whether the APK was verified
 
     """
 
-    _java_security = os.path.join(os.getcwd(), '.java.security')
-    if os.path.exists(_java_security):
-        os.remove(_java_security)
-    with open(_java_security, 'w') as fp:
-        fp.write('jdk.jar.disabledAlgorithms=MD2, RSA keySize < 1024')
-    os.chmod(_java_security, 0o400)
+    worker = _get_verify_worker('jarsigner')
+    if worker and worker.verify(apk):
+        logging.debug(_('JAR signature verified: {path}').format(path=apk))
+        return True
 
+    _java_security = _write_old_java_security()
     try:
         cmd = [
             config['jarsigner'],
@@ -3206,15 +3802,140 @@ def verify_old_apk_signature(apk):
             logging.debug(_('JAR signature verified: {path}').format(path=apk))
             return True
     finally:
-        if os.path.exists(_java_security):
-            os.chmod(_java_security, 0o600)
-            os.remove(_java_security)
+        _remove_old_java_security(_java_security)
 
     logging.error(_('Old APK signature failed to verify: {path}').format(path=apk)
                   + '\n' + output.decode('utf-8'))
     return False
 
 
+class VerifyWorker:
+    """A long-lived Java process that verifies APK signatures
+
+    Starting Java takes much longer than verifying an APK, so this
+    runs fdroidserver/VerifyWorker.java once, then sends it the paths
+    of all the APKs to verify over stdin, and reads back one line per
+    APK.  The 'apksigner' mode uses the ApkVerifier from apksigner.jar,
+    the 'jarsigner' mode does the checks of verify_old_apk_signature().
+
+    Only a positive answer is trusted, in any other case the callers
+    run apksigner or jarsigner on that APK, like before, so that the
+    error gets reported as it always was.
+
+    :param mode: 'apksigner' or 'jarsigner'
+    :param java: the java binary, version 11 or newer
+    :param classpath: the path to apksigner.jar for the 'apksigner' mode
+    """
+
+    def __init__(self, mode, java, classpath=None):
+        self.mode = mode
+        self.pid = os.getpid()
+        cmd = [java]
+        if classpath:
+            cmd += ['-cp', classpath]
+        _java_security = None
+        if mode == 'jarsigner':
+            _java_security = _write_old_java_security()
+            cmd += ['-Djava.security.properties=' + _java_security]
+        cmd += [os.path.join(os.path.dirname(__file__), 'VerifyWorker.java'), mode]
+        try:
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL)
+            ready = self.process.stdout.readline()
+        finally:
+            if _java_security:
+                _remove_old_java_security(_java_security)
+        if ready != b'READY\n':
+            self.close()
+            raise FDroidException(_('Could not start the {mode} verify worker').format(mode=mode))
+
+    def verify(self, apk, min_sdk_version=None):
+        """Verify the signature of one APK
+
+        :returns: True only if the APK was verified
+        """
+        path = os.path.abspath(apk)
+        if self.process is None or '\n' in path or '\r' in path:
+            return False
+        try:
+            self.process.stdin.write(('%s\t%s\n' % (min_sdk_version or '-', path)).encode('utf-8'))
+            self.process.stdin.flush()
+            result = self.process.stdout.readline()
+        except OSError:
+            result = b''
+        if not result:
+            logging.debug(_('The {mode} verify worker died').format(mode=self.mode))
+            self.close()
+            return False
+        return result == b'OK\n'
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+            self.process.stdout.close()
+            self.process = None
+
+
+_verify_workers = dict()
+
+
+def _find_apksigner_jar():
+    apksigner = os.path.realpath(config['apksigner'])
+    for path in (os.path.join(os.path.dirname(apksigner), 'lib', 'apksigner.jar'),
+                 '/usr/share/java/apksig.jar'):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _get_verify_worker(mode):
+    """Get the running VerifyWorker for the mode, starting it if needed
+
+    This is started only once per process, the forked worker processes
+    of `fdroid update --jobs` each start their own.
+
+    :returns: the VerifyWorker, or None to verify each APK separately
+    """
+    if not config.get('verify_worker', True):
+        return None
+    worker = _verify_workers.get(mode)
+    if worker is not None and (worker is False or worker.pid == os.getpid()):
+        return worker or None
+    _verify_workers[mode] = False
+    if 'jarsigner' not in config:
+        return None
+    java = os.path.join(os.path.dirname(os.path.realpath(config['jarsigner'])), 'java')
+    if not os.path.exists(java):
+        java = shutil.which('java')
+    if not java:
+        return None
+    classpath = None
+    if mode == 'apksigner':
+        classpath = _find_apksigner_jar()
+        if not classpath:
+            return None
+    try:
+        worker = VerifyWorker(mode, java, classpath)
+    except (OSError, FDroidException) as e:
+        logging.debug(_('Verifying APKs one at a time: {error}').format(error=e))
+        return None
+    _verify_workers[mode] = worker
+    return worker
+
+
+@atexit.register
+def stop_verify_workers():
+    """Stop the running VerifyWorker instances, started by this process"""
+    for mode, worker in list(_verify_workers.items()):
+        if worker and worker.pid == os.getpid():
+            worker.close()
+        del _verify_workers[mode]
+
+
 apk_badchars = re.compile('''[/ :;'"]''')
 
 
@@ -3407,6 +4128,122 @@ def get_certificate(signature_block_file):
     return encoder.encode(cert)
 
 
+def _read_length_prefixed(data, offset):
+    """Read a block prefixed with its uint32 little-endian length
+
+    :returns: (block, offset) where offset is where the next block starts
+    """
+    (length, ) = struct.unpack_from('<I', data, offset)
+    offset += 4
+    if offset + length > len(data):
+        raise ValueError('length-prefixed block is longer than its container')
+    return data[offset:offset + length], offset + length
+
+
+def get_apk_signing_block(fp):
+    """Get the ID-value pairs in the APK Signing Block of an APK
+
+    The APK Signing Block sits right before the ZIP Central Directory,
+    so this only reads the End of Central Directory record at the end
+    of the file, then the block, without parsing the rest of the APK.
+    https://source.android.com/security/apksigning/v2#apk-signing-block
+
+    :param fp: the APK as a seekable binary file object
+    :returns: a dict of the block ID to its value, or None if there
+      is no APK Signing Block
+    """
+    fp.seek(0, os.SEEK_END)
+    filesize = fp.tell()
+    # the EOCD record is 22 bytes, followed by a comment of up to 65535 bytes
+    tailsize = min(filesize, 22 + 0xffff)
+    fp.seek(filesize - tailsize)
+    tail = fp.read(tailsize)
+    eocd = tail.rfind(b'PK\x05\x06')
+    while eocd >= 0:
+        if len(tail) >= eocd + 22:
+            (comment_length, ) = struct.unpack_from('<H', tail, eocd + 20)
+            if eocd + 22 + comment_length == len(tail):
+                break
+        eocd = tail.rfind(b'PK\x05\x06', 0, eocd)
+    if eocd < 0:
+        return None
+    (cd_offset, ) = struct.unpack_from('<I', tail, eocd + 16)
+    if cd_offset < 32 or cd_offset == 0xffffffff:  # ZIP64 is not allowed in APKs
+        return None
+
+    # the block ends with its size as uint64 and the magic
+    fp.seek(cd_offset - 24)
+    footer = fp.read(24)
+    if len(footer) != 24 or footer[8:] != b'APK Sig Block 42':
+        return None
+    (block_size, ) = struct.unpack('<Q', footer[:8])
+    if block_size < 24 or block_size + 8 > cd_offset:
+        return None
+    fp.seek(cd_offset - block_size - 8)
+    block = fp.read(block_size - 24 + 8)
+    (block_size_start, ) = struct.unpack_from('<Q', block, 0)
+    if block_size_start != block_size:
+        return None
+
+    pairs = dict()
+    offset = 8
+    while offset < len(block):
+        (pair_length, ) = struct.unpack_from('<Q', block, offset)
+        offset += 8
+        if pair_length < 4 or offset + pair_length > len(block):
+            raise ValueError('APK Signing Block has a broken ID-value pair')
+        (block_id, ) = struct.unpack_from('<I', block, offset)
+        pairs[block_id] = block[offset + 4:offset + pair_length]
+        offset += pair_length
+    return pairs
+
+
+def get_apk_signature_scheme_certificates(value):
+    """Get the DER-encoded certificates from a v2 or v3 APK Signature Scheme block
+
+    The signers and their signed data are laid out the same way in
+    both versions, and the certificates always come right after the
+    digests.  The certificates of all signers are returned, in order.
+
+    :param value: the value of the block from get_apk_signing_block()
+    """
+    certs = []
+    signers, _ignored = _read_length_prefixed(value, 0)
+    offset = 0
+    while offset < len(signers):
+        signer, offset = _read_length_prefixed(signers, offset)
+        signed_data, _ignored = _read_length_prefixed(signer, 0)
+        _digests, pos = _read_length_prefixed(signed_data, 0)
+        certificates, _ignored = _read_length_prefixed(signed_data, pos)
+        pos = 0
+        while pos < len(certificates):
+            cert, pos = _read_length_prefixed(certificates, pos)
+            certs.append(cert)
+    return certs
+
+
+def get_signing_block_certificates(fp):
+    """Get the signing certificates from the APK Signing Block
+
+    :param fp: the APK as a seekable binary file object
+    :returns: (v2certs, v3certs) as lists of DER-encoded certificates
+    """
+    try:
+        pairs = get_apk_signing_block(fp)
+        if not pairs:
+            return [], []
+        v2certs = []
+        if APK_SIGNATURE_SCHEME_V2_BLOCK_ID in pairs:
+            v2certs = get_apk_signature_scheme_certificates(pairs[APK_SIGNATURE_SCHEME_V2_BLOCK_ID])
+        v3certs = []
+        if APK_SIGNATURE_SCHEME_V3_BLOCK_ID in pairs:
+            v3certs = get_apk_signature_scheme_certificates(pairs[APK_SIGNATURE_SCHEME_V3_BLOCK_ID])
+    except (ValueError, struct.error) as e:
+        logging.debug('Could not parse the APK Signing Block: ' + str(e))
+        return [], []
+    return v2certs, v3certs
+
+
 def load_stats_fdroid_signing_key_fingerprints():
     """Load list of signing-key fingerprints stored by fdroid publish from file.
 
@@ -3415,9 +4252,9 @@ def load_stats_fdroid_signing_key_fingerprints():
     jar_file = os.path.join('stats', 'publishsigkeys.jar')
     if not os.path.isfile(jar_file):
         return {}
-    cmd = [config['jarsigner'], '-strict', '-verify', jar_file]
-    p = FDroidPopen(cmd, output=False)
-    if p.returncode != 4:
+    try:
+        verify_jar_signature(jar_file)
+    except VerificationException:
         raise FDroidException("Signature validation of '{}' failed! "
                               "Please run publish again to rebuild this file.".format(jar_file))
 
@@ -49,3 +49,7 @@ class BuildException(FDroidException):
 
 class VerificationException(FDroidException):
     pass
+
+
+class InProcessSigningUnsupported(FDroidException):
+    pass
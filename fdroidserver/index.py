@@ -44,7 +44,7 @@ from fdroidserver.common import FDroidPopen, FDroidPopenBytes, load_stats_fdroid
 from fdroidserver.exception import FDroidException, VerificationException, MetaDataException
 
 
-def make(apps, sortedids, apks, repodir, archive):
+def make(apps, sortedids, apks, repodir, archive, packageindex=None):
     """Generate the repo index files.
 
     This requires properly initialized options and config objects.
@@ -55,6 +55,7 @@ def make(apps, sortedids, apks, repodir, archive):
     :param repodir: the repo directory
     :param archive: True if this is the archive repo, False if it's the
                     main one.
+    :param packageindex: common.PackageIndex of apks, made if None
     """
     from fdroidserver.update import METADATA_VERSION
 
@@ -106,6 +107,9 @@ def make(apps, sortedids, apks, repodir, archive):
     if mirrors:
         repodict['mirrors'] = mirrors
 
+    if packageindex is None:
+        packageindex = common.PackageIndex(apks)
+    descriptioncache = metadata.get_description_cache()
     appsWithPackages = collections.OrderedDict()
     for packageName in sortedids:
         app = apps[packageName]
@@ -113,13 +117,12 @@ def make(apps, sortedids, apks, repodir, archive):
             continue
 
         # only include apps with packages
-        for apk in apks:
-            if apk['packageName'] == packageName:
-                newapp = copy.copy(app)  # update wiki needs unmodified description
-                newapp['Description'] = metadata.description_html(app['Description'],
-                                                                  _resolve_description_link)
-                appsWithPackages[packageName] = newapp
-                break
+        if packageName in packageindex:
+            newapp = copy.copy(app)  # update wiki needs unmodified description
+            newapp['Description'] = descriptioncache.get_html(app['Description'],
+                                                              _resolve_description_link)
+            appsWithPackages[packageName] = newapp
+    descriptioncache.save()
 
     requestsdict = collections.OrderedDict()
     for command in ('install', 'uninstall'):
@@ -137,12 +140,13 @@ def make(apps, sortedids, apks, repodir, archive):
     fdroid_signing_key_fingerprints = load_stats_fdroid_signing_key_fingerprints()
 
     make_v0(appsWithPackages, apks, repodir, repodict, requestsdict,
-            fdroid_signing_key_fingerprints)
+            fdroid_signing_key_fingerprints, packageindex)
     make_v1(appsWithPackages, apks, repodir, repodict, requestsdict,
-            fdroid_signing_key_fingerprints)
+            fdroid_signing_key_fingerprints, common.get_developer_signatures())
 
 
-def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints):
+def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints,
+            developersignatures=None):
 
     def _index_encoder_default(obj):
         if isinstance(obj, set):
@@ -158,56 +162,10 @@ def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_
             return d
         raise TypeError(repr(obj) + " is not JSON serializable")
 
-    output = collections.OrderedDict()
-    output['repo'] = repodict
-    output['requests'] = requestsdict
-
     # establish sort order of the index
-    v1_sort_packages(packages, fdroid_signing_key_fingerprints)
-
-    appslist = []
-    output['apps'] = appslist
-    for packageName, appdict in apps.items():
-        d = collections.OrderedDict()
-        appslist.append(d)
-        for k, v in sorted(appdict.items()):
-            if not v:
-                continue
-            if k in ('builds', 'comments', 'metadatapath',
-                     'ArchivePolicy', 'AutoUpdateMode', 'MaintainerNotes',
-                     'Provides', 'Repo', 'RepoType', 'RequiresRoot',
-                     'UpdateCheckData', 'UpdateCheckIgnore', 'UpdateCheckMode',
-                     'UpdateCheckName', 'NoSourceSince', 'VercodeOperation'):
-                continue
-
-            # name things after the App class fields in fdroidclient
-            if k == 'id':
-                k = 'packageName'
-            elif k == 'CurrentVersionCode':  # TODO make SuggestedVersionCode the canonical name
-                k = 'suggestedVersionCode'
-            elif k == 'CurrentVersion':  # TODO make SuggestedVersionName the canonical name
-                k = 'suggestedVersionName'
-            elif k == 'AutoName':
-                if 'Name' not in apps[packageName]:
-                    d['name'] = v
-                continue
-            else:
-                k = k[:1].lower() + k[1:]
-            d[k] = v
+    v1_sort_packages(packages, fdroid_signing_key_fingerprints, developersignatures)
 
-    # establish sort order in localized dicts
-    for app in output['apps']:
-        localized = app.get('localized')
-        if localized:
-            lordered = collections.OrderedDict()
-            for lkey, lvalue in sorted(localized.items()):
-                lordered[lkey] = collections.OrderedDict()
-                for ikey, iname in sorted(lvalue.items()):
-                    lordered[lkey][ikey] = iname
-            app['localized'] = lordered
-
-    output_packages = collections.OrderedDict()
-    output['packages'] = output_packages
+    packagelists = collections.OrderedDict()
     for package in packages:
         packageName = package['packageName']
         if packageName not in apps:
@@ -223,27 +181,33 @@ def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_
                                  .format(apkfilename=package['apkName'], version=versionName))
                     package['versionName'] = versionName
                     break
-        if packageName in output_packages:
-            packagelist = output_packages[packageName]
+        if packageName in packagelists:
+            packagelists[packageName].append(package)
         else:
-            packagelist = []
-            output_packages[packageName] = packagelist
-        d = collections.OrderedDict()
-        packagelist.append(d)
-        for k, v in sorted(package.items()):
-            if not v:
-                continue
-            if k in ('icon', 'icons', 'icons_src', 'name', ):
-                continue
-            d[k] = v
+            packagelists[packageName] = [package]
 
+    # the entries are converted and written one at a time, so the
+    # whole index never has to be in memory as one big dict
     json_name = 'index-v1.json'
     index_file = os.path.join(repodir, json_name)
     with open(index_file, 'w') as fp:
-        if common.options.pretty:
-            json.dump(output, fp, default=_index_encoder_default, indent=2)
-        else:
-            json.dump(output, fp, default=_index_encoder_default)
+        writer = JSONStreamWriter(fp, indent=2 if common.options.pretty else None,
+                                  default=_index_encoder_default)
+        writer.begin_object()
+        writer.write(repodict, 'repo')
+        writer.write(requestsdict, 'requests')
+        writer.begin_array('apps')
+        for appdict in apps.values():
+            writer.write(_v1_app_entry(appdict))
+        writer.end()
+        writer.begin_object('packages')
+        for packageName, packagelist in packagelists.items():
+            writer.begin_array(packageName)
+            for package in packagelist:
+                writer.write(_v1_package_entry(package))
+            writer.end()
+        writer.end()
+        writer.end()
 
     if common.options.nosign:
         logging.debug(_('index-v1 must have a signature, use `fdroid signindex` to create it!'))
@@ -252,15 +216,132 @@ def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_
         signindex.sign_index_v1(repodir, json_name)
 
 
-def v1_sort_packages(packages, fdroid_signing_key_fingerprints):
+def _v1_app_entry(appdict):
+    """Convert the metadata of an app to its entry in index-v1"""
+    d = collections.OrderedDict()
+    for k, v in sorted(appdict.items()):
+        if not v:
+            continue
+        if k in ('builds', 'comments', 'metadatapath',
+                 'ArchivePolicy', 'AutoUpdateMode', 'MaintainerNotes',
+                 'Provides', 'Repo', 'RepoType', 'RequiresRoot',
+                 'UpdateCheckData', 'UpdateCheckIgnore', 'UpdateCheckMode',
+                 'UpdateCheckName', 'NoSourceSince', 'VercodeOperation'):
+            continue
+
+        # name things after the App class fields in fdroidclient
+        if k == 'id':
+            k = 'packageName'
+        elif k == 'CurrentVersionCode':  # TODO make SuggestedVersionCode the canonical name
+            k = 'suggestedVersionCode'
+        elif k == 'CurrentVersion':  # TODO make SuggestedVersionName the canonical name
+            k = 'suggestedVersionName'
+        elif k == 'AutoName':
+            if 'Name' not in appdict:
+                d['name'] = v
+            continue
+        else:
+            k = k[:1].lower() + k[1:]
+        d[k] = v
+
+    # establish sort order in localized dicts
+    localized = d.get('localized')
+    if localized:
+        lordered = collections.OrderedDict()
+        for lkey, lvalue in sorted(localized.items()):
+            lordered[lkey] = collections.OrderedDict()
+            for ikey, iname in sorted(lvalue.items()):
+                lordered[lkey][ikey] = iname
+        d['localized'] = lordered
+    return d
+
+
+def _v1_package_entry(package):
+    """Convert the dict of an APK or other file to its entry in index-v1"""
+    d = collections.OrderedDict()
+    for k, v in sorted(package.items()):
+        if not v:
+            continue
+        if k in ('icon', 'icons', 'icons_src', 'name', ):
+            continue
+        d[k] = v
+    return d
+
+
+class JSONStreamWriter:
+    """Write a JSON document piece by piece
+
+    The output is exactly what json.dump() would write if the whole
+    document were given to it at once, with the same indent and
+    default, but only one value has to be in memory at a time.
+    Objects and arrays are opened with begin_object() and
+    begin_array(), filled with write(), and closed with end().  The
+    key argument is required for everything that goes into an object.
+    """
+
+    def __init__(self, fp, indent=None, default=None):
+        self.fp = fp
+        self.indent = indent
+        self.encoder = json.JSONEncoder(indent=indent, default=default)
+        self._closers = []
+        self._empty = []
+
+    def _newline(self, level):
+        if self.indent is not None:
+            self.fp.write('\n' + ' ' * (self.indent * level))
+
+    def _start_value(self, key):
+        if not self._closers:
+            return
+        if self._empty[-1]:
+            self._empty[-1] = False
+        else:
+            self.fp.write(',' if self.indent is not None else ', ')
+        self._newline(len(self._closers))
+        if key is not None:
+            self.fp.write(self.encoder.encode(str(key)) + ': ')
+
+    def _begin(self, opener, closer, key):
+        self._start_value(key)
+        self.fp.write(opener)
+        self._closers.append(closer)
+        self._empty.append(True)
+
+    def begin_object(self, key=None):
+        self._begin('{', '}', key)
+
+    def begin_array(self, key=None):
+        self._begin('[', ']', key)
+
+    def write(self, value, key=None):
+        self._start_value(key)
+        s = self.encoder.encode(value)
+        if self.indent is not None and self._closers:
+            # JSON strings never contain a raw newline, they are escaped
+            s = s.replace('\n', '\n' + ' ' * (self.indent * len(self._closers)))
+        self.fp.write(s)
+
+    def end(self):
+        closer = self._closers.pop()
+        if not self._empty.pop():
+            self._newline(len(self._closers))
+        self.fp.write(closer)
+
+
+def v1_sort_packages(packages, fdroid_signing_key_fingerprints, developersignatures=None):
     """Sorts the supplied list to ensure a deterministic sort order for
     package entries in the index file. This sort-order also expresses
     installation preference to the clients.
     (First in this list = first to install)
 
     :param packages: list of packages which need to be sorted before but into index file.
+    :param developersignatures: a common.DeveloperSignatures, the shared
+        one from common.get_developer_signatures() when not given
     """
 
+    if developersignatures is None:
+        developersignatures = common.get_developer_signatures()
+
     GROUP_DEV_SIGNED = 1
     GROUP_FDROID_SIGNED = 2
     GROUP_OTHER_SIGNED = 3
@@ -270,7 +351,7 @@ def v1_sort_packages(packages, fdroid_signing_key_fingerprints):
 
         sig = package.get('signer', None)
 
-        dev_sig = common.metadata_find_developer_signature(packageName)
+        dev_sig = developersignatures.get_fingerprint(packageName)
         group = GROUP_OTHER_SIGNED
         if dev_sig and dev_sig == sig:
             group = GROUP_DEV_SIGNED
@@ -288,35 +369,106 @@ def v1_sort_packages(packages, fdroid_signing_key_fingerprints):
     packages.sort(key=v1_sort_keys)
 
 
-def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints):
+def _get_minidom_escapes():
+    """Return str.translate() tables for text and attribute values
+
+    These are read from what xml.dom.minidom of this Python writes,
+    since that has changed between versions.
     """
-    aka index.jar aka index.xml
+    doc = Document()
+    text = dict()
+    attr = dict()
+    for c in '&<>"\'\r\n\t':
+        el = doc.createElement('e')
+        el.setAttribute('a', c)
+        el.appendChild(doc.createTextNode(c))
+        m = re.fullmatch(r'<e a="(.*)">(.*)</e>', el.toxml(), re.DOTALL)
+        if m.group(1) != c:
+            attr[ord(c)] = m.group(1)
+        if m.group(2) != c:
+            text[ord(c)] = m.group(2)
+    return text, attr
+
+
+class XMLStreamWriter:
+    """Write XML exactly like xml.dom.minidom does, without building a DOM
+
+    The output is the same as from Document.toxml(encoding='utf-8'),
+    or toprettyxml(encoding='utf-8') if pretty is True, of the same
+    tree.  Elements with child elements are opened with start() and
+    closed with end(), elements with only text or nothing in them are
+    written with element().  Attributes are written in the order
+    given, so pass an OrderedDict if there is more than one.  fp
+    should be opened with errors='xmlcharrefreplace' and newline='\\n'
+    like minidom does.
     """
 
-    doc = Document()
+    _escapes = None
+
+    def __init__(self, fp, pretty=False):
+        if XMLStreamWriter._escapes is None:
+            XMLStreamWriter._escapes = _get_minidom_escapes()
+        self.text_escapes, self.attr_escapes = XMLStreamWriter._escapes
+        self.fp = fp
+        self.addindent = '\t' if pretty else ''
+        self.newl = '\n' if pretty else ''
+        self._stack = []
+        self._open = False  # the last start tag still needs its '>'
+        fp.write('<?xml version="1.0" encoding="utf-8"?>' + self.newl)
+
+    def _start_tag(self, name, attrs):
+        if self._open:
+            self.fp.write('>' + self.newl)
+            self._open = False
+        self.fp.write(self.addindent * len(self._stack) + '<' + name)
+        if attrs:
+            for k, v in attrs.items():
+                self.fp.write(' %s="%s"' % (k, v.translate(self.attr_escapes)))
+
+    def start(self, name, attrs=None):
+        self._start_tag(name, attrs)
+        self._stack.append(name)
+        self._open = True
+
+    def element(self, name, text=None, attrs=None):
+        self._start_tag(name, attrs)
+        if text is None:
+            self.fp.write('/>' + self.newl)
+        else:
+            self.fp.write('>%s</%s>%s' % (str(text).translate(self.text_escapes), name, self.newl))
+
+    def end(self):
+        name = self._stack.pop()
+        if self._open:
+            self.fp.write('/>' + self.newl)
+            self._open = False
+        else:
+            self.fp.write('%s</%s>%s' % (self.addindent * len(self._stack), name, self.newl))
+
+
+def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints,
+            packageindex=None):
+    """
+    aka index.jar aka index.xml
+
+    :param packageindex: common.PackageIndex of apks, made if None
+    """
 
-    def addElement(name, value, doc, parent):
-        el = doc.createElement(name)
-        el.appendChild(doc.createTextNode(value))
-        parent.appendChild(el)
+    def addElement(name, value, writer):
+        writer.element(name, value)
 
-    def addElementNonEmpty(name, value, doc, parent):
+    def addElementNonEmpty(name, value, writer):
         if not value:
             return
-        addElement(name, value, doc, parent)
+        addElement(name, value, writer)
 
-    def addElementIfInApk(name, apk, key, doc, parent):
+    def addElementIfInApk(name, apk, key, writer):
         if key not in apk:
             return
         value = str(apk[key])
-        addElement(name, value, doc, parent)
+        addElement(name, value, writer)
 
-    def addElementCDATA(name, value, doc, parent):
-        el = doc.createElement(name)
-        el.appendChild(doc.createCDATASection(value))
-        parent.appendChild(el)
-
-    def addElementCheckLocalized(name, app, key, doc, parent, default=''):
+    def addElementCheckLocalized(name, app, key, writer, default=''):
         """Fill in field from metadata or localized block
 
         For name/summary/description, they can come only from the app source,
@@ -329,7 +481,6 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
 
         """
 
-        el = doc.createElement(name)
         value = app.get(key)
         lkey = key[:1].lower() + key[1:]
         localized = app.get('localized')
@@ -346,245 +497,251 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
             value = localized[lang].get(lkey)
         if not value:
             value = default
-        el.appendChild(doc.createTextNode(value))
-        parent.appendChild(el)
-
-    root = doc.createElement("fdroid")
-    doc.appendChild(root)
-
-    repoel = doc.createElement("repo")
-    repoel.setAttribute("icon", os.path.basename(repodict['icon']))
-    if 'maxage' in repodict:
-        repoel.setAttribute("maxage", str(repodict['maxage']))
-    repoel.setAttribute("name", repodict['name'])
-    pubkey, repo_pubkey_fingerprint = extract_pubkey()
-    repoel.setAttribute("pubkey", pubkey.decode('utf-8'))
-    repoel.setAttribute("timestamp", '%d' % repodict['timestamp'].timestamp())
-    repoel.setAttribute("url", repodict['address'])
-    repoel.setAttribute("version", str(repodict['version']))
-
-    addElement('description', repodict['description'], doc, repoel)
-    for mirror in repodict.get('mirrors', []):
-        addElement('mirror', mirror, doc, repoel)
-
-    root.appendChild(repoel)
-
-    for command in ('install', 'uninstall'):
-        for packageName in requestsdict[command]:
-            element = doc.createElement(command)
-            root.appendChild(element)
-            element.setAttribute('packageName', packageName)
-
-    for appid, appdict in apps.items():
-        app = metadata.App(appdict)
-
-        if app.Disabled is not None:
-            continue
-
-        # Get a list of the apks for this app...
-        apklist = []
-        apksbyversion = collections.defaultdict(lambda: [])
-        for apk in apks:
-            if apk.get('versionCode') and apk.get('packageName') == appid:
-                apksbyversion[apk['versionCode']].append(apk)
-        for versionCode, apksforver in apksbyversion.items():
-            fdroidsig = fdroid_signing_key_fingerprints.get(appid, {}).get('signer')
-            fdroid_signed_apk = None
-            name_match_apk = None
-            for x in apksforver:
-                if fdroidsig and x.get('signer', None) == fdroidsig:
-                    fdroid_signed_apk = x
-                if common.apk_release_filename.match(x.get('apkName', '')):
-                    name_match_apk = x
-            # choose which of the available versions is most
-            # suiteable for index v0
-            if fdroid_signed_apk:
-                apklist.append(fdroid_signed_apk)
-            elif name_match_apk:
-                apklist.append(name_match_apk)
-            else:
-                apklist.append(apksforver[0])
-
-        if len(apklist) == 0:
-            continue
+        writer.element(name, value)
+
+    if packageindex is None:
+        packageindex = common.PackageIndex(apks)
+
+    # the index is written while it is generated, so write it to a
+    # temporary file to keep the old index.xml if something goes wrong
+    index_file = os.path.join(repodir, 'index.xml')
+    tmp_index_file = index_file + '.tmp'
+    f = open(tmp_index_file, 'w', encoding='utf-8', errors='xmlcharrefreplace', newline='\n')
+    try:
+        writer = XMLStreamWriter(f, pretty=common.options.pretty)
+        writer.start('fdroid')
+
+        repoattrs = collections.OrderedDict()
+        repoattrs["icon"] = os.path.basename(repodict['icon'])
+        if 'maxage' in repodict:
+            repoattrs["maxage"] = str(repodict['maxage'])
+        repoattrs["name"] = repodict['name']
+        pubkey, repo_pubkey_fingerprint = extract_pubkey()
+        repoattrs["pubkey"] = pubkey.decode('utf-8')
+        repoattrs["timestamp"] = '%d' % repodict['timestamp'].timestamp()
+        repoattrs["url"] = repodict['address']
+        repoattrs["version"] = str(repodict['version'])
+        writer.start('repo', repoattrs)
+
+        addElement('description', repodict['description'], writer)
+        for mirror in repodict.get('mirrors', []):
+            addElement('mirror', mirror, writer)
+
+        writer.end()
+
+        for command in ('install', 'uninstall'):
+            for packageName in requestsdict[command]:
+                writer.element(command, attrs={'packageName': packageName})
+
+        for appid, appdict in apps.items():
+            app = metadata.App(appdict)
+
+            if app.Disabled is not None:
+                continue
 
-        apel = doc.createElement("application")
-        apel.setAttribute("id", app.id)
-        root.appendChild(apel)
-
-        addElement('id', app.id, doc, apel)
-        if app.added:
-            addElement('added', app.added.strftime('%Y-%m-%d'), doc, apel)
-        if app.lastUpdated:
-            addElement('lastupdated', app.lastUpdated.strftime('%Y-%m-%d'), doc, apel)
-
-        addElementCheckLocalized('name', app, 'Name', doc, apel)
-        addElementCheckLocalized('summary', app, 'Summary', doc, apel)
-
-        if app.icon:
-            addElement('icon', app.icon, doc, apel)
-
-        addElementCheckLocalized('desc', app, 'Description', doc, apel,
-                                 '<p>No description available</p>')
-
-        addElement('license', app.License, doc, apel)
-        if app.Categories:
-            addElement('categories', ','.join(app.Categories), doc, apel)
-            # We put the first (primary) category in LAST, which will have
-            # the desired effect of making clients that only understand one
-            # category see that one.
-            addElement('category', app.Categories[0], doc, apel)
-        addElement('web', app.WebSite, doc, apel)
-        addElement('source', app.SourceCode, doc, apel)
-        addElement('tracker', app.IssueTracker, doc, apel)
-        addElementNonEmpty('changelog', app.Changelog, doc, apel)
-        addElementNonEmpty('author', app.AuthorName, doc, apel)
-        addElementNonEmpty('email', app.AuthorEmail, doc, apel)
-        addElementNonEmpty('donate', app.Donate, doc, apel)
-        addElementNonEmpty('bitcoin', app.Bitcoin, doc, apel)
-        addElementNonEmpty('litecoin', app.Litecoin, doc, apel)
-        addElementNonEmpty('flattr', app.FlattrID, doc, apel)
-        addElementNonEmpty('liberapay', app.LiberapayID, doc, apel)
-        addElementNonEmpty('openCollective', app.OpenCollective, doc, apel)
-
-        # These elements actually refer to the current version (i.e. which
-        # one is recommended. They are historically mis-named, and need
-        # changing, but stay like this for now to support existing clients.
-        addElement('marketversion', app.CurrentVersion, doc, apel)
-        addElement('marketvercode', app.CurrentVersionCode, doc, apel)
-
-        if app.Provides:
-            pv = app.Provides.split(',')
-            addElementNonEmpty('provides', ','.join(pv), doc, apel)
-        if app.RequiresRoot:
-            addElement('requirements', 'root', doc, apel)
-
-        # Sort the apk list into version order, just so the web site
-        # doesn't have to do any work by default...
-        apklist = sorted(apklist, key=lambda apk: apk['versionCode'], reverse=True)
-
-        if 'antiFeatures' in apklist[0]:
-            app.AntiFeatures.extend(apklist[0]['antiFeatures'])
-        if app.AntiFeatures:
-            addElementNonEmpty('antifeatures', ','.join(app.AntiFeatures), doc, apel)
-
-        # Check for duplicates - they will make the client unhappy...
-        for i in range(len(apklist) - 1):
-            first = apklist[i]
-            second = apklist[i + 1]
-            if first['versionCode'] == second['versionCode'] \
-               and first['sig'] == second['sig']:
-                if first['hash'] == second['hash']:
-                    raise FDroidException('"{0}/{1}" and "{0}/{2}" are exact duplicates!'.format(
-                        repodir, first['apkName'], second['apkName']))
+            # Get a list of the apks for this app...
+            apklist = []
+            apksbyversion = collections.defaultdict(lambda: [])
+            for apk in packageindex.get(appid):
+                if apk.get('versionCode'):
+                    apksbyversion[apk['versionCode']].append(apk)
+            for versionCode, apksforver in apksbyversion.items():
+                fdroidsig = fdroid_signing_key_fingerprints.get(appid, {}).get('signer')
+                fdroid_signed_apk = None
+                name_match_apk = None
+                for x in apksforver:
+                    if fdroidsig and x.get('signer', None) == fdroidsig:
+                        fdroid_signed_apk = x
+                    if common.apk_release_filename.match(x.get('apkName', '')):
+                        name_match_apk = x
+                # choose which of the available versions is most
+                # suiteable for index v0
+                if fdroid_signed_apk:
+                    apklist.append(fdroid_signed_apk)
+                elif name_match_apk:
+                    apklist.append(name_match_apk)
                 else:
-                    raise FDroidException('duplicates: "{0}/{1}" - "{0}/{2}"'.format(
-                        repodir, first['apkName'], second['apkName']))
-
-        current_version_code = 0
-        current_version_file = None
-        for apk in apklist:
-            file_extension = common.get_file_extension(apk['apkName'])
-            # find the APK for the "Current Version"
-            if current_version_code < apk['versionCode']:
-                current_version_code = apk['versionCode']
-            if current_version_code < int(app.CurrentVersionCode):
-                current_version_file = apk['apkName']
-
-            apkel = doc.createElement("package")
-            apel.appendChild(apkel)
-
-            versionName = apk.get('versionName')
-            if not versionName:
-                versionCodeStr = str(apk['versionCode'])  # TODO build.versionCode should be int!
-                for build in app.builds:
-                    if build['versionCode'] == versionCodeStr and 'versionName' in build:
-                        versionName = build['versionName']
-                        break
-            if versionName:
-                addElement('version', versionName, doc, apkel)
-
-            addElement('versioncode', str(apk['versionCode']), doc, apkel)
-            addElement('apkname', apk['apkName'], doc, apkel)
-            addElementIfInApk('srcname', apk, 'srcname', doc, apkel)
-
-            hashel = doc.createElement("hash")
-            hashel.setAttribute('type', 'sha256')
-            hashel.appendChild(doc.createTextNode(apk['hash']))
-            apkel.appendChild(hashel)
-
-            addElement('size', str(apk['size']), doc, apkel)
-            addElementIfInApk('sdkver', apk,
-                              'minSdkVersion', doc, apkel)
-            addElementIfInApk('targetSdkVersion', apk,
-                              'targetSdkVersion', doc, apkel)
-            addElementIfInApk('maxsdkver', apk,
-                              'maxSdkVersion', doc, apkel)
-            addElementIfInApk('obbMainFile', apk,
-                              'obbMainFile', doc, apkel)
-            addElementIfInApk('obbMainFileSha256', apk,
-                              'obbMainFileSha256', doc, apkel)
-            addElementIfInApk('obbPatchFile', apk,
-                              'obbPatchFile', doc, apkel)
-            addElementIfInApk('obbPatchFileSha256', apk,
-                              'obbPatchFileSha256', doc, apkel)
-            if 'added' in apk:
-                addElement('added', apk['added'].strftime('%Y-%m-%d'), doc, apkel)
-
-            if file_extension == 'apk':  # sig is required for APKs, but only APKs
-                addElement('sig', apk['sig'], doc, apkel)
-
-                old_permissions = set()
-                sorted_permissions = sorted(apk['uses-permission'])
-                for perm in sorted_permissions:
-                    perm_name = perm[0]
-                    if perm_name.startswith("android.permission."):
-                        perm_name = perm_name[19:]
-                    old_permissions.add(perm_name)
-                addElementNonEmpty('permissions', ','.join(sorted(old_permissions)), doc, apkel)
-
-                for permission in sorted_permissions:
-                    permel = doc.createElement('uses-permission')
-                    if permission[1] is not None:
-                        permel.setAttribute('maxSdkVersion', '%d' % permission[1])
-                        apkel.appendChild(permel)
-                    permel.setAttribute('name', permission[0])
-                for permission_sdk_23 in sorted(apk['uses-permission-sdk-23']):
-                    permel = doc.createElement('uses-permission-sdk-23')
-                    if permission_sdk_23[1] is not None:
-                        permel.setAttribute('maxSdkVersion', '%d' % permission_sdk_23[1])
-                        apkel.appendChild(permel)
-                    permel.setAttribute('name', permission_sdk_23[0])
-                if 'nativecode' in apk:
-                    addElement('nativecode', ','.join(sorted(apk['nativecode'])), doc, apkel)
-                addElementNonEmpty('features', ','.join(sorted(apk['features'])), doc, apkel)
-
-        if current_version_file is not None \
-                and common.config['make_current_version_link'] \
-                and repodir == 'repo':  # only create these
-            namefield = common.config['current_version_name_source']
-            sanitized_name = re.sub(b'''[ '"&%?+=/]''', b'', app.get(namefield).encode('utf-8'))
-            apklinkname = sanitized_name + os.path.splitext(current_version_file)[1].encode('utf-8')
-            current_version_path = os.path.join(repodir, current_version_file).encode('utf-8', 'surrogateescape')
-            if os.path.islink(apklinkname):
-                os.remove(apklinkname)
-            os.symlink(current_version_path, apklinkname)
-            # also symlink gpg signature, if it exists
-            for extension in (b'.asc', b'.sig'):
-                sigfile_path = current_version_path + extension
-                if os.path.exists(sigfile_path):
-                    siglinkname = apklinkname + extension
-                    if os.path.islink(siglinkname):
-                        os.remove(siglinkname)
-                    os.symlink(sigfile_path, siglinkname)
-
-    if common.options.pretty:
-        output = doc.toprettyxml(encoding='utf-8')
-    else:
-        output = doc.toxml(encoding='utf-8')
+                    apklist.append(apksforver[0])
+
+            if len(apklist) == 0:
+                continue
 
-    with open(os.path.join(repodir, 'index.xml'), 'wb') as f:
-        f.write(output)
+            writer.start("application", {"id": app.id})
+
+            addElement('id', app.id, writer)
+            if app.added:
+                addElement('added', app.added.strftime('%Y-%m-%d'), writer)
+            if app.lastUpdated:
+                addElement('lastupdated', app.lastUpdated.strftime('%Y-%m-%d'), writer)
+
+            addElementCheckLocalized('name', app, 'Name', writer)
+            addElementCheckLocalized('summary', app, 'Summary', writer)
+
+            if app.icon:
+                addElement('icon', app.icon, writer)
+
+            addElementCheckLocalized('desc', app, 'Description', writer,
+                                     '<p>No description available</p>')
+
+            addElement('license', app.License, writer)
+            if app.Categories:
+                addElement('categories', ','.join(app.Categories), writer)
+                # We put the first (primary) category in LAST, which will have
+                # the desired effect of making clients that only understand one
+                # category see that one.
+                addElement('category', app.Categories[0], writer)
+            addElement('web', app.WebSite, writer)
+            addElement('source', app.SourceCode, writer)
+            addElement('tracker', app.IssueTracker, writer)
+            addElementNonEmpty('changelog', app.Changelog, writer)
+            addElementNonEmpty('author', app.AuthorName, writer)
+            addElementNonEmpty('email', app.AuthorEmail, writer)
+            addElementNonEmpty('donate', app.Donate, writer)
+            addElementNonEmpty('bitcoin', app.Bitcoin, writer)
+            addElementNonEmpty('litecoin', app.Litecoin, writer)
+            addElementNonEmpty('flattr', app.FlattrID, writer)
+            addElementNonEmpty('liberapay', app.LiberapayID, writer)
+            addElementNonEmpty('openCollective', app.OpenCollective, writer)
+
+            # These elements actually refer to the current version (i.e. which
+            # one is recommended. They are historically mis-named, and need
+            # changing, but stay like this for now to support existing clients.
+            addElement('marketversion', app.CurrentVersion, writer)
+            addElement('marketvercode', app.CurrentVersionCode, writer)
+
+            if app.Provides:
+                pv = app.Provides.split(',')
+                addElementNonEmpty('provides', ','.join(pv), writer)
+            if app.RequiresRoot:
+                addElement('requirements', 'root', writer)
+
+            # Sort the apk list into version order, just so the web site
+            # doesn't have to do any work by default...
+            apklist = sorted(apklist, key=lambda apk: apk['versionCode'], reverse=True)
+
+            if 'antiFeatures' in apklist[0]:
+                app.AntiFeatures.extend(apklist[0]['antiFeatures'])
+            if app.AntiFeatures:
+                addElementNonEmpty('antifeatures', ','.join(app.AntiFeatures), writer)
+
+            # Check for duplicates - they will make the client unhappy...
+            for i in range(len(apklist) - 1):
+                first = apklist[i]
+                second = apklist[i + 1]
+                if first['versionCode'] == second['versionCode'] \
+                   and first['sig'] == second['sig']:
+                    if first['hash'] == second['hash']:
+                        raise FDroidException('"{0}/{1}" and "{0}/{2}" are exact duplicates!'.format(
+                            repodir, first['apkName'], second['apkName']))
+                    else:
+                        raise FDroidException('duplicates: "{0}/{1}" - "{0}/{2}"'.format(
+                            repodir, first['apkName'], second['apkName']))
+
+            current_version_code = 0
+            current_version_file = None
+            for apk in apklist:
+                file_extension = common.get_file_extension(apk['apkName'])
+                # find the APK for the "Current Version"
+                if current_version_code < apk['versionCode']:
+                    current_version_code = apk['versionCode']
+                if current_version_code < int(app.CurrentVersionCode):
+                    current_version_file = apk['apkName']
+
+                writer.start("package")
+
+                versionName = apk.get('versionName')
+                if not versionName:
+                    versionCodeStr = str(apk['versionCode'])  # TODO build.versionCode should be int!
+                    for build in app.builds:
+                        if build['versionCode'] == versionCodeStr and 'versionName' in build:
+                            versionName = build['versionName']
+                            break
+                if versionName:
+                    addElement('version', versionName, writer)
+
+                addElement('versioncode', str(apk['versionCode']), writer)
+                addElement('apkname', apk['apkName'], writer)
+                addElementIfInApk('srcname', apk, 'srcname', writer)
+
+                writer.element("hash", apk['hash'], {'type': 'sha256'})
+
+                addElement('size', str(apk['size']), writer)
+                addElementIfInApk('sdkver', apk,
+                                  'minSdkVersion', writer)
+                addElementIfInApk('targetSdkVersion', apk,
+                                  'targetSdkVersion', writer)
+                addElementIfInApk('maxsdkver', apk,
+                                  'maxSdkVersion', writer)
+                addElementIfInApk('obbMainFile', apk,
+                                  'obbMainFile', writer)
+                addElementIfInApk('obbMainFileSha256', apk,
+                                  'obbMainFileSha256', writer)
+                addElementIfInApk('obbPatchFile', apk,
+                                  'obbPatchFile', writer)
+                addElementIfInApk('obbPatchFileSha256', apk,
+                                  'obbPatchFileSha256', writer)
+                if 'added' in apk:
+                    addElement('added', apk['added'].strftime('%Y-%m-%d'), writer)
+
+                if file_extension == 'apk':  # sig is required for APKs, but only APKs
+                    addElement('sig', apk['sig'], writer)
+
+                    old_permissions = set()
+                    sorted_permissions = sorted(apk['uses-permission'])
+                    for perm in sorted_permissions:
+                        perm_name = perm[0]
+                        if perm_name.startswith("android.permission."):
+                            perm_name = perm_name[19:]
+                        old_permissions.add(perm_name)
+                    addElementNonEmpty('permissions', ','.join(sorted(old_permissions)), writer)
+
+                    # only the permissions with a maxSdkVersion ever got an element
+                    for permission in sorted_permissions:
+                        if permission[1] is not None:
+                            writer.element('uses-permission',
+                                           attrs=collections.OrderedDict([
+                                               ('maxSdkVersion', '%d' % permission[1]),
+                                               ('name', permission[0])]))
+                    for permission_sdk_23 in sorted(apk['uses-permission-sdk-23']):
+                        if permission_sdk_23[1] is not None:
+                            writer.element('uses-permission-sdk-23',
+                                           attrs=collections.OrderedDict([
+                                               ('maxSdkVersion', '%d' % permission_sdk_23[1]),
+                                               ('name', permission_sdk_23[0])]))
+                    if 'nativecode' in apk:
+                        addElement('nativecode', ','.join(sorted(apk['nativecode'])), writer)
+                    addElementNonEmpty('features', ','.join(sorted(apk['features'])), writer)
+
+                writer.end()
+
+            writer.end()
+
+            if current_version_file is not None \
+                    and common.config['make_current_version_link'] \
+                    and repodir == 'repo':  # only create these
+                namefield = common.config['current_version_name_source']
+                sanitized_name = re.sub(b'''[ '"&%?+=/]''', b'', app.get(namefield).encode('utf-8'))
+                apklinkname = sanitized_name + os.path.splitext(current_version_file)[1].encode('utf-8')
+                current_version_path = os.path.join(repodir, current_version_file).encode('utf-8', 'surrogateescape')
+                if os.path.islink(apklinkname):
+                    os.remove(apklinkname)
+                os.symlink(current_version_path, apklinkname)
+                # also symlink gpg signature, if it exists
+                for extension in (b'.asc', b'.sig'):
+                    sigfile_path = current_version_path + extension
+                    if os.path.exists(sigfile_path):
+                        siglinkname = apklinkname + extension
+                        if os.path.islink(siglinkname):
+                            os.remove(siglinkname)
+                        os.symlink(sigfile_path, siglinkname)
+
+        writer.end()
+    except BaseException:
+        f.close()
+        os.remove(tmp_index_file)
+        raise
+    f.close()
+    os.replace(tmp_index_file, index_file)
 
     if 'repo_keyalias' in common.config:
 
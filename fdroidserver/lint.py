@@ -587,7 +587,7 @@ def main():
     config = common.read_config(options)
 
     # Get all apps...
-    allapps = metadata.read_metadata(xref=True)
+    allapps = metadata.read_metadata(xref=True, appids=common.read_pkg_args(options.appid, False))
     apps = common.read_app_args(options.appid, allapps, False)
 
     anywarns = check_for_unsupported_metadata_files()
@@ -18,12 +18,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
 import os
 import re
+import sys
+import time
 import glob
 import html
 import logging
+import multiprocessing
+import pickle
 import textwrap
 import io
 import yaml
@@ -33,6 +38,7 @@ except ImportError:
     from yaml import SafeLoader
 import importlib
 from collections import OrderedDict
+from collections.abc import MutableMapping
 
 import fdroidserver.common
 from fdroidserver import _
@@ -41,6 +47,10 @@ from fdroidserver.exception import MetaDataException, FDroidException
 srclibs = None
 warnings_action = None
 
+# read_metadata() parses the metadata files with a pool of processes
+# when there are at least this many of them
+PARALLEL_THRESHOLD = 200
+
 # validates usernames based on a loose collection of rules from GitHub, GitLab,
 # Liberapay and issuehunt.  This is mostly to block abuse.
 VALID_USERNAME_REGEX = re.compile(r'^[a-z\d](?:[a-z\d/._-]){0,38}$', re.IGNORECASE)
@@ -237,6 +247,65 @@ class App(dict):
             return Build()
 
 
+class AppOverlay(MutableMapping):
+    """A view of an App that stores only the fields that are changed
+
+    Reading a field falls through to the App, while setting or
+    deleting one only changes the overlay, so the App is left alone.
+    This is much cheaper than copy.deepcopy() when a few fields need
+    other values, like for the archive index.  Any lists or dicts from
+    the App that will be changed in place must be replaced with copies
+    in the overlay first.
+    """
+
+    def __init__(self, app, fields=None):
+        object.__setattr__(self, '_app', app)
+        object.__setattr__(self, '_fields', dict(fields) if fields else dict())
+        object.__setattr__(self, '_deleted', set())
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            return self._fields[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        return self._app[key]
+
+    def __setitem__(self, key, value):
+        self._deleted.discard(key)
+        self._fields[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._fields.pop(key, None)
+        if key in self._app:
+            self._deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self._fields or (key in self._app and key not in self._deleted)
+
+    def __iter__(self):
+        for key in self._app:
+            if key not in self._deleted:
+                yield key
+        for key in self._fields:
+            if key not in self._app:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __copy__(self):
+        copy = AppOverlay(self._app, self._fields)
+        copy._deleted.update(self._deleted)
+        return copy
+
+    __getattr__ = App.__getattr__
+    __setattr__ = App.__setattr__
+    __delattr__ = App.__delattr__
+    get_last_build = App.get_last_build
+
+
 TYPE_UNKNOWN = 0
 TYPE_OBSOLETE = 1
 TYPE_STRING = 2
@@ -388,6 +457,180 @@ class Build(dict):
         return paths[version]
 
 
+class _Record(MutableMapping):
+    """The base of AppRecord and BuildRecord
+
+    Each field of the record class it is made for has a slot, so an
+    instance does not need a whole dict, and reading a field as an
+    attribute does not go through Python code.  Any other keys are
+    kept in a dict that is only made when one is set.  A field that
+    is deleted is not in the mapping anymore, like with a dict.
+    """
+
+    __slots__ = ('_extra',)
+    _fields = ()
+    _fieldset = frozenset()
+    _defaults = ()
+
+    def __init__(self, copydict=None):
+        object.__setattr__(self, '_extra', None)
+        if copydict is None:
+            for name, value in self._defaults:
+                if isinstance(value, list):
+                    value = list(value)
+                elif isinstance(value, dict):
+                    value = dict(value)
+                object.__setattr__(self, name, value)
+        else:
+            self.update(copydict)
+
+    @classmethod
+    def _from_items(cls, items):
+        record = cls.__new__(cls)
+        extra = None
+        for key, value in items:
+            if key in cls._fieldset:
+                object.__setattr__(record, key, value)
+            else:
+                if extra is None:
+                    extra = dict()
+                extra[key] = value
+        object.__setattr__(record, '_extra', extra)
+        return record
+
+    def __reduce__(self):
+        return (self._from_items, (list(self.items()),))
+
+    def __copy__(self):
+        return self._from_items(self.items())
+
+    def __getitem__(self, key):
+        if key in self._fieldset:
+            try:
+                return object.__getattribute__(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._fieldset:
+            object.__setattr__(self, key, value)
+        else:
+            if self._extra is None:
+                object.__setattr__(self, '_extra', dict())
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._fieldset:
+            try:
+                object.__delattr__(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self._fieldset:
+            try:
+                object.__getattribute__(self, key)
+            except AttributeError:
+                return False
+            return True
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for name in self._fields:
+            try:
+                object.__getattribute__(self, name)
+            except AttributeError:
+                continue
+            yield name
+        if self._extra is not None:
+            yield from list(self._extra)
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self))
+
+    def __getattr__(self, name):
+        # only called for fields that are not set, and other keys
+        if self._extra is not None and name in self._extra:
+            return self._extra[name]
+        raise AttributeError("No such attribute: " + name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self[name]
+        except KeyError:
+            raise AttributeError("No such attribute: " + name)
+
+
+def _record_class(name, base, dictclass, doc):
+    defaults = tuple(dictclass().items())
+    fields = tuple(field for field, _ignored in defaults)
+    return type(name, (_Record, base), {
+        '__module__': __name__,
+        '__doc__': doc,
+        '__slots__': fields,
+        '_fields': fields,
+        '_fieldset': frozenset(fields),
+        '_defaults': defaults,
+    })
+
+
+class _BuildMethods:
+    __slots__ = ()
+    build_method = Build.build_method
+    output_method = Build.output_method
+    ndk_path = Build.ndk_path
+
+
+BuildRecord = _record_class('BuildRecord', _BuildMethods, Build, """A compact Build
+
+It has the same fields, defaults, attributes and methods as a Build,
+and works like a dict of them, but it is not a dict, see AppRecord.
+""")
+
+
+class _AppMethods:
+    __slots__ = ()
+    get_last_build = App.get_last_build
+
+
+AppRecord = _record_class('AppRecord', _AppMethods, App, """A compact App
+
+It has the same fields, defaults, attributes and methods as an App,
+and works like a dict of them, but it is not a dict, so it is only
+for code that does not need one, like json.dump() does.  Use
+to_record() and to_app() to convert between them, and its builds.
+""")
+
+
+def to_record(app):
+    """Make an AppRecord of an App, with BuildRecords as its builds"""
+    record = AppRecord._from_items(app.items())
+    if 'builds' in app:
+        record.builds = [BuildRecord._from_items(build.items()) for build in app.builds]
+    return record
+
+
+def to_app(record):
+    """Make an App of an AppRecord, with Builds as its builds"""
+    app = App(record)
+    if 'builds' in record:
+        app.builds = [Build(build) for build in record.builds]
+    return app
+
+
 flagtypes = {
     'versionCode': TYPE_INT,
     'extlibs': TYPE_LIST,
@@ -538,9 +781,14 @@ class DescriptionFormatter:
         self.html = io.StringIO()
         self.text = io.StringIO()
         self.para_lines = []
+        self.warned = False
         self.linkResolver = None
         self.linkResolver = linkres
 
+    def warn(self, value):
+        self.warned = True
+        warn_or_exception(value)
+
     def endcur(self, notstates=None):
         if notstates and self.state in notstates:
             return
@@ -613,7 +861,7 @@ class DescriptionFormatter:
             if txt.startswith("[["):
                 index = txt.find("]]")
                 if index == -1:
-                    warn_or_exception(_("Unterminated ]]"))
+                    self.warn(_("Unterminated ]]"))
                 url = txt[2:index]
                 if self.linkResolver:
                     url, urltext = self.linkResolver(url)
@@ -625,7 +873,7 @@ class DescriptionFormatter:
             else:
                 index = txt.find("]")
                 if index == -1:
-                    warn_or_exception(_("Unterminated ]"))
+                    self.warn(_("Unterminated ]"))
                 url = txt[1:index]
                 index2 = url.find(' ')
                 if index2 == -1:
@@ -634,7 +882,7 @@ class DescriptionFormatter:
                     urltxt = url[index2 + 1:]
                     url = url[:index2]
                     if url == urltxt:
-                        warn_or_exception(_("URL title is just the URL, use brackets: [URL]"))
+                        self.warn(_("URL title is just the URL, use brackets: [URL]"))
                 res_html += '<a href="' + url + '">' + html.escape(urltxt, quote=False) + '</a>'
                 res_plain += urltxt
                 if urltxt != url:
@@ -691,14 +939,18 @@ class DescriptionFormatter:
         self.html.close()
 
 
-# Parse multiple lines of description as written in a metadata file, returning
-# a single string in text format and wrapped to 80 columns.
-def description_txt(s):
-    ps = DescriptionFormatter(None)
+def _format_description(s, linkres):
+    ps = DescriptionFormatter(linkres)
     for line in s.splitlines():
         ps.parseline(line)
     ps.end()
-    return ps.text_txt
+    return ps
+
+
+# Parse multiple lines of description as written in a metadata file, returning
+# a single string in text format and wrapped to 80 columns.
+def description_txt(s):
+    return _format_description(s, None).text_txt
 
 
 # Parse multiple lines of description as written in a metadata file, returning
@@ -711,11 +963,117 @@ def description_wiki(s):
 # Parse multiple lines of description as written in a metadata file, returning
 # a single string in HTML format.
 def description_html(s, linkres):
-    ps = DescriptionFormatter(linkres)
-    for line in s.splitlines():
-        ps.parseline(line)
-    ps.end()
-    return ps.text_html
+    return _format_description(s, linkres).text_html
+
+
+class DescriptionCache:
+    """Persistent cache of the output of description_html()
+
+    The HTML of a description only depends on its text and on what
+    the linkres function returns for the [[appid]] links in it.  So
+    for each text, keyed by its hash, this keeps the appids it links
+    to, and the HTML, keyed by a hash of what those links resolved
+    to.  On a lookup, only the links are resolved again instead of
+    the whole description parsed.  Descriptions that made warnings
+    are never stored, so that the warnings are shown every time.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+        if os.path.exists(path):
+            try:
+                with open(path) as fp:
+                    data = json.load(fp)
+                if data.get('version') == self.VERSION:
+                    self.entries = data['entries']
+            except (ValueError, KeyError, AttributeError) as e:
+                logging.debug(_('Ignoring broken {path}: {error}')
+                              .format(path=path, error=str(e)))
+
+    @staticmethod
+    def _hash(value):
+        return hashlib.sha256(json.dumps(value).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _is_target(target):
+        return (isinstance(target, tuple) and len(target) == 2
+                and all(isinstance(v, str) for v in target))
+
+    def get_html(self, s, linkres):
+        """Return description_html(s, linkres), from the cache if it is there"""
+        if linkres is None:
+            def linkres(url):
+                return url, url
+        texthash = self._hash(s)
+        self.seen.add(texthash)
+        entry = self.entries.get(texthash)
+        resolved = dict()
+        if entry is not None:
+            for appid in entry['links']:
+                if appid not in resolved:
+                    resolved[appid] = linkres(appid)
+            targets = [resolved[appid] for appid in entry['links']]
+            if all(self._is_target(t) for t in targets):
+                text_html = entry['html'].get(self._hash(targets))
+                if text_html is not None:
+                    self.hits += 1
+                    return text_html
+
+        self.misses += 1
+        appids = []
+
+        def recording_linkres(appid):
+            if appid not in resolved:
+                resolved[appid] = linkres(appid)
+            appids.append(appid)
+            return resolved[appid]
+
+        ps = _format_description(s, recording_linkres)
+        targets = [resolved[appid] for appid in appids]
+        if not ps.warned and all(self._is_target(t) for t in targets):
+            if entry is None:
+                entry = self.entries[texthash] = {'links': appids, 'html': dict()}
+            entry['html'][self._hash(targets)] = ps.text_html
+            self.changed = True
+        return ps.text_html
+
+    def save(self, prune=False):
+        """Write the cache if it changed, and log the hits and misses
+
+        With prune, the descriptions that were not looked up since the
+        cache was loaded are dropped from it.
+        """
+        logging.debug(_('Description cache: {hits} hits, {misses} misses')
+                      .format(hits=self.hits, misses=self.misses))
+        self.hits = self.misses = 0
+        if prune:
+            for texthash in set(self.entries) - self.seen:
+                del self.entries[texthash]
+                self.changed = True
+        if not self.changed or not os.path.isdir(os.path.dirname(self.path)):
+            return
+        data = json.dumps({'version': self.VERSION, 'entries': self.entries})
+        fdroidserver.common.write_file_atomically(self.path, data.encode('utf-8'))
+        self.changed = False
+
+
+_description_cache = None
+
+
+def get_description_cache():
+    """Get the DescriptionCache of the current directory, see DescriptionCache"""
+    global _description_cache
+    path = os.path.abspath(os.path.join('tmp', 'descriptions.json'))
+    if _description_cache is None or _description_cache.path != path:
+        _description_cache = DescriptionCache(path)
+    return _description_cache
 
 
 def parse_txt_srclib(metadatapath):
@@ -839,7 +1197,167 @@ def read_srclibs():
         srclibs[srclibname] = parse_yaml_srclib(metadatapath)
 
 
-def read_metadata(xref=True, check_vcs=[], refresh=True, sort_by_time=False):
+class _RecordingHandler(logging.Handler):
+    """Keeps the log records made while parsing a metadata file"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+_worker_log = None
+
+
+def _init_parse_metadata_worker():
+    global _worker_log
+    _worker_log = _RecordingHandler()
+    logging.getLogger().handlers = [_worker_log]
+
+
+def _parse_metadata_worker(args):
+    """Parse and check one metadata file in a worker process
+
+    :returns: the App and the log records it made, or None when it
+        failed, so it gets parsed again in the main process to report
+        the error there exactly like it would have been.
+    """
+    metadatapath, refresh = args
+    del _worker_log.records[:]
+    try:
+        app = parse_metadata(metadatapath, False, refresh)
+        check_metadata(app)
+    except Exception:
+        return None
+    for record in _worker_log.records:
+        # so that it can be pickled
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+    return app, _worker_log.records
+
+
+def parse_metadata_files(metadatapaths, refresh=True, jobs=None):
+    """Parse and check metadata files with a pool of jobs processes
+
+    The processes are forked, so they have the same config and
+    warnings_action.  This does not check the source repos for
+    .fdroid.yml, like parse_metadata() does with check_vcs.
+
+    :returns: a dict of the App and the log records of each file that
+        could be parsed and checked, by path.  The records are not
+        logged yet, so that it can be done in the order of the files.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    results = dict()
+    # fork so that the workers inherit config and warnings_action
+    with multiprocessing.get_context('fork').Pool(jobs, _init_parse_metadata_worker) as pool:
+        chunksize = max(1, len(metadatapaths) // (jobs * 8))
+        for metadatapath, result in zip(metadatapaths, pool.imap(
+                _parse_metadata_worker, [(p, refresh) for p in metadatapaths], chunksize)):
+            if result is not None:
+                results[metadatapath] = result
+    return results
+
+
+def get_metadata_cache_file():
+    return os.path.join('tmp', 'metadata.pickle')
+
+
+class MetadataCache:
+    """Persistent cache of the parsed and checked App of each metadata file
+
+    The entries are keyed by the path of the file, and only used while
+    its size and mtime are the same.  The whole cache is dropped when
+    fdroidserver changes, or when the settings that parsing depends on
+    do.  Each App is kept pickled on its own, so that only the ones
+    that are used get unpickled, and each of them is a new copy.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.context = self._get_context()
+        self.entries = dict()
+        self.changed = False
+        self.hits = 0
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as fp:
+                    data = pickle.load(fp)
+                if data['version'] == self.VERSION and data['context'] == self.context:
+                    self.entries = data['entries']
+            except Exception as e:
+                logging.debug(_('Ignoring broken {path}: {error}')
+                              .format(path=path, error=str(e)))
+
+    @classmethod
+    def _get_context(cls):
+        """What the parsed metadata depends on, other than the file itself
+
+        There is no version string in fdroidserver itself when it runs
+        from git, so the source files of the parser stand in for it.
+        """
+        sources = []
+        for module in (sys.modules[__name__], fdroidserver.common):
+            st = os.stat(module.__file__)
+            sources.append((os.path.basename(module.__file__), st.st_size, st.st_mtime_ns))
+        return (sources, sys.version_info[:2], warnings_action,
+                list(fdroidserver.common.config.get('accepted_formats', [])))
+
+    @staticmethod
+    def _get_stat(metadatapath):
+        st = os.stat(metadatapath)
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, metadatapath):
+        """Return a new copy of the cached App of metadatapath, or None"""
+        entry = self.entries.get(metadatapath)
+        if entry is None or entry[0] != self._get_stat(metadatapath):
+            return None
+        self.hits += 1
+        return pickle.loads(entry[1])
+
+    def put(self, metadatapath, app):
+        stat = self._get_stat(metadatapath)
+        # a change in the same clock tick might keep the size and mtime
+        if time.time() - stat[1] / 1e9 < 2:
+            if self.entries.pop(metadatapath, None) is not None:
+                self.changed = True
+            return
+        self.entries[metadatapath] = (stat, pickle.dumps(app, pickle.HIGHEST_PROTOCOL))
+        self.changed = True
+
+    def save(self, metadatapaths=None):
+        """Write the cache if it changed
+
+        :param metadatapaths: when given, the entries of all other files
+            are dropped
+        """
+        logging.debug(_('Metadata cache: {hits} of {count} files unchanged')
+                      .format(hits=self.hits, count=len(metadatapaths or self.entries)))
+        if metadatapaths is not None:
+            for metadatapath in set(self.entries) - set(metadatapaths):
+                del self.entries[metadatapath]
+                self.changed = True
+        if not self.changed:
+            return
+        data = pickle.dumps({'version': self.VERSION, 'context': self.context, 'entries': self.entries},
+                            pickle.HIGHEST_PROTOCOL)
+        fdroidserver.common.write_file_atomically(self.path, data)
+        self.changed = False
+
+
+def _has_warnings(records):
+    return any(record.levelno >= logging.WARNING for record in records)
+
+
+def read_metadata(xref=True, check_vcs=[], refresh=True, sort_by_time=False, appids=None,
+                  compact=False):
     """Return a list of App instances sorted newest first
 
     This reads all of the metadata files in a 'data' repository, then
@@ -854,6 +1372,14 @@ def read_metadata(xref=True, check_vcs=[], refresh=True, sort_by_time=False):
 
     check_vcs is the list of appids to check for .fdroid.yml in source
 
+    appids is the list of appids to read the metadata of, instead of
+    all of them, plus the .fdroid metadata in the current directory.
+    The [[appid]] links in their descriptions are still checked against
+    all the metadata files that there are, without parsing them.
+
+    With compact, the apps are returned as AppRecords instead of Apps,
+    which take much less memory.
+
     """
 
     # Always read the srclibs before the apps, since they can use a srlib as
@@ -873,6 +1399,14 @@ def read_metadata(xref=True, check_vcs=[], refresh=True, sort_by_time=False):
                      + glob.glob('.fdroid.json')
                      + glob.glob('.fdroid.yml'))
 
+    knownappids = set()
+    if appids:
+        knownappids = set(fdroidserver.common.get_extension(os.path.basename(path))[0]
+                          for path in metadatafiles)
+        metadatafiles = [path for path in metadatafiles
+                         if fdroidserver.common.get_extension(os.path.basename(path))[0]
+                         in appids or path.startswith('.fdroid.')]
+
     if sort_by_time:
         entries = ((os.stat(path).st_mtime, path) for path in metadatafiles)
         metadatafiles = []
@@ -882,6 +1416,28 @@ def read_metadata(xref=True, check_vcs=[], refresh=True, sort_by_time=False):
         # most things want the index alpha sorted for stability
         metadatafiles = sorted(metadatafiles)
 
+    # the ones that are checked for .fdroid.yml in their source repo
+    # are always parsed again, one at a time
+    metadatacache = MetadataCache(get_metadata_cache_file())
+    parsed = dict()
+    toparse = []
+    for metadatapath in metadatafiles:
+        if fdroidserver.common.get_extension(os.path.basename(metadatapath))[0] in check_vcs:
+            continue
+        app = metadatacache.get(metadatapath)
+        if app is None:
+            toparse.append(metadatapath)
+        else:
+            parsed[metadatapath] = (app, [])
+    if (len(toparse) >= PARALLEL_THRESHOLD and (os.cpu_count() or 1) > 1
+            and 'fork' in multiprocessing.get_all_start_methods()):
+        logging.debug(_('Parsing {count} metadata files with {jobs} jobs')
+                      .format(count=len(toparse), jobs=os.cpu_count()))
+        for metadatapath, (app, records) in parse_metadata_files(toparse, refresh).items():
+            parsed[metadatapath] = (app, records)
+            if not _has_warnings(records):
+                metadatacache.put(metadatapath, app)
+
     for metadatapath in metadatafiles:
         if metadatapath == '.fdroid.txt':
             warn_or_exception(_('.fdroid.txt is not supported!  Convert to .fdroid.yml or .fdroid.json.'))
@@ -892,24 +1448,43 @@ def read_metadata(xref=True, check_vcs=[], refresh=True, sort_by_time=False):
         if appid in apps:
             warn_or_exception(_("Found multiple metadata files for {appid}")
                               .format(appid=appid))
-        app = parse_metadata(metadatapath, appid in check_vcs, refresh)
-        check_metadata(app)
+        if metadatapath in parsed:
+            app, records = parsed[metadatapath]
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+        else:
+            recorder = _RecordingHandler()
+            logging.getLogger().addHandler(recorder)
+            try:
+                app = parse_metadata(metadatapath, appid in check_vcs, refresh)
+                check_metadata(app)
+            finally:
+                logging.getLogger().removeHandler(recorder)
+            if appid not in check_vcs and not _has_warnings(recorder.records):
+                metadatacache.put(metadatapath, app)
         apps[app.id] = app
+    metadatacache.save(None if appids else metadatafiles)
 
     if xref:
         # Parse all descriptions at load time, just to ensure cross-referencing
         # errors are caught early rather than when they hit the build server.
         def linkres(appid):
-            if appid in apps:
+            if appid in apps or appid in knownappids:
                 return ("fdroid.app:" + appid, "Dummy name - don't know yet")
             warn_or_exception(_("Cannot resolve app id {appid}").format(appid=appid))
 
+        descriptioncache = get_description_cache()
         for appid, app in apps.items():
             try:
-                description_html(app.Description, linkres)
+                descriptioncache.get_html(app.Description, linkres)
             except MetaDataException as e:
                 warn_or_exception(_("Problem with description of {appid}: {error}")
                                   .format(appid=appid, error=str(e)))
+        descriptioncache.save(prune=not appids)
+
+    if compact:
+        for appid, app in apps.items():
+            apps[appid] = to_record(app)
 
     return apps
 
@@ -1656,6 +2231,8 @@ def write_txt(mf, app):
 
 
 def write_metadata(metadatapath, app):
+    if isinstance(app, AppRecord):
+        app = to_app(app)
     _ignored, ext = fdroidserver.common.get_extension(metadatapath)
     accepted = fdroidserver.common.config['accepted_formats']
     if ext not in accepted:
@@ -227,6 +227,7 @@ def main():
                           '{0} apps, {1} key aliases', len(allapps)).format(len(allapps), len(allaliases)))
 
     # Process any APKs or ZIPs that are waiting to be signed...
+    developersignatures = common.get_developer_signatures()
     for apkfile in sorted(glob.glob(os.path.join(unsigned_dir, '*.apk'))
                           + glob.glob(os.path.join(unsigned_dir, '*.zip'))):
 
@@ -290,7 +291,7 @@ def main():
             skipsigning = False
 
             # First we handle signatures for this app from local metadata
-            signingfiles = common.metadata_find_developer_signing_files(appid, vercode)
+            signingfiles = developersignatures.get_signing_files(appid, vercode)
             if signingfiles:
                 # There's a signature of the app developer present in our
                 # metadata. This means we're going to prepare both a locally
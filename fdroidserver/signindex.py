@@ -16,7 +16,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import hashlib
+import importlib.util
 import os
+import re
+import stat
+import struct
+import tempfile
 import time
 import zipfile
 from argparse import ArgumentParser
@@ -24,24 +31,45 @@ import logging
 
 from . import _
 from . import common
-from .exception import FDroidException
+from .exception import FDroidException, InProcessSigningUnsupported
 
 config = None
 options = None
 start_timestamp = time.gmtime()
 
 
+# the date of the signature files, so signing the same JAR gives the same bytes
+JAR_SIGNATURE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+JKS_MAGIC = 0xfeedfeed
+JKS_KEY_PROTECTOR_OID = '1.3.6.1.4.1.42.2.17.1.1'
+
+
 def sign_jar(jar):
     """
-    Sign a JAR file with Java's jarsigner.
+    Sign a JAR file with the repo signing key.
 
     This method requires a properly initialized config object.
 
+    The JAR is signed in Python with sign_jar_in_process() when the
+    keystore is a JKS or PKCS12 file and the cryptography library is
+    installed, so no JVM needs to be started.  Otherwise, like for
+    smartcards, this runs Java's jarsigner.
+
     This does use old hashing algorithms, i.e. SHA1, but that's not
     broken yet for file verification.  This could be set to SHA256,
     but then Android < 4.3 would not be able to verify it.
     https://code.google.com/p/android/issues/detail?id=38321
     """
+    if config['keystore'] != 'NONE':
+        try:
+            private_key, certificate = load_signing_key()
+            sign_jar_in_process(jar, private_key, certificate, config['repo_keyalias'])
+            return
+        except ImportError:
+            pass
+        except InProcessSigningUnsupported as e:
+            logging.debug(_('Signing with jarsigner: {error}').format(error=e))
+
     args = [config['jarsigner'], '-keystore', config['keystore'],
             '-storepass:env', 'FDROID_KEY_STORE_PASS',
             '-digestalg', 'SHA1', '-sigalg', 'SHA1withRSA',
@@ -59,6 +87,233 @@ def sign_jar(jar):
         raise FDroidException("Failed to sign %s!" % jar)
 
 
+def _read_jks_private_key(data, alias, storepass, keypass):
+    """Read a private key entry from a Java KeyStore (JKS) file
+
+    :returns: (the PKCS#8 DER private key, list of DER certificates)
+    """
+    from asn1crypto import keys
+
+    password = storepass.encode('utf-16-be')
+    digest = hashlib.sha1(password + b'Mighty Aphrodite' + data[:-20]).digest()  # nosec JKS format
+    if digest != data[-20:]:
+        raise FDroidException(_('Keystore was tampered with, or password was incorrect'))
+
+    magic, version, count = struct.unpack_from('>III', data, 0)
+    pos = 12
+
+    def read_utf():
+        nonlocal pos
+        (length, ) = struct.unpack_from('>H', data, pos)
+        pos += 2 + length
+        return data[pos - length:pos].decode('utf-8')
+
+    def read_bytes():
+        nonlocal pos
+        (length, ) = struct.unpack_from('>I', data, pos)
+        pos += 4 + length
+        return data[pos - length:pos]
+
+    for _i in range(count):
+        (tag, ) = struct.unpack_from('>I', data, pos)
+        pos += 4
+        entry_alias = read_utf()
+        pos += 8  # timestamp
+        if tag == 1:
+            encrypted_key = read_bytes()
+            (chain_length, ) = struct.unpack_from('>I', data, pos)
+            pos += 4
+            chain = []
+            for _j in range(chain_length):
+                if version == 2:
+                    read_utf()  # certificate type
+                chain.append(read_bytes())
+            if entry_alias == alias.lower():
+                break
+        else:
+            if version == 2:
+                read_utf()
+            read_bytes()
+    else:
+        raise FDroidException(_('Alias {alias} does not exist in the keystore')
+                              .format(alias=alias))
+
+    info = keys.EncryptedPrivateKeyInfo.load(encrypted_key)
+    if info['encryption_algorithm']['algorithm'].dotted != JKS_KEY_PROTECTOR_OID:
+        raise InProcessSigningUnsupported('unsupported JKS key protection algorithm')
+    encrypted = info['encrypted_data'].native
+    salt, encrypted, check = encrypted[:20], encrypted[20:-20], encrypted[-20:]
+    password = keypass.encode('utf-16-be')
+    keystream = b''
+    block = salt
+    while len(keystream) < len(encrypted):
+        block = hashlib.sha1(password + block).digest()  # nosec JKS format
+        keystream += block
+    key = bytes(a ^ b for a, b in zip(encrypted, keystream))
+    if hashlib.sha1(password + key).digest() != check:  # nosec JKS format
+        raise FDroidException(_('Cannot recover key, the key password is incorrect'))
+    return key, chain
+
+
+def load_signing_key():
+    """Load the repo signing key from the keystore in config
+
+    This reads 'keystore', 'repo_keyalias', 'keystorepass' and
+    'keypass' just like jarsigner does.  The cryptography library only
+    reads the first key of a PKCS12 keystore, so any other alias has to
+    go through jarsigner.
+
+    :returns: (private key, DER-encoded certificate)
+    :raises: ImportError if the cryptography library is not installed
+    :raises: InProcessSigningUnsupported if the keystore needs to go through Java
+    """
+    from cryptography.hazmat.primitives.serialization import load_der_private_key, pkcs12
+    from cryptography.hazmat.primitives.serialization import Encoding
+
+    with open(config['keystore'], 'rb') as fp:
+        data = fp.read()
+    if len(data) > 4 and struct.unpack('>I', data[:4])[0] == JKS_MAGIC:
+        key, chain = _read_jks_private_key(data, config['repo_keyalias'],
+                                           config['keystorepass'], config['keypass'])
+        return load_der_private_key(key, password=None), chain[0]
+    elif data[:1] == b'\x30':
+        try:
+            keystore = pkcs12.load_pkcs12(data, config['keystorepass'].encode('utf-8'))
+        except ValueError as e:
+            raise FDroidException(str(e))
+        if keystore.key is None or keystore.cert is None:
+            raise InProcessSigningUnsupported('no private key found in the PKCS12 keystore')
+        # aliases are case-insensitive, like in Java's PKCS12 keystore
+        friendly_name = (keystore.cert.friendly_name or b'').decode('utf-8', 'replace')
+        if friendly_name.lower() != config['repo_keyalias'].lower():
+            raise InProcessSigningUnsupported('alias {alias} is not the first key of the PKCS12 keystore'
+                                              .format(alias=config['repo_keyalias']))
+        return keystore.key, keystore.cert.certificate.public_bytes(Encoding.DER)
+    raise InProcessSigningUnsupported('unsupported keystore type')
+
+
+def _jar_manifest_line(key, value):
+    """Make a manifest line, wrapped at 72 bytes like Java does"""
+    line = ('%s: %s' % (key, value)).encode('utf-8')
+    lines = [line[:72]]
+    line = line[72:]
+    while line:
+        lines.append(b' ' + line[:71])
+        line = line[71:]
+    return b'\r\n'.join(lines) + b'\r\n'
+
+
+def _jar_signature_block_name(alias):
+    """The base name of the signature files, made from the alias like jarsigner"""
+    name = re.sub(r'[^A-Z0-9_-]', '_', alias.upper())[:8]
+    return 'META-INF/' + name
+
+
+def sign_jar_in_process(jar, private_key, certificate, alias):
+    """Sign a JAR file with a v1 JAR signature using SHA1withRSA
+
+    This writes what `jarsigner -digestalg SHA1 -sigalg SHA1withRSA`
+    does: META-INF/MANIFEST.MF with the digests of all entries, the
+    .SF file with the digests of the manifest, and a PKCS#7 signature
+    block of the .SF file.  Any previous signature is replaced.  The
+    output only depends on the contents of the JAR and the key, so
+    signing the same index again gives exactly the same file.
+
+    :param private_key: an RSA private key from the cryptography library
+    :param certificate: the DER-encoded certificate of the key
+    :param alias: the key alias, which names the signature files
+    """
+    from asn1crypto import cms, x509
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+    if not isinstance(private_key, rsa.RSAPrivateKey):
+        raise InProcessSigningUnsupported('only RSA keys can sign with SHA1withRSA')
+
+    with zipfile.ZipFile(jar) as zin:
+        entries = []
+        for info in zin.infolist():
+            name = info.filename
+            if name.endswith('/') and name.upper().startswith('META-INF/'):
+                continue
+            if name.upper() == 'META-INF/MANIFEST.MF' or re.match(
+                    r'META-INF/[^/]*\.(SF|RSA|DSA|EC)$|META-INF/SIG-[^/]*$', name, re.IGNORECASE):
+                continue
+            entries.append((info, zin.read(info)))
+
+    files = [(info, data) for info, data in entries if not info.filename.endswith('/')]
+    created_by = _jar_manifest_line('Created-By', 'fdroidserver')
+    main_section = _jar_manifest_line('Manifest-Version', '1.0') + created_by + b'\r\n'
+    sections = [_jar_manifest_line('Name', info.filename)
+                + _jar_manifest_line('SHA1-Digest', _b64sha1(data))
+                + b'\r\n'
+                for info, data in files]
+    manifest = main_section + b''.join(sections)
+
+    signature_file = (_jar_manifest_line('Signature-Version', '1.0')
+                      + _jar_manifest_line('SHA1-Digest-Manifest-Main-Attributes', _b64sha1(main_section))
+                      + created_by
+                      + _jar_manifest_line('SHA1-Digest-Manifest', _b64sha1(manifest))
+                      + b'\r\n')
+    for (info, data), section in zip(files, sections):
+        signature_file += (_jar_manifest_line('Name', info.filename)
+                           + _jar_manifest_line('SHA1-Digest', _b64sha1(section))
+                           + b'\r\n')
+
+    signature = private_key.sign(signature_file, padding.PKCS1v15(), hashes.SHA1())  # nosec see sign_jar()
+    cert = x509.Certificate.load(certificate)
+    signed_data = cms.SignedData({
+        'version': 'v1',
+        'digest_algorithms': [{'algorithm': 'sha1'}],
+        'encap_content_info': {'content_type': 'data'},
+        'certificates': [cert],
+        'signer_infos': [{
+            'version': 'v1',
+            'sid': cms.SignerIdentifier({
+                'issuer_and_serial_number': {
+                    'issuer': cert.issuer,
+                    'serial_number': cert.serial_number,
+                },
+            }),
+            'digest_algorithm': {'algorithm': 'sha1'},
+            'signature_algorithm': {'algorithm': 'rsassa_pkcs1v15'},
+            'signature': signature,
+        }],
+    })
+    block = cms.ContentInfo({'content_type': 'signed_data', 'content': signed_data}).dump()
+
+    basename = _jar_signature_block_name(alias)
+    fd, tmpjar = tempfile.mkstemp(prefix='.signing-', suffix='.jar', dir=os.path.dirname(jar) or '.')
+    os.close(fd)
+    os.chmod(tmpjar, stat.S_IMODE(os.stat(jar).st_mode))
+    try:
+        with zipfile.ZipFile(tmpjar, 'w') as zout:
+            for name, data in (('META-INF/MANIFEST.MF', manifest),
+                               (basename + '.SF', signature_file),
+                               (basename + '.RSA', block)):
+                info = zipfile.ZipInfo(name, date_time=JAR_SIGNATURE_DATE_TIME)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                zout.writestr(info, data)
+            for info, data in entries:
+                zout.writestr(info, data)
+        os.replace(tmpjar, jar)
+    finally:
+        if os.path.exists(tmpjar):
+            os.remove(tmpjar)
+
+
+def _b64sha1(data):
+    return base64.b64encode(hashlib.sha1(data).digest()).decode()  # nosec see sign_jar()
+
+
+def can_sign_in_process():
+    """Check if sign_jar() can work without jarsigner"""
+    if config.get('keystore') == 'NONE':
+        return False
+    return bool(importlib.util.find_spec('asn1crypto') and importlib.util.find_spec('cryptography'))
+
+
 def sign_index_v1(repodir, json_name):
     """
     Sign index-v1.json to make index-v1.jar
@@ -98,7 +353,7 @@ def main():
 
     config = common.read_config(options)
 
-    if 'jarsigner' not in config:
+    if 'jarsigner' not in config and not can_sign_in_process():
         raise FDroidException(
             _('Java jarsigner not found! Install in standard location or set java_paths!'))
 
@@ -19,17 +19,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import abc
 import sys
 import os
 import shutil
+import tempfile
 import glob
 import logging
 import re
 import socket
+import sqlite3
 import warnings
 import zipfile
 import hashlib
 import json
+import multiprocessing
 import time
 import yaml
 import copy
@@ -42,6 +46,7 @@ except ImportError:
     from yaml import SafeLoader
 
 import collections
+import collections.abc
 from binascii import hexlify
 
 from . import _
@@ -56,8 +61,26 @@ if hasattr(Image, 'DecompressionBombWarning'):
     warnings.simplefilter('error', Image.DecompressionBombWarning)
 Image.MAX_IMAGE_PIXELS = 0xffffff  # 4096x4096
 
+# Only apkcaches from before APKCACHE_FIELD_VERSIONS are thrown away when
+# this changes, see get_cache().
 METADATA_VERSION = 21
 
+# The version of each group of fields in the apkcache entries of APKs.
+# When the code that makes one of them changes, bump its version here,
+# then only that group gets made again from the cached APKs, instead of
+# rescanning every APK, see upgrade_cached_apk().
+APKCACHE_FIELD_VERSIONS = collections.OrderedDict([
+    ('manifest', 1),  # scan_apk_androguard() or scan_apk_aapt()
+    ('signer', 1),  # 'sig' and 'signer'
+    ('signature', 1),  # common.verify_apk_signature() and friends
+    ('vulnerabilities', 1),  # has_known_vulnerability()
+    ('icons', 1),  # extract_apk_icons()
+])
+APKCACHE_MANIFEST_FIELDS = ('packageName', 'versionCode', 'versionName', 'name',
+                            'minSdkVersion', 'targetSdkVersion', 'maxSdkVersion',
+                            'icons_src', 'nativecode', 'uses-permission',
+                            'uses-permission-sdk-23', 'features')
+
 # less than the valid range of versionCode, i.e. Java's Integer.MIN_VALUE
 UNSET_VERSION_CODE = -0x100000000
 
@@ -126,11 +149,12 @@ def disabled_algorithms_allowed():
     return options.allow_disabled_algorithms or config['allow_disabled_algorithms']
 
 
-def status_update_json(apps, sortedids, apks):
+def status_update_json(apps, sortedids, apks, packageindex=None):
     """Output a JSON file with metadata about this `fdroid update` run
 
     :param apps: fully populated list of all applications
     :param apks: all to be published apks
+    :param packageindex: common.PackageIndex of apks, made if None
 
     """
 
@@ -141,6 +165,8 @@ def status_update_json(apps, sortedids, apks):
     output['failedBuilds'] = dict()
     output['noPackages'] = []
 
+    if packageindex is None:
+        packageindex = common.PackageIndex(apks)
     for appid in sortedids:
         app = apps[appid]
         for af in app.get('AntiFeatures', []):
@@ -151,21 +177,14 @@ def status_update_json(apps, sortedids, apks):
                 antiFeatures[af]['apps'] = set()
             antiFeatures[af]['apps'].add(appid)
 
-        apklist = []
-        for apk in apks:
-            if apk['packageName'] == appid:
-                apklist.append(apk)
         builds = app.get('builds', [])
         validapks = 0
         for build in builds:
             if not build.get('disable'):
-                builtit = False
-                for apk in apklist:
-                    if apk['versionCode'] == int(build.versionCode):
-                        builtit = True
-                        validapks += 1
-                        break
-                if not builtit:
+                builtit = bool(packageindex.get_version(appid, int(build.versionCode)))
+                if builtit:
+                    validapks += 1
+                else:
                     failedBuilds = output['failedBuilds']
                     if appid not in failedBuilds:
                         failedBuilds[appid] = []
@@ -177,11 +196,12 @@ def status_update_json(apps, sortedids, apks):
     common.write_status_json(output, options.pretty)
 
 
-def update_wiki(apps, sortedids, apks):
+def update_wiki(apps, sortedids, apks, packageindex=None):
     """Update the wiki
 
     :param apps: fully populated list of all applications
     :param apks: all apks, except...
+    :param packageindex: common.PackageIndex of apks, made if None
     """
     logging.info("Updating wiki")
     wikicat = 'Apps'
@@ -193,6 +213,8 @@ def update_wiki(apps, sortedids, apks):
     generated_pages = {}
     generated_redirects = {}
 
+    if packageindex is None:
+        packageindex = common.PackageIndex(apks)
     for appid in sortedids:
         app = metadata.App(apps[appid])
 
@@ -244,11 +266,10 @@ def update_wiki(apps, sortedids, apks):
         gotcurrentver = False
         cantupdate = False
         buildfails = False
-        for apk in apks:
-            if apk['packageName'] == appid:
-                if str(apk['versionCode']) == app.CurrentVersionCode:
-                    gotcurrentver = True
-                apklist.append(apk)
+        for apk in packageindex.get(appid):
+            if str(apk['versionCode']) == app.CurrentVersionCode:
+                gotcurrentver = True
+            apklist.append(apk)
         # Include ones we can't build, as a special case...
         for build in app.builds:
             if build.disable:
@@ -493,16 +514,300 @@ def getsig(apkpath):
 
     """
 
-    cert_encoded = common.get_first_signer_certificate(apkpath)
+    return getsig_from_certificate(common.get_first_signer_certificate(apkpath))
+
+
+def getsig_from_certificate(cert_encoded):
+    """Get the unique ID for a DER-encoded signing certificate, see getsig()"""
     if not cert_encoded:
         return None
     return hashlib.md5(hexlify(cert_encoded)).hexdigest()  # nosec just used as ID for signing key
 
 
+class _ApkCacheEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, set):
+            return list(obj)
+        elif isinstance(obj, datetime):
+            return obj.timestamp()
+        return super().default(obj)
+
+
+def _decode_cache_entry(v):
+    """Convert the JSON types of a cache entry back to the ones used in update"""
+    if isinstance(v, dict):
+        if 'antiFeatures' in v:
+            v['antiFeatures'] = set(v['antiFeatures'])
+        if 'added' in v:
+            v['added'] = datetime.fromtimestamp(v['added'])
+    return v
+
+
+class ApkCache(collections.abc.MutableMapping):
+    """The apkcache, stored in an SQLite database
+
+    This works like the dict that used to be loaded from and written
+    to apkcache.json as a whole, but each entry is only read and
+    decoded from the database when it is used, and only the entries
+    that are new or changed are written back by commit().  Entries
+    that were read are compared to what is stored, since the rest of
+    `fdroid update` changes them in place.
+
+    The 'file_stats' and 'field_versions' keys are each kept in their
+    own table, one row per file, see is_cache_entry_current() and
+    get_cached_apk().  They can always be read, but they only count as
+    keys when there is something in them, like in the old JSON file.
+    """
+
+    FILE_STATS = 'file_stats'
+    FIELD_VERSIONS = 'field_versions'
+
+    def __init__(self, path):
+        self.path = path
+        self._meta = collections.OrderedDict()
+        self._names = collections.OrderedDict()  # names of all entries, in order
+        self._stored = dict()  # name -> the JSON as stored, for entries that were read
+        self._entries = dict()  # name -> the decoded entry
+        self._deleted = set()
+        self._cleared = False
+        self.file_stats = _ApkCacheFileStats()
+        self.field_versions = _ApkCacheFieldVersions()
+        self._tables = collections.OrderedDict([
+            (self.FILE_STATS, self.file_stats),
+            (self.FIELD_VERSIONS, self.field_versions),
+        ])
+        self._db = None
+        if os.path.exists(path):
+            self._connect()
+            for key, value in self._db.execute('SELECT key, value FROM meta ORDER BY rowid'):
+                self._meta[key] = json.loads(value)
+            for (name, ) in self._db.execute('SELECT name FROM entries ORDER BY rowid'):
+                self._names[name] = True
+            for table in self._tables.values():
+                table.load(self._db)
+
+    def _connect(self):
+        if self._db is None:
+            cache_path = os.path.dirname(self.path)
+            if cache_path and not os.path.exists(cache_path):
+                os.makedirs(cache_path)
+            self._db = sqlite3.connect(self.path)
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+                self._db.execute('CREATE TABLE IF NOT EXISTS entries (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+                for table in self._tables.values():
+                    self._db.execute(table.CREATE)
+
+    def __getitem__(self, key):
+        if key in self._tables:
+            return self._tables[key]
+        if key in self._meta:
+            return self._meta[key]
+        if key not in self._names:
+            raise KeyError(key)
+        if key not in self._entries:
+            (value, ) = self._db.execute('SELECT value FROM entries WHERE name = ?', (key, )).fetchone()
+            self._stored[key] = value
+            self._entries[key] = _decode_cache_entry(json.loads(value, object_pairs_hook=collections.OrderedDict))
+        return self._entries[key]
+
+    def __setitem__(self, key, value):
+        if key in self._tables:
+            self._tables[key].clear()
+            self._tables[key].update(value)
+        elif not isinstance(value, dict):
+            self._meta[key] = value
+        else:
+            self._names[key] = True
+            self._entries[key] = value
+            self._stored.pop(key, None)
+            self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key in self._tables:
+            self._tables[key].clear()
+        elif key in self._meta:
+            del self._meta[key]
+        else:
+            del self._names[key]
+            self._entries.pop(key, None)
+            self._stored.pop(key, None)
+            self._deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self._tables:
+            return bool(self._tables[key])
+        return key in self._meta or key in self._names
+
+    def __iter__(self):
+        yield from list(self._meta)
+        for key, table in self._tables.items():
+            if table:
+                yield key
+        yield from list(self._names)
+
+    def __len__(self):
+        return len(self._meta) + sum(1 for t in self._tables.values() if t) + len(self._names)
+
+    def entry_names(self):
+        """The names of all entries, without decoding them"""
+        return list(self._names)
+
+    def clear(self):
+        """Empty the cache, the database is only changed by commit()"""
+        self._meta.clear()
+        self._names.clear()
+        self._entries.clear()
+        self._stored.clear()
+        self._deleted.clear()
+        for table in self._tables.values():
+            table.clear()
+        self._cleared = True
+
+    def commit(self):
+        """Write all new and changed entries to the database"""
+        self._connect()
+        with self._db:
+            if self._cleared:
+                self._db.execute('DELETE FROM meta')
+                self._db.execute('DELETE FROM entries')
+                for table in self._tables.values():
+                    self._db.execute('DELETE FROM ' + table.TABLE)  # nosec table names are constants
+                self._cleared = False
+            for key, value in self._meta.items():
+                self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                 (key, json.dumps(value)))
+            for name in self._deleted:
+                self._db.execute('DELETE FROM entries WHERE name = ?', (name, ))
+            self._deleted.clear()
+            for name, entry in self._entries.items():
+                value = json.dumps(entry, cls=_ApkCacheEncoder)
+                if self._stored.get(name) != value:
+                    self._db.execute('INSERT OR REPLACE INTO entries (name, value) VALUES (?, ?)',
+                                     (name, value))
+                    self._stored[name] = value
+            for table in self._tables.values():
+                table.save(self._db)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class _ApkCacheTable(collections.abc.MutableMapping):
+    """A per-file table of an ApkCache, tracking what needs to be written
+
+    MutableMapping is an ABC, so subclasses have to implement load()
+    and save_row().
+    """
+
+    TABLE = None
+    CREATE = None
+
+    def __init__(self):
+        self._rows = dict()
+        self.changed = set()
+        self.deleted = set()
+
+    def __getitem__(self, name):
+        return self._rows[name]
+
+    def __setitem__(self, name, value):
+        if self._rows.get(name) != value:
+            self._rows[name] = self.copy_value(value)
+            self.changed.add(name)
+            self.deleted.discard(name)
+
+    def __delitem__(self, name):
+        del self._rows[name]
+        self.changed.discard(name)
+        self.deleted.add(name)
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def copy_value(self, value):
+        return value
+
+    @abc.abstractmethod
+    def load(self, db):
+        """Read all rows of the table from db"""
+
+    def save(self, db):
+        for name in self.deleted:
+            db.execute('DELETE FROM {} WHERE name = ?'.format(self.TABLE), (name, ))
+        for name in self.changed:
+            self.save_row(db, name, self._rows[name])
+        self.deleted.clear()
+        self.changed.clear()
+
+    @abc.abstractmethod
+    def save_row(self, db, name, value):
+        """Write one row of the table to db"""
+
+
+class _ApkCacheFileStats(_ApkCacheTable):
+    """The 'file_stats' of an ApkCache, see get_file_stat()"""
+
+    TABLE = 'file_stats'
+    CREATE = ('CREATE TABLE IF NOT EXISTS file_stats (name TEXT PRIMARY KEY, size INTEGER,'
+              ' mtime_ns INTEGER, ino INTEGER, dev INTEGER)')
+
+    def copy_value(self, value):
+        return list(value)
+
+    def load(self, db):
+        for row in db.execute('SELECT name, size, mtime_ns, ino, dev FROM file_stats'):
+            self._rows[row[0]] = list(row[1:])
+
+    def save_row(self, db, name, value):
+        db.execute('INSERT OR REPLACE INTO file_stats (name, size, mtime_ns, ino, dev)'
+                   ' VALUES (?, ?, ?, ?, ?)', [name] + list(value))
+
+
+class _ApkCacheFieldVersions(_ApkCacheTable):
+    """The 'field_versions' of an ApkCache, see get_apkcache_field_versions()"""
+
+    TABLE = 'field_versions'
+    CREATE = 'CREATE TABLE IF NOT EXISTS field_versions (name TEXT PRIMARY KEY, value TEXT NOT NULL)'
+
+    def copy_value(self, value):
+        return json.loads(json.dumps(value), object_pairs_hook=collections.OrderedDict)
+
+    def load(self, db):
+        for name, value in db.execute('SELECT name, value FROM field_versions'):
+            self._rows[name] = json.loads(value, object_pairs_hook=collections.OrderedDict)
+
+    def save_row(self, db, name, value):
+        db.execute('INSERT OR REPLACE INTO field_versions (name, value) VALUES (?, ?)',
+                   (name, json.dumps(value)))
+
+
 def get_cache_file():
+    return os.path.join('tmp', 'apkcache.db')
+
+
+def get_json_cache_file():
+    """The file the apkcache was stored in before it moved to SQLite"""
     return os.path.join('tmp', 'apkcache.json')
 
 
+def _migrate_json_cache(apkcache):
+    """Move the entries from apkcache.json into the new cache, once"""
+    jsonfile = get_json_cache_file()
+    logging.info(_('Migrating {path} to {newpath}')
+                 .format(path=jsonfile, newpath=apkcache.path))
+    with open(jsonfile) as fp:
+        data = json.load(fp, object_pairs_hook=collections.OrderedDict)
+    for k, v in data.items():
+        apkcache[k] = _decode_cache_entry(v)
+    apkcache.commit()
+
+
 def get_cache():
     """Get the cached dict of the APK index
 
@@ -511,57 +816,147 @@ def get_cache():
     long time, like calculating the SHA-256 and verifying the APK
     signature.
 
-    The cache is invalidated if the metadata version is different, or
-    the 'allow_disabled_algorithms' config/option is different.  In
-    those cases, there is no easy way to know what has changed from
-    the cache, so just rerun the whole thing.
+    The 'field_versions' entry holds the versions of the fields that
+    each APK entry was made with, see APKCACHE_FIELD_VERSIONS, so when
+    those change only the outdated fields get made again.  So when the
+    format of a field changes, bump its version there, not the metadata
+    version, which only throws away caches from before field versions.
+
+    The 'file_stats' entry holds the os.stat() values that each entry
+    was made from, so unchanged files do not need to be hashed again.
 
-    :return: apkcache
+    :return: apkcache, an ApkCache instance
 
     """
-    apkcachefile = get_cache_file()
     ada = disabled_algorithms_allowed()
-    if not options.clean and os.path.exists(apkcachefile):
-        with open(apkcachefile) as fp:
-            apkcache = json.load(fp, object_pairs_hook=collections.OrderedDict)
-        if apkcache.get("METADATA_VERSION") != METADATA_VERSION \
-           or apkcache.get('allow_disabled_algorithms') != ada:
-            apkcache = collections.OrderedDict()
-    else:
-        apkcache = collections.OrderedDict()
+    apkcache = ApkCache(get_cache_file())
+    jsonfile = get_json_cache_file()
+    if options.clean:
+        apkcache.clear()
+    elif not apkcache and os.path.exists(jsonfile):
+        _migrate_json_cache(apkcache)
+    if os.path.exists(jsonfile):
+        # migrated, thrown away with --clean, or left over next to a newer cache
+        os.remove(jsonfile)
+    if 'field_versions' not in apkcache:
+        if apkcache.get("METADATA_VERSION") != METADATA_VERSION:
+            apkcache.clear()
+        else:
+            _set_legacy_field_versions(apkcache)
 
     apkcache["METADATA_VERSION"] = METADATA_VERSION
     apkcache['allow_disabled_algorithms'] = ada
 
-    for k, v in apkcache.items():
-        if not isinstance(v, dict):
-            continue
-        if 'antiFeatures' in v:
-            v['antiFeatures'] = set(v['antiFeatures'])
-        if 'added' in v:
-            v['added'] = datetime.fromtimestamp(v['added'])
-
     return apkcache
 
 
+def _get_cache_entry_names(apkcache):
+    if isinstance(apkcache, ApkCache):
+        return apkcache.entry_names()
+    return [k for k, v in apkcache.items()
+            if k not in ('file_stats', 'field_versions') and isinstance(v, dict)]
+
+
+def _set_legacy_field_versions(apkcache):
+    """Record which fields the entries of a cache from before field versions have
+
+    Those entries were made by the first version of each group of fields.
+    """
+    for name in _get_cache_entry_names(apkcache):
+        if not name.endswith('.apk'):
+            continue
+        versions = collections.OrderedDict((k, 1) for k in APKCACHE_FIELD_VERSIONS)
+        set_cached_field_versions(apkcache, name, versions)
+
+
 def write_cache(apkcache):
-    class Encoder(json.JSONEncoder):
-        def default(self, obj):
-            if isinstance(obj, set):
-                return list(obj)
-            elif isinstance(obj, datetime):
-                return obj.timestamp()
-            return super().default(obj)
-
-    apkcachefile = get_cache_file()
-    cache_path = os.path.dirname(apkcachefile)
-    if not os.path.exists(cache_path):
-        os.makedirs(cache_path)
-    for k, v in apkcache.items():
+    if not isinstance(apkcache, ApkCache):
+        newcache = ApkCache(get_cache_file())
+        newcache.clear()
+        newcache.update(apkcache)
+        apkcache = newcache
+    for k in apkcache.keys():
         if isinstance(k, bytes):
-            print('BYTES: ' + str(k) + ' ' + str(v))
-    with open(apkcachefile, 'w') as fp:
-        json.dump(apkcache, fp, cls=Encoder, indent=2)
+            logging.debug('BYTES: ' + str(k) + ' ' + str(apkcache[k]))
+    for table in (apkcache.file_stats, apkcache.field_versions):
+        for name in list(table.keys()):
+            if name not in apkcache:
+                del table[name]
+    apkcache.commit()
+
+
+def get_file_stat(filename):
+    """Get the values of os.stat() that show if a file changed since it was cached"""
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev]
+
+
+def is_cache_entry_current(apkcache, name, filename, filestat):
+    """Check if the cached entry for a repo file still matches the file
+
+    Reading every file just to hash it makes no-op runs very slow on
+    big repos, so if the size, mtime, inode and device are the same as
+    when the file was hashed, the cached hash is trusted.  The file
+    gets hashed anyway when --verify-hashes is given, or when it was
+    changed just before the stat was stored, see set_cached_file_stat().
+
+    :param apkcache: current apk cache information
+    :param name: the file name used as the key in apkcache
+    :param filename: the path to the file
+    :param filestat: the current stat values of the file, from get_file_stat()
+    :returns: (current, cachechanged) where current is True if the cached
+     entry can be used, and cachechanged is True if the apkcache got changed.
+    """
+    file_stats = apkcache.get('file_stats', dict())
+    if not getattr(options, 'verify_hashes', False) and file_stats.get(name) == filestat:
+        return True, False
+    if apkcache[name].get('hash') == sha256sum(filename):
+        set_cached_file_stat(apkcache, name, filestat)
+        return True, True
+    return False, False
+
+
+def set_cached_file_stat(apkcache, name, filestat):
+    """Store the stat values a cache entry was made from, see is_cache_entry_current()"""
+    if 'file_stats' not in apkcache:
+        apkcache['file_stats'] = collections.OrderedDict()
+    # a change in the same clock tick might keep the size and mtime,
+    # so the file is hashed again next time, like in metadata.MetadataCache
+    if time.time() - filestat[1] / 1e9 < 2:
+        apkcache['file_stats'].pop(name, None)
+        return
+    apkcache['file_stats'][name] = filestat
+
+
+def get_apkcache_field_versions():
+    """Get the versions of the fields that an APK is cached with"""
+    return collections.OrderedDict(APKCACHE_FIELD_VERSIONS)
+
+
+def relies_on_disabled_algorithms(apk, repodir, allow_disabled_algorithms):
+    """Check if a cached APK was only accepted because of disabled algorithms
+
+    Those are allowed in the archive, or when allow_disabled_algorithms
+    is set, see check_apk_signature().  This goes by the anti-features
+    of the entry, so moving an APK between sections does not mean
+    verifying it again unless it really has to be.
+
+    :returns: True if the signature has to be verified again
+    """
+    return 'DisabledAlgorithm' in apk.get('antiFeatures', ()) \
+        and repodir != 'archive' and not allow_disabled_algorithms
+
+
+def get_cached_field_versions(apkcache, name):
+    """Get the field versions of a cache entry, an empty dict if they are unknown"""
+    return apkcache.get('field_versions', dict()).get(name, dict())
+
+
+def set_cached_field_versions(apkcache, name, versions):
+    """Store the field versions a cache entry was made with, see get_apkcache_field_versions()"""
+    if 'field_versions' not in apkcache:
+        apkcache['field_versions'] = collections.OrderedDict()
+    apkcache['field_versions'][name] = versions
 
 
 def get_icon_bytes(apkzip, iconsrc):
@@ -596,7 +991,7 @@ def sha256base64(filename):
     return urlsafe_b64encode(hasher.digest()).decode()
 
 
-def has_known_vulnerability(filename):
+def has_known_vulnerability(filename, inspector=None):
     """checks for known vulnerabilities in the APK
 
     Checks OpenSSL .so files in the APK to see if they are a known vulnerable
@@ -609,6 +1004,8 @@ def has_known_vulnerability(filename):
 
     Janus is similar to Master Key but is perhaps easier to scan for.
     https://www.guardsquare.com/en/blog/new-android-vulnerability-allows-attackers-modify-apps-without-affecting-their-signatures
+
+    :param inspector: an optional common.ApkInspector to read the APK from
     """
 
     found_vuln = False
@@ -617,15 +1014,19 @@ def has_known_vulnerability(filename):
     if not hasattr(has_known_vulnerability, "pattern"):
         has_known_vulnerability.pattern = re.compile(b'.*OpenSSL ([01][0-9a-z.-]+)')
 
-    with open(filename.encode(), 'rb') as fp:
-        first4 = fp.read(4)
+    if inspector is None:
+        with open(filename.encode(), 'rb') as fp:
+            first4 = fp.read(4)
+    else:
+        first4 = inspector.header
     if first4 != b'\x50\x4b\x03\x04':
         raise FDroidException(_('{path} has bad file signature "{pattern}", possible Janus exploit!')
                               .format(path=filename, pattern=first4.decode().replace('\n', ' ')) + '\n'
                               + 'https://www.guardsquare.com/en/blog/new-android-vulnerability-allows-attackers-modify-apps-without-affecting-their-signatures')
 
     files_in_apk = set()
-    with zipfile.ZipFile(filename) as zf:
+    zf = zipfile.ZipFile(filename) if inspector is None else inspector.zip
+    try:
         for name in zf.namelist():
             if name.endswith('libcrypto.so') or name.endswith('libssl.so'):
                 lib = zf.open(name)
@@ -652,10 +1053,13 @@ def has_known_vulnerability(filename):
                                     .format(apkfilename=filename, name=name))
                     found_vuln = True
                 files_in_apk.add(name)
+    finally:
+        if inspector is None:
+            zf.close()
     return found_vuln
 
 
-def insert_obbs(repodir, apps, apks):
+def insert_obbs(repodir, apps, apks, packageindex=None):
     """Scans the .obb files in a given repo directory and adds them to the
     relevant APK instances.  OBB files have versionCodes like APK
     files, and they are loosely associated.  If there is an OBB file
@@ -668,6 +1072,7 @@ def insert_obbs(repodir, apps, apks):
     :param repodir: repo directory to scan
     :param apps: list of current, valid apps
     :param apks: current information on all APKs
+    :param packageindex: common.PackageIndex of apks, made if None
 
     """
 
@@ -677,6 +1082,8 @@ def insert_obbs(repodir, apps, apks):
             logging.error(_("Deleting unknown file: {path}").format(path=f))
             os.remove(f)
 
+    if packageindex is None:
+        packageindex = common.PackageIndex(apks)
     obbs = []
     java_Integer_MIN_VALUE = -pow(2, 31)
     currentPackageNames = apps.keys()
@@ -698,8 +1105,8 @@ def insert_obbs(repodir, apps, apks):
         if packagename not in currentPackageNames:
             obbWarnDelete(f, _("OBB's packagename does not match a supported APK:"))
             continue
-        for apk in apks:
-            if packagename == apk['packageName'] and apk['versionCode'] > highestVersionCode:
+        for apk in packageindex.get(packagename):
+            if apk['versionCode'] > highestVersionCode:
                 highestVersionCode = apk['versionCode']
         if versionCode > highestVersionCode:
             obbWarnDelete(f, _('OBB file has newer versionCode({integer}) than any APK:')
@@ -708,20 +1115,24 @@ def insert_obbs(repodir, apps, apks):
         obbsha256 = sha256sum(f)
         obbs.append((packagename, versionCode, obbfile, obbsha256))
 
-    for apk in apks:
-        for (packagename, versionCode, obbfile, obbsha256) in sorted(obbs, reverse=True):
-            if versionCode <= apk['versionCode'] and packagename == apk['packageName']:
-                if obbfile.startswith('main.') and 'obbMainFile' not in apk:
-                    apk['obbMainFile'] = obbfile
-                    apk['obbMainFileSha256'] = obbsha256
-                elif obbfile.startswith('patch.') and 'obbPatchFile' not in apk:
-                    apk['obbPatchFile'] = obbfile
-                    apk['obbPatchFileSha256'] = obbsha256
-            if 'obbMainFile' in apk and 'obbPatchFile' in apk:
-                break
-
-
-def translate_per_build_anti_features(apps, apks):
+    obbsbypackage = collections.OrderedDict()
+    for (packagename, versionCode, obbfile, obbsha256) in sorted(obbs, reverse=True):
+        obbsbypackage.setdefault(packagename, []).append((versionCode, obbfile, obbsha256))
+    for packagename, packageobbs in obbsbypackage.items():
+        for apk in packageindex.get(packagename):
+            for (versionCode, obbfile, obbsha256) in packageobbs:
+                if versionCode <= apk['versionCode']:
+                    if obbfile.startswith('main.') and 'obbMainFile' not in apk:
+                        apk['obbMainFile'] = obbfile
+                        apk['obbMainFileSha256'] = obbsha256
+                    elif obbfile.startswith('patch.') and 'obbPatchFile' not in apk:
+                        apk['obbPatchFile'] = obbfile
+                        apk['obbPatchFileSha256'] = obbsha256
+                if 'obbMainFile' in apk and 'obbPatchFile' in apk:
+                    break
+
+
+def translate_per_build_anti_features(apps, apks, packageindex=None):
     """Grab the anti-features list from the build metadata
 
     For most Anti-Features, they are really most applicable per-APK,
@@ -737,21 +1148,16 @@ def translate_per_build_anti_features(apps, apks):
 
     """
 
-    antiFeatures = dict()
+    if packageindex is None:
+        packageindex = common.PackageIndex(apks)
     for packageName, app in apps.items():
         d = dict()
         for build in app['builds']:
             afl = build.get('antifeatures')
             if afl:
                 d[int(build.versionCode)] = afl
-        if len(d) > 0:
-            antiFeatures[packageName] = d
-
-    for apk in apks:
-        d = antiFeatures.get(apk['packageName'])
-        if d:
-            afl = d.get(apk['versionCode'])
-            if afl:
+        for versionCode, afl in d.items():
+            for apk in packageindex.get_version(packageName, versionCode):
                 apk['antiFeatures'].update(afl)
 
 
@@ -1270,20 +1676,22 @@ def scan_repo_files(apkcache, repodir, knownapks, use_date_from_file=False):
             raise FDroidException(_('{path} is zero size!')
                                   .format(path=filename))
 
-        shasum = sha256sum(filename)
+        filestat = get_file_stat(filename)
         usecache = False
         if name_utf8 in apkcache:
             repo_file = apkcache[name_utf8]
-            if repo_file.get('hash') == shasum:
+            usecache, statchanged = is_cache_entry_current(apkcache, name_utf8, filename, filestat)
+            cachechanged = cachechanged or statchanged
+            if usecache:
                 logging.debug(_("Reading {apkfilename} from cache")
                               .format(apkfilename=name_utf8))
-                usecache = True
             else:
                 logging.debug(_("Ignoring stale cache data for {apkfilename}")
                               .format(apkfilename=name_utf8))
 
         if not usecache:
             logging.debug(_("Processing {apkfilename}").format(apkfilename=name_utf8))
+            shasum = sha256sum(filename)
             repo_file = collections.OrderedDict()
             repo_file['name'] = os.path.splitext(name_utf8)[0]
             # TODO rename apkname globally to something more generic
@@ -1305,6 +1713,7 @@ def scan_repo_files(apkcache, repodir, knownapks, use_date_from_file=False):
             repo_file['size'] = stat.st_size
 
             apkcache[name_utf8] = repo_file
+            set_cached_file_stat(apkcache, name_utf8, filestat)
             cachechanged = True
 
         if use_date_from_file:
@@ -1324,18 +1733,21 @@ def scan_repo_files(apkcache, repodir, knownapks, use_date_from_file=False):
     return repo_files, cachechanged
 
 
-def scan_apk(apk_file):
+def scan_apk(apk_file, inspector=None):
     """
     Scans an APK file and returns dictionary with metadata of the APK.
 
     Attention: This does *not* verify that the APK signature is correct.
 
     :param apk_file: The (ideally absolute) path to the APK file
+    :param inspector: the common.ApkInspector of apk_file, if there already is one
     :raises BuildException
     :return A dict containing APK metadata
     """
+    if inspector is None:
+        inspector = common.ApkInspector(apk_file)
     apk = {
-        'hash': sha256sum(apk_file),
+        'hash': inspector.sha256,
         'hashType': 'sha256',
         'uses-permission': [],
         'uses-permission-sdk-23': [],
@@ -1346,9 +1758,9 @@ def scan_apk(apk_file):
     }
 
     if common.use_androguard():
-        scan_apk_androguard(apk, apk_file)
+        scan_apk_androguard(apk, apk_file, inspector)
     else:
-        scan_apk_aapt(apk, apk_file)
+        scan_apk_aapt(apk, apk_file, inspector)
 
     if not common.is_valid_package_name(apk['packageName']):
         raise BuildException(_("{appid} from {path} is not a valid Java Package Name!")
@@ -1359,29 +1771,27 @@ def scan_apk(apk_file):
 
     # Get the signature, or rather the signing key fingerprints
     logging.debug('Getting signature of {0}'.format(os.path.basename(apk_file)))
-    apk['sig'] = getsig(apk_file)
+    cert_encoded = inspector.get_first_signer_certificate()
+    apk['sig'] = getsig_from_certificate(cert_encoded)
     if not apk['sig']:
         raise BuildException("Failed to get apk signature")
-    apk['signer'] = common.apk_signer_fingerprint(os.path.join(os.getcwd(),
-                                                               apk_file))
-    if not apk.get('signer'):
-        raise BuildException("Failed to get apk signing key fingerprint")
+    apk['signer'] = common.signer_fingerprint(cert_encoded)
 
     # Get size of the APK
-    apk['size'] = os.path.getsize(apk_file)
+    apk['size'] = inspector.size
 
     if 'minSdkVersion' not in apk:
         logging.warning("No SDK version information found in {0}".format(apk_file))
         apk['minSdkVersion'] = 3  # aapt defaults to 3 as the min
 
     # Check for known vulnerabilities
-    if has_known_vulnerability(apk_file):
+    if has_known_vulnerability(apk_file, inspector):
         apk['antiFeatures'].add('KnownVuln')
 
     return apk
 
 
-def _get_apk_icons_src(apkfile, icon_name):
+def _get_apk_icons_src(apkfile, icon_name, inspector=None):
     """Extract the paths to the app icon in all available densities
 
     The folder name is normally generated by the Android Tools, but
@@ -1390,24 +1800,28 @@ def _get_apk_icons_src(apkfile, icon_name):
     too.
 
     """
+    if inspector is None:
+        with zipfile.ZipFile(apkfile) as zf:
+            namelist = zf.namelist()
+    else:
+        namelist = inspector.namelist()
     icons_src = dict()
     density_re = re.compile(r'^res/(.*)/{}\.(png|xml)$'.format(icon_name))
-    with zipfile.ZipFile(apkfile) as zf:
-        for filename in zf.namelist():
-            m = density_re.match(filename)
-            if m:
-                folder = m.group(1).split('-')
-                try:
-                    density = screen_resolutions[folder[1]]
-                except Exception:
-                    density = '160'
-                icons_src[density] = m.group(0)
+    for filename in namelist:
+        m = density_re.match(filename)
+        if m:
+            folder = m.group(1).split('-')
+            try:
+                density = screen_resolutions[folder[1]]
+            except Exception:
+                density = '160'
+            icons_src[density] = m.group(0)
     if icons_src.get('-1') is None and '160' in icons_src:
         icons_src['-1'] = icons_src['160']
     return icons_src
 
 
-def scan_apk_aapt(apk, apkfile):
+def scan_apk_aapt(apk, apkfile, inspector=None):
     p = SdkToolsPopen(['aapt', 'dump', 'badging', apkfile], output=False)
     if p.returncode != 0:
         if options.delete_unknown:
@@ -1481,7 +1895,7 @@ def scan_apk_aapt(apk, apkfile):
                 if feature.startswith("android.feature."):
                     feature = feature[16:]
                 apk['features'].add(feature)
-    apk['icons_src'] = _get_apk_icons_src(apkfile, icon_name)
+    apk['icons_src'] = _get_apk_icons_src(apkfile, icon_name, inspector)
 
 
 def _sanitize_sdk_version(value):
@@ -1505,10 +1919,13 @@ def _sanitize_sdk_version(value):
     return None
 
 
-def scan_apk_androguard(apk, apkfile):
+def scan_apk_androguard(apk, apkfile, inspector=None):
     try:
-        from androguard.core.bytecodes.apk import APK
-        apkobject = APK(apkfile)
+        if inspector is None:
+            from androguard.core.bytecodes.apk import APK
+            apkobject = APK(apkfile)
+        else:
+            apkobject = inspector.get_androguard_apk()
         if apkobject.is_valid_APK():
             arsc = apkobject.get_android_resources()
         else:
@@ -1574,7 +1991,7 @@ def scan_apk_androguard(apk, apkfile):
         else:
             # don't use 'anydpi' aka 0xFFFE aka 65534 since it is XML
             icon_name = os.path.splitext(os.path.basename(apkobject.get_app_icon(max_dpi=65534 - 1)))[0]
-        apk['icons_src'] = _get_apk_icons_src(apkfile, icon_name)
+        apk['icons_src'] = _get_apk_icons_src(apkfile, icon_name, inspector)
 
     arch_re = re.compile("^lib/(.*)/.*$")
     arch = set([arch_re.match(file).group(1) for file in apkobject.get_files() if arch_re.match(file)])
@@ -1641,124 +2058,303 @@ def process_apk(apkcache, apkfilename, repodir, knownapks, use_date_from_apk=Fal
      apk is the scanned apk information, and cachechanged is True if the apkcache got changed.
     """
 
-    apk = {}
-    apkfile = os.path.join(repodir, apkfilename)
+    filestat = get_file_stat(os.path.join(repodir, apkfilename))
+    apk, cachechanged = get_cached_apk(apkcache, apkfilename, repodir, filestat,
+                                       allow_disabled_algorithms)
+    if apk is not None:
+        return False, apk, cachechanged
 
-    cachechanged = False
-    usecache = False
-    if apkfilename in apkcache:
-        apk = apkcache[apkfilename]
-        if apk.get('hash') == sha256sum(apkfile):
-            logging.debug(_("Reading {apkfilename} from cache")
-                          .format(apkfilename=apkfilename))
-            usecache = True
-        else:
-            logging.debug(_("Ignoring stale cache data for {apkfilename}")
-                          .format(apkfilename=apkfilename))
+    skip, apk, default_date_param = scan_new_apk(apkfilename, repodir, use_date_from_apk,
+                                                 allow_disabled_algorithms, archive_bad_sig)
+    if skip:
+        return True, None, False
+    record_new_apk(apkcache, knownapks, apk, default_date_param, filestat,
+                   get_apkcache_field_versions())
+    return False, apk, True
+
+
+def get_cached_apk(apkcache, apkfilename, repodir, filestat, allow_disabled_algorithms=False):
+    """Get the cached entry for an APK if it is still valid
 
-    if not usecache:
-        logging.debug(_("Processing {apkfilename}").format(apkfilename=apkfilename))
+    Fields that were made by an older version of the code are made
+    again from the APK, see upgrade_cached_apk().
 
+    :returns: (apk, cachechanged) where apk is None if there is no
+     valid cache entry, and cachechanged is True if the apkcache got changed.
+    """
+    if apkfilename in apkcache:
+        current, cachechanged = is_cache_entry_current(apkcache, apkfilename,
+                                                       os.path.join(repodir, apkfilename),
+                                                       filestat)
+        if current:
+            apk = apkcache[apkfilename]
+            versions = get_apkcache_field_versions()
+            cached_versions = get_cached_field_versions(apkcache, apkfilename)
+            if cached_versions == versions \
+               and not relies_on_disabled_algorithms(apk, repodir, allow_disabled_algorithms):
+                logging.debug(_("Reading {apkfilename} from cache")
+                              .format(apkfilename=apkfilename))
+                return apk, cachechanged
+            apk = upgrade_cached_apk(apk, repodir, cached_versions, versions,
+                                     allow_disabled_algorithms)
+            if apk is not None:
+                apkcache[apkfilename] = apk
+                set_cached_field_versions(apkcache, apkfilename, versions)
+                return apk, True
+        logging.debug(_("Ignoring stale cache data for {apkfilename}")
+                      .format(apkfilename=apkfilename))
+    return None, False
+
+
+def upgrade_cached_apk(apk, repodir, cached_versions, versions, allow_disabled_algorithms=False):
+    """Make the outdated fields of a cached APK entry again
+
+    This only redoes the parts of scan_new_apk() whose version in
+    APKCACHE_FIELD_VERSIONS changed, so bumping one of them does not
+    mean hashing and verifying every APK in the repo again.  The
+    signature is only verified again if the code that does it changed,
+    or if it relied on disabled algorithms that are no longer allowed.
+
+    :param apk: the cached entry
+    :param cached_versions: the field versions the entry was made with
+    :param versions: the current field versions, see get_apkcache_field_versions()
+    :returns: the updated copy of the entry, or None if the APK needs
+     to be scanned like a new one.
+    """
+    outdated = [k for k, v in versions.items() if cached_versions.get(k) != v]
+    if 'signature' not in outdated \
+       and relies_on_disabled_algorithms(apk, repodir, allow_disabled_algorithms):
+        outdated.append('signature')
+    apk = copy.deepcopy(apk)
+    apkfile = os.path.join(repodir, apk['apkName'])
+    logging.debug(_("Updating {fields} of {apkfilename} in cache")
+                  .format(fields=', '.join(outdated), apkfilename=apk['apkName']))
+
+    inspector = None
+
+    def get_inspector():
+        nonlocal inspector
+        if inspector is None:
+            inspector = common.ApkInspector(apkfile)
+        return inspector
+
+    if 'manifest' in outdated:
+        scanned = {
+            'uses-permission': [],
+            'uses-permission-sdk-23': [],
+            'features': [],
+            'icons_src': {},
+            'icons': {},
+            'antiFeatures': set(),
+        }
         try:
-            apk = scan_apk(apkfile)
+            if common.use_androguard():
+                scan_apk_androguard(scanned, apkfile, get_inspector())
+            else:
+                scan_apk_aapt(scanned, apkfile, get_inspector())
         except BuildException:
-            logging.warning(_("Skipping '{apkfilename}' with invalid signature!")
-                            .format(apkfilename=apkfilename))
-            return True, None, False
-
-        # Check for debuggable apks...
-        if common.is_apk_and_debuggable(apkfile):
-            logging.warning('{0} is set to android:debuggable="true"'.format(apkfile))
-
-        if options.rename_apks:
-            n = apk['packageName'] + '_' + str(apk['versionCode']) + '.apk'
-            std_short_name = os.path.join(repodir, n)
-            if apkfile != std_short_name:
-                if os.path.exists(std_short_name):
-                    std_long_name = std_short_name.replace('.apk', '_' + apk['sig'][:7] + '.apk')
-                    if apkfile != std_long_name:
-                        if os.path.exists(std_long_name):
-                            dupdir = os.path.join('duplicates', repodir)
-                            if not os.path.isdir(dupdir):
-                                os.makedirs(dupdir, exist_ok=True)
-                            dupfile = os.path.join('duplicates', std_long_name)
-                            logging.warning('Moving duplicate ' + std_long_name + ' to ' + dupfile)
-                            os.rename(apkfile, dupfile)
-                            return True, None, False
-                        else:
-                            os.rename(apkfile, std_long_name)
-                    apkfile = std_long_name
-                else:
-                    os.rename(apkfile, std_short_name)
-                    apkfile = std_short_name
-                apkfilename = apkfile[len(repodir) + 1:]
-
-        apk['apkName'] = apkfilename
-        srcfilename = apkfilename[:-4] + "_src.tar.gz"
-        if os.path.exists(os.path.join(repodir, srcfilename)):
-            apk['srcname'] = srcfilename
-
-        # verify the jar signature is correct, allow deprecated
-        # algorithms only if the APK is in the archive.
-        skipapk = False
-        if not common.verify_apk_signature(apkfile):
-            if repodir == 'archive' or allow_disabled_algorithms:
-                if common.verify_old_apk_signature(apkfile):
-                    apk['antiFeatures'].update(['KnownVuln', 'DisabledAlgorithm'])
-                else:
-                    skipapk = True
+            return None
+        for field in APKCACHE_MANIFEST_FIELDS:
+            if field in scanned:
+                apk[field] = scanned[field]
             else:
-                skipapk = True
+                apk.pop(field, None)
+        if 'minSdkVersion' not in apk:
+            apk['minSdkVersion'] = 3  # aapt defaults to 3 as the min
+
+    if 'signer' in outdated:
+        cert_encoded = get_inspector().get_first_signer_certificate()
+        apk['sig'] = getsig_from_certificate(cert_encoded)
+        if not apk['sig']:
+            return None
+        apk['signer'] = common.signer_fingerprint(cert_encoded)
+
+    if 'signature' in outdated:
+        if 'DisabledAlgorithm' in apk['antiFeatures']:
+            apk['antiFeatures'].difference_update(['KnownVuln', 'DisabledAlgorithm'])
+            if 'vulnerabilities' not in outdated:
+                outdated.append('vulnerabilities')
+        if not check_apk_signature(apk, apkfile, repodir, allow_disabled_algorithms):
+            return None
+
+    if 'vulnerabilities' in outdated:
+        if has_known_vulnerability(apkfile, get_inspector()):
+            apk['antiFeatures'].add('KnownVuln')
+        elif 'DisabledAlgorithm' not in apk['antiFeatures']:
+            apk['antiFeatures'].discard('KnownVuln')
+
+    if 'icons' in outdated or 'manifest' in outdated:
+        apk['icons'] = {}
+        apk.pop('icon', None)
+        iconfilename = "%s.%s" % (apk['packageName'], apk['versionCode'])
+        empty_densities = extract_apk_icons(iconfilename, apk, get_inspector().zip, repodir)
+        fill_missing_icon_densities(empty_densities, iconfilename, apk, repodir)
 
-        if skipapk:
-            if archive_bad_sig:
-                logging.warning(_('Archiving {apkfilename} with invalid signature!')
-                                .format(apkfilename=apkfilename))
-                move_apk_between_sections(repodir, 'archive', apk)
-            else:
-                logging.warning(_('Skipping {apkfilename} with invalid signature!')
-                                .format(apkfilename=apkfilename))
-            return True, None, False
+    return apk
 
-        apkzip = zipfile.ZipFile(apkfile, 'r')
 
-        manifest = apkzip.getinfo('AndroidManifest.xml')
-        # 1980-0-0 means zeroed out, any other invalid date should trigger a warning
-        if (1980, 0, 0) != manifest.date_time[0:3]:
-            try:
-                common.check_system_clock(datetime(*manifest.date_time), apkfilename)
-            except ValueError as e:
-                logging.warning(_("{apkfilename}'s AndroidManifest.xml has a bad date: ")
-                                .format(apkfilename=apkfile) + str(e))
+def record_new_apk(apkcache, knownapks, apk, default_date_param, filestat, versions):
+    """Add a freshly scanned APK to the apkcache and KnownApks
 
-        # extract icons from APK zip file
-        iconfilename = "%s.%s" % (apk['packageName'], apk['versionCode'])
-        try:
-            empty_densities = extract_apk_icons(iconfilename, apk, apkzip, repodir)
-        finally:
-            apkzip.close()  # ensure that APK zip file gets closed
+    This is kept separate from the scanning so that the results of
+    parallel workers can be merged in a single, deterministic order.
 
-        # resize existing icons for densities missing in the APK
-        fill_missing_icon_densities(empty_densities, iconfilename, apk, repodir)
+    :param versions: the field versions it was scanned with, see
+     get_apkcache_field_versions()
+    """
+    added = knownapks.recordapk(apk['apkName'], apk['packageName'],
+                                default_date=default_date_param)
+    if added:
+        apk['added'] = added
+    apkcache[apk['apkName']] = apk
+    set_cached_file_stat(apkcache, apk['apkName'], filestat)
+    set_cached_field_versions(apkcache, apk['apkName'], versions)
+
+
+def scan_new_apk(apkfilename, repodir, use_date_from_apk=False,
+                 allow_disabled_algorithms=False, archive_bad_sig=False, icon_repodir=None):
+    """Scan, verify and extract the icons of an APK that is not in the cache
 
-        if use_date_from_apk and manifest.date_time[1] != 0:
-            default_date_param = datetime(*manifest.date_time)
+    This does not touch any shared state like the apkcache or
+    KnownApks, so it can be run in a worker process.
+
+    :param icon_repodir: the directory to extract the icons into,
+                         instead of the icon dirs in repodir
+
+    :returns: (skip, apk, default_date_param) where skip is a boolean
+     indicating whether to skip this apk, apk is the scanned apk
+     information, and default_date_param is the date to record for it
+     in KnownApks.
+    """
+    apkfile = os.path.join(repodir, apkfilename)
+    if icon_repodir is None:
+        icon_repodir = repodir
+    logging.debug(_("Processing {apkfilename}").format(apkfilename=apkfilename))
+
+    try:
+        inspector = common.ApkInspector(apkfile)
+        apk = scan_apk(apkfile, inspector)
+    except BuildException:
+        logging.warning(_("Skipping '{apkfilename}' with invalid signature!")
+                        .format(apkfilename=apkfilename))
+        return True, None, None
+
+    # Check for debuggable apks...
+    if inspector.is_debuggable():
+        logging.warning('{0} is set to android:debuggable="true"'.format(apkfile))
+
+    if options.rename_apks:
+        n = apk['packageName'] + '_' + str(apk['versionCode']) + '.apk'
+        std_short_name = os.path.join(repodir, n)
+        if apkfile != std_short_name:
+            if os.path.exists(std_short_name):
+                std_long_name = std_short_name.replace('.apk', '_' + apk['sig'][:7] + '.apk')
+                if apkfile != std_long_name:
+                    if os.path.exists(std_long_name):
+                        dupdir = os.path.join('duplicates', repodir)
+                        if not os.path.isdir(dupdir):
+                            os.makedirs(dupdir, exist_ok=True)
+                        dupfile = os.path.join('duplicates', std_long_name)
+                        logging.warning('Moving duplicate ' + std_long_name + ' to ' + dupfile)
+                        os.rename(apkfile, dupfile)
+                        return True, None, None
+                    else:
+                        os.rename(apkfile, std_long_name)
+                apkfile = std_long_name
+            else:
+                os.rename(apkfile, std_short_name)
+                apkfile = std_short_name
+            apkfilename = apkfile[len(repodir) + 1:]
+
+    apk['apkName'] = apkfilename
+    srcfilename = apkfilename[:-4] + "_src.tar.gz"
+    if os.path.exists(os.path.join(repodir, srcfilename)):
+        apk['srcname'] = srcfilename
+
+    if not check_apk_signature(apk, apkfile, repodir, allow_disabled_algorithms):
+        if archive_bad_sig:
+            logging.warning(_('Archiving {apkfilename} with invalid signature!')
+                            .format(apkfilename=apkfilename))
+            move_apk_between_sections(repodir, 'archive', apk)
         else:
-            default_date_param = None
+            logging.warning(_('Skipping {apkfilename} with invalid signature!')
+                            .format(apkfilename=apkfilename))
+        return True, None, None
 
-        # Record in known apks, getting the added date at the same time..
-        added = knownapks.recordapk(apk['apkName'], apk['packageName'],
-                                    default_date=default_date_param)
-        if added:
-            apk['added'] = added
+    manifest = inspector.zip.getinfo('AndroidManifest.xml')
+    # 1980-0-0 means zeroed out, any other invalid date should trigger a warning
+    if (1980, 0, 0) != manifest.date_time[0:3]:
+        try:
+            common.check_system_clock(datetime(*manifest.date_time), apkfilename)
+        except ValueError as e:
+            logging.warning(_("{apkfilename}'s AndroidManifest.xml has a bad date: ")
+                            .format(apkfilename=apkfile) + str(e))
+
+    # extract icons from APK zip file
+    iconfilename = "%s.%s" % (apk['packageName'], apk['versionCode'])
+    empty_densities = extract_apk_icons(iconfilename, apk, inspector.zip, icon_repodir)
+
+    # resize existing icons for densities missing in the APK
+    fill_missing_icon_densities(empty_densities, iconfilename, apk, icon_repodir)
+
+    if use_date_from_apk and manifest.date_time[1] != 0:
+        default_date_param = datetime(*manifest.date_time)
+    else:
+        default_date_param = None
+
+    return False, apk, default_date_param
+
+
+def check_apk_signature(apk, apkfile, repodir, allow_disabled_algorithms=False):
+    """Verify the signature of a scanned APK
 
-        apkcache[apkfilename] = apk
-        cachechanged = True
+    Deprecated algorithms are only allowed if the APK is in the
+    archive, or allow_disabled_algorithms is set, and then the APK
+    gets marked with the 'KnownVuln' and 'DisabledAlgorithm'
+    anti-features.
 
-    return False, apk, cachechanged
+    :returns: True if the signature is valid
+    """
+    if common.verify_apk_signature(apkfile):
+        return True
+    if repodir == 'archive' or allow_disabled_algorithms:
+        if common.verify_old_apk_signature(apkfile):
+            apk['antiFeatures'].update(['KnownVuln', 'DisabledAlgorithm'])
+            return True
+    return False
+
+
+def _scan_new_apk_worker(args):
+    """Run scan_new_apk() in a pool worker
+
+    Two APKs with the same packageName and versionCode write the same
+    icon files, so each worker extracts the icons into its own staging
+    dir.  The coordinator then moves them into the repo in filename
+    order, just like the serial run overwrites them.  The staging dirs
+    are in tmp/, on the same filesystem as the repo, so that moving
+    the icons is only a rename.
+    """
+    os.makedirs('tmp', exist_ok=True)
+    stagingdir = tempfile.mkdtemp(prefix='update-icons-', dir='tmp')
+    try:
+        for icon_dir in get_all_icon_dirs(stagingdir):
+            os.makedirs(icon_dir, exist_ok=True)
+        return scan_new_apk(*args, icon_repodir=stagingdir) + (stagingdir, )
+    except BaseException:
+        shutil.rmtree(stagingdir, ignore_errors=True)
+        raise
+
+
+def _move_staged_icons(stagingdir, repodir):
+    """Move the icons extracted by _scan_new_apk_worker() into the repo"""
+    for density in all_screen_densities:
+        staged_dir = get_icon_dir(stagingdir, density)
+        icon_dir = get_icon_dir(repodir, density)
+        for f in sorted(os.listdir(staged_dir)):
+            shutil.move(os.path.join(staged_dir, f), os.path.join(icon_dir, f))
 
 
-def process_apks(apkcache, repodir, knownapks, use_date_from_apk=False):
+def process_apks(apkcache, repodir, knownapks, use_date_from_apk=False, jobs=1):
     """Processes the apks in the given repo directory.
 
     This also extracts the icons.
@@ -1768,6 +2364,9 @@ def process_apks(apkcache, repodir, knownapks, use_date_from_apk=False):
     :param knownapks: known apks info
     :param use_date_from_apk: use date from APK (instead of current date)
                               for newly added APKs
+    :param jobs: number of worker processes to scan new APKs with.  The
+                 results are merged in filename order, so the outcome is
+                 the same as scanning them one at a time.
     :returns: (apks, cachechanged) where apks is a list of apk information,
               and cachechanged is True if the apkcache got changed.
     """
@@ -1782,16 +2381,67 @@ def process_apks(apkcache, repodir, knownapks, use_date_from_apk=False):
         else:
             os.makedirs(icon_dir)
 
-    apks = []
-    for apkfile in sorted(glob.glob(os.path.join(repodir, '*.apk'))):
-        apkfilename = apkfile[len(repodir) + 1:]
-        ada = disabled_algorithms_allowed()
-        (skip, apk, cachethis) = process_apk(apkcache, apkfilename, repodir, knownapks,
-                                             use_date_from_apk, ada, True)
-        if skip:
-            continue
-        apks.append(apk)
+    apkfilenames = [apkfile[len(repodir) + 1:]
+                    for apkfile in sorted(glob.glob(os.path.join(repodir, '*.apk')))]
+    ada = disabled_algorithms_allowed()
+
+    if jobs > 1 and options.rename_apks:
+        # renaming can make two APKs race for the same file name
+        logging.warning(_('--rename-apks cannot be run in parallel, using a single job'))
+        jobs = 1
+    if jobs > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        logging.warning(_('Parallel APK processing is not supported on this platform, using a single job'))
+        jobs = 1
+
+    if jobs <= 1:
+        apks = []
+        for apkfilename in apkfilenames:
+            (skip, apk, cachethis) = process_apk(apkcache, apkfilename, repodir, knownapks,
+                                                 use_date_from_apk, ada, True)
+            if skip:
+                continue
+            apks.append(apk)
+            cachechanged = cachechanged or cachethis
+        return apks, cachechanged
+
+    cached = dict()
+    filestats = dict()
+    for apkfilename in apkfilenames:
+        filestats[apkfilename] = get_file_stat(os.path.join(repodir, apkfilename))
+        apk, cachethis = get_cached_apk(apkcache, apkfilename, repodir, filestats[apkfilename], ada)
+        if apk is not None:
+            cached[apkfilename] = apk
         cachechanged = cachechanged or cachethis
+    uncached = [f for f in apkfilenames if f not in cached]
+
+    scanned = dict()
+    apks = []
+    try:
+        if uncached:
+            logging.info(_('Processing {count} APKs with {jobs} jobs')
+                         .format(count=len(uncached), jobs=jobs))
+            # fork so that the workers inherit config, options and logging setup
+            with multiprocessing.get_context('fork').Pool(jobs) as pool:
+                results = pool.imap(_scan_new_apk_worker,
+                                    [(f, repodir, use_date_from_apk, ada, True) for f in uncached])
+                for apkfilename, result in zip(uncached, results):
+                    scanned[apkfilename] = result
+
+        for apkfilename in apkfilenames:
+            if apkfilename in cached:
+                apks.append(cached[apkfilename])
+                continue
+            skip, apk, default_date_param, stagingdir = scanned[apkfilename]
+            if skip:
+                continue
+            _move_staged_icons(stagingdir, repodir)
+            record_new_apk(apkcache, knownapks, apk, default_date_param, filestats[apkfilename],
+                           get_apkcache_field_versions())
+            apks.append(apk)
+            cachechanged = True
+    finally:
+        for result in scanned.values():
+            shutil.rmtree(result[-1], ignore_errors=True)
 
     return apks, cachechanged
 
@@ -1955,28 +2605,31 @@ def fill_missing_icon_densities(empty_densities, icon_filename, apk, repo_dir):
         shutil.copyfile(baseline, os.path.join(get_icon_dir(repo_dir, '0'), icon_filename))
 
 
-def apply_info_from_latest_apk(apps, apks):
+def apply_info_from_latest_apk(apps, apks, packageindex=None):
     """
     Some information from the apks needs to be applied up to the application level.
     When doing this, we use the info from the most recent version's apk.
     We deal with figuring out when the app was added and last updated at the same time.
+
+    :param packageindex: common.PackageIndex of apks, made if None
     """
+    if packageindex is None:
+        packageindex = common.PackageIndex(apks)
     for appid, app in apps.items():
         bestver = UNSET_VERSION_CODE
-        for apk in apks:
-            if apk['packageName'] == appid:
-                if apk['versionCode'] > bestver:
-                    bestver = apk['versionCode']
-                    bestapk = apk
+        for apk in packageindex.get(appid):
+            if apk['versionCode'] > bestver:
+                bestver = apk['versionCode']
+                bestapk = apk
 
-                if app.NoSourceSince:
-                    apk['antiFeatures'].add('NoSourceSince')
+            if app.NoSourceSince:
+                apk['antiFeatures'].add('NoSourceSince')
 
-                if 'added' in apk:
-                    if not app.added or apk['added'] < app.added:
-                        app.added = apk['added']
-                    if not app.lastUpdated or apk['added'] > app.lastUpdated:
-                        app.lastUpdated = apk['added']
+            if 'added' in apk:
+                if not app.added or apk['added'] < app.added:
+                    app.added = apk['added']
+                if not app.lastUpdated or apk['added'] > app.lastUpdated:
+                    app.lastUpdated = apk['added']
 
         if not app.added:
             logging.debug("Don't know when " + appid + " was added")
@@ -2006,17 +2659,28 @@ def make_categories_txt(repodir, categories):
         f.write(catdata)
 
 
-def archive_old_apks(apps, apks, archapks, repodir, archivedir, defaultkeepversions):
+def get_archive_plan(apps, apks, archapks, repodir, archivedir, defaultkeepversions,
+                     packageindex=None):
+    """Work out which APKs to move to follow the ArchivePolicy of each app
+
+    The APKs of each app are looked up in the PackageIndex, so this is
+    linear in the number of APKs.  Nothing is changed.
+
+    :param packageindex: common.PackageIndex of apks in the repodir
+                         section and archapks in the archivedir section,
+                         made if None
+    :returns: a list of (apk, from_dir, to_dir) tuples in the order the
+              moves should be made
+    """
 
     def filter_apk_list_sorted(apk_list):
         res = []
         currentVersionApk = None
         for apk in apk_list:
-            if apk['packageName'] == appid:
-                if apk['versionCode'] == common.version_code_string_to_int(app.CurrentVersionCode):
-                    currentVersionApk = apk
-                    continue
-                res.append(apk)
+            if apk['versionCode'] == common.version_code_string_to_int(app.CurrentVersionCode):
+                currentVersionApk = apk
+                continue
+            res.append(apk)
 
         # Sort the apk list by version code. First is highest/newest.
         sorted_list = sorted(res, key=lambda apk: apk['versionCode'], reverse=True)
@@ -2025,6 +2689,12 @@ def archive_old_apks(apps, apks, archapks, repodir, archivedir, defaultkeepversi
             sorted_list.insert(0, currentVersionApk)
         return sorted_list
 
+    if packageindex is None:
+        packageindex = common.PackageIndex(apks, repodir)
+        packageindex.update(archapks, archivedir)
+    repoindex = packageindex.section(repodir)
+
+    plan = []
     for appid, app in apps.items():
 
         if app.ArchivePolicy:
@@ -2035,28 +2705,54 @@ def archive_old_apks(apps, apks, archapks, repodir, archivedir, defaultkeepversi
         logging.debug(_("Checking archiving for {appid} - apks:{integer}, keepversions:{keep}, archapks:{arch}")
                       .format(appid=appid, integer=len(apks), keep=keepversions, arch=len(archapks)))
 
-        all_app_apks = filter_apk_list_sorted(apks + archapks)
+        all_app_apks = filter_apk_list_sorted(packageindex.get(appid))
+        inrepo = set(id(apk) for apk in repoindex.get(appid))
 
         # determine which apks to keep in repo
-        keep = []
+        keep = set()
         for apk in all_app_apks:
             if len(keep) == keepversions:
                 break
             if 'antiFeatures' not in apk:
-                keep.append(apk)
+                keep.add(id(apk))
             elif 'DisabledAlgorithm' not in apk['antiFeatures'] or disabled_algorithms_allowed():
-                keep.append(apk)
+                keep.add(id(apk))
 
-        # actually move apks to the target section
         for apk in all_app_apks:
-            if apk in apks and apk not in keep:
-                apks.remove(apk)
-                archapks.append(apk)
-                move_apk_between_sections(repodir, archivedir, apk)
-            elif apk in archapks and apk in keep:
-                archapks.remove(apk)
-                apks.append(apk)
-                move_apk_between_sections(archivedir, repodir, apk)
+            if id(apk) in inrepo and id(apk) not in keep:
+                plan.append((apk, repodir, archivedir))
+            elif id(apk) not in inrepo and id(apk) in keep:
+                plan.append((apk, archivedir, repodir))
+    return plan
+
+
+def archive_old_apks(apps, apks, archapks, repodir, archivedir, defaultkeepversions,
+                     packageindex=None):
+    """Move APKs between the repo and the archive to follow the ArchivePolicy
+
+    The moves from get_archive_plan() are made in one batch, then apks
+    and archapks are each updated in a single pass.  The APKs that were
+    moved are added to the end of the list of their new section.
+
+    :param packageindex: common.PackageIndex of apks in the repodir
+                         section and archapks in the archivedir section,
+                         made if None and kept up to date with the moves
+    """
+    if packageindex is None:
+        packageindex = common.PackageIndex(apks, repodir)
+        packageindex.update(archapks, archivedir)
+    plan = get_archive_plan(apps, apks, archapks, repodir, archivedir, defaultkeepversions,
+                            packageindex)
+
+    for apk, from_dir, to_dir in plan:
+        move_apk_between_sections(from_dir, to_dir, apk)
+        packageindex.move(apk, to_dir)
+
+    moved = set(id(apk) for apk, from_dir, to_dir in plan)
+    apks[:] = ([apk for apk in apks if id(apk) not in moved]
+               + [apk for apk, from_dir, to_dir in plan if to_dir == repodir])
+    archapks[:] = ([apk for apk in archapks if id(apk) not in moved]
+                   + [apk for apk, from_dir, to_dir in plan if to_dir == archivedir])
 
 
 def move_apk_between_sections(from_dir, to_dir, apk):
@@ -2067,8 +2763,7 @@ def move_apk_between_sections(from_dir, to_dir, apk):
         if ignore_missing and not os.path.exists(from_path):
             return
         to_path = os.path.join(to_dir, filename)
-        if not os.path.exists(to_dir):
-            os.mkdir(to_dir)
+        os.makedirs(to_dir, exist_ok=True)
         shutil.move(from_path, to_path)
 
     if from_dir == to_dir:
@@ -2200,6 +2895,12 @@ def main():
                         help=_("Rename APK files that do not match package.name_123.apk"))
     parser.add_argument("--allow-disabled-algorithms", action="store_true", default=False,
                         help=_("Include APKs that are signed with disabled algorithms like MD5"))
+    parser.add_argument("--verify-hashes", action="store_true", default=False,
+                        help=_("Rehash all files instead of trusting the cache for unchanged files"))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=_("Number of processes to use for scanning new APKs"))
+    parser.add_argument("--archive-plan", action="store_true", default=False,
+                        help=_("Print the APKs that would be moved to or from the archive and exit"))
     metadata.add_metadata_arguments(parser)
     options = parser.parse_args()
     metadata.warnings_action = options.W
@@ -2258,7 +2959,7 @@ def main():
         common.genkeystore(config)
 
     # Get all apps...
-    apps = metadata.read_metadata()
+    apps = metadata.read_metadata(compact=True)
 
     # Generate a list of categories...
     categories = set()
@@ -2275,7 +2976,8 @@ def main():
     delete_disabled_builds(apps, apkcache, repodirs)
 
     # Scan all apks in the main repo
-    apks, cachechanged = process_apks(apkcache, repodirs[0], knownapks, options.use_date_from_apk)
+    apks, cachechanged = process_apks(apkcache, repodirs[0], knownapks, options.use_date_from_apk,
+                                      options.jobs)
 
     files, fcachechanged = scan_repo_files(apkcache, repodirs[0], knownapks,
                                            options.use_date_from_apk)
@@ -2285,7 +2987,7 @@ def main():
         if apk['packageName'] not in apps:
             if options.create_metadata:
                 create_metadata_from_template(apk)
-                apps = metadata.read_metadata()
+                apps = metadata.read_metadata(compact=True)
             else:
                 msg = _("{apkfilename} ({appid}) has no metadata!") \
                     .format(apkfilename=apk['apkName'], appid=apk['packageName'])
@@ -2300,28 +3002,44 @@ def main():
                 else:
                     logging.warning(msg + '\n\t' + _('Use `fdroid update -c` to create it.'))
 
+    # all the passes below look up packages in this, instead of each
+    # going through the whole list of APKs for every app
+    packageindex = common.PackageIndex(apks, repodirs[0])
+
     insert_funding_yml_donation_links(apps)
     copy_triple_t_store_metadata(apps)
-    insert_obbs(repodirs[0], apps, apks)
+    insert_obbs(repodirs[0], apps, apks, packageindex)
     insert_localized_app_metadata(apps)
-    translate_per_build_anti_features(apps, apks)
+    translate_per_build_anti_features(apps, apks, packageindex)
 
     # Scan the archive repo for apks as well
     if len(repodirs) > 1:
-        archapks, cc = process_apks(apkcache, repodirs[1], knownapks, options.use_date_from_apk)
+        archapks, cc = process_apks(apkcache, repodirs[1], knownapks, options.use_date_from_apk,
+                                    options.jobs)
         if cc:
             cachechanged = True
+        packageindex.update(archapks, repodirs[1])
     else:
         archapks = []
 
     # Apply information from latest apks to the application and update dates
-    apply_info_from_latest_apk(apps, apks + archapks)
+    apply_info_from_latest_apk(apps, apks + archapks, packageindex)
 
     # Sort the app list by name, then the web site doesn't have to by default.
     # (we had to wait until we'd scanned the apks to do this, because mostly the
     # name comes from there!)
     sortedids = sorted(apps.keys(), key=lambda appid: apps[appid].Name.upper())
 
+    if options.archive_plan:
+        if len(repodirs) > 1:
+            plan = get_archive_plan(apps, apks, archapks, repodirs[0], repodirs[1],
+                                    config['archive_older'], packageindex)
+            for apk, from_dir, to_dir in plan:
+                print(os.path.join(from_dir, apk['apkName']) + ' -> ' + os.path.join(to_dir, apk['apkName']))
+        if cachechanged:
+            write_cache(apkcache)
+        return
+
     # APKs are placed into multiple repos based on the app package, providing
     # per-app subscription feeds for nightly builds and things like it
     if config['per_app_repos']:
@@ -2331,24 +3049,30 @@ def main():
             appdict = dict()
             appdict[appid] = app
             if os.path.isdir(repodir):
-                index.make(appdict, [appid], apks, repodir, False)
+                index.make(appdict, [appid], apks, repodir, False,
+                           packageindex.section(repodirs[0]))
             else:
                 logging.info(_('Skipping index generation for {appid}').format(appid=appid))
         return
 
     if len(repodirs) > 1:
-        archive_old_apks(apps, apks, archapks, repodirs[0], repodirs[1], config['archive_older'])
+        archive_old_apks(apps, apks, archapks, repodirs[0], repodirs[1], config['archive_older'],
+                         packageindex)
 
     # Make the index for the main repo...
-    index.make(apps, sortedids, apks, repodirs[0], False)
+    index.make(apps, sortedids, apks, repodirs[0], False, packageindex.section(repodirs[0]))
     make_categories_txt(repodirs[0], categories)
 
     # If there's an archive repo,  make the index for it. We already scanned it
     # earlier on.
     if len(repodirs) > 1:
-        archived_apps = copy.deepcopy(apps)
-        apply_info_from_latest_apk(archived_apps, archapks)
-        index.make(archived_apps, sortedids, archapks, repodirs[1], True)
+        # index.make() extends AntiFeatures in place, so that gets a copy
+        archived_apps = collections.OrderedDict()
+        for appid, app in apps.items():
+            archived_apps[appid] = metadata.AppOverlay(app, {'AntiFeatures': list(app.AntiFeatures)})
+        archpackageindex = packageindex.section(repodirs[1])
+        apply_info_from_latest_apk(archived_apps, archapks, archpackageindex)
+        index.make(archived_apps, sortedids, archapks, repodirs[1], True, archpackageindex)
 
     git_remote = config.get('binary_transparency_remote')
     if git_remote or os.path.isdir(os.path.join('binary_transparency', '.git')):
@@ -2379,8 +3103,8 @@ def main():
 
     # Update the wiki...
     if options.wiki:
-        update_wiki(apps, sortedids, apks + archapks)
-    status_update_json(apps, sortedids, apks + archapks)
+        update_wiki(apps, sortedids, apks + archapks, packageindex)
+    status_update_json(apps, sortedids, apks + archapks, packageindex)
 
     logging.info(_("Finished"))
 
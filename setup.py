@@ -63,6 +63,7 @@ setup(name='fdroidserver',
       url='https://f-droid.org',
       license='AGPL-3.0',
       packages=['fdroidserver', 'fdroidserver.asynchronousfilereader'],
+      package_data={'fdroidserver': ['VerifyWorker.java']},
       scripts=['fdroid', 'makebuildserver'],
       data_files=get_data_files(),
       python_requires='>=3.4',
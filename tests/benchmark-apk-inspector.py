@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+#
+# Compare the time it takes to gather the info `fdroid update` needs
+# from each APK when opening the file for each step, like before, and
+# when reading it once with common.ApkInspector.  Run it from tests/:
+#
+#   ./benchmark-apk-inspector.py [rounds] [APK...]
+
+import glob
+import logging
+import os
+import sys
+import timeit
+import zipfile
+
+localmodule = os.path.realpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+if localmodule not in sys.path:
+    sys.path.insert(0, localmodule)
+
+import fdroidserver.common  # noqa: E402
+import fdroidserver.update  # noqa: E402
+
+logging.basicConfig(level=logging.CRITICAL)
+fdroidserver.common.config = dict()
+fdroidserver.common.fill_config_defaults(fdroidserver.common.config)
+
+
+def separate_opens(apkfile):
+    fdroidserver.update.sha256sum(apkfile)
+    apkobject = fdroidserver.common._get_androguard_APK(apkfile)
+    apkobject.get_package()
+    with zipfile.ZipFile(apkfile) as zf:
+        zf.namelist()  # for _get_apk_icons_src()
+    fdroidserver.update.getsig(apkfile)
+    fdroidserver.common.apk_signer_fingerprint(apkfile)
+    fdroidserver.update.has_known_vulnerability(apkfile)
+    fdroidserver.common.is_apk_and_debuggable(apkfile)
+    with zipfile.ZipFile(apkfile) as zf:
+        zf.getinfo('AndroidManifest.xml')  # for the icons in process_apk()
+
+
+def single_open(apkfile):
+    inspector = fdroidserver.common.ApkInspector(apkfile)
+    inspector.get_androguard_apk().get_package()
+    inspector.namelist()
+    cert = inspector.get_first_signer_certificate()
+    fdroidserver.update.getsig_from_certificate(cert)
+    fdroidserver.common.signer_fingerprint(cert)
+    fdroidserver.update.has_known_vulnerability(apkfile, inspector)
+    inspector.is_debuggable()
+    inspector.zip.getinfo('AndroidManifest.xml')
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    apkfiles = sys.argv[2:] or sorted(glob.glob('repo/*.apk'))
+    if not fdroidserver.common.use_androguard():
+        print('ERROR: this benchmark requires androguard')
+        sys.exit(1)
+    print('%d APKs, %d rounds' % (len(apkfiles), rounds))
+    for f in (separate_opens, single_open):
+        seconds = min(timeit.repeat(lambda: [f(apkfile) for apkfile in apkfiles],
+                                    number=1, repeat=rounds))
+        print('%-16s %8.3f s' % (f.__name__, seconds))
+
+
+if __name__ == "__main__":
+    main()
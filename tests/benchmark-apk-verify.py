@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+#
+# Compare the time it takes to verify APK signatures when starting
+# apksigner or jarsigner for each APK, and when sending them all to a
+# single common.VerifyWorker.  The APKs are repeated until there are
+# count of them.  Run it from tests/:
+#
+#   ./benchmark-apk-verify.py [count] [APK...]
+
+import glob
+import itertools
+import logging
+import os
+import sys
+import time
+
+localmodule = os.path.realpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+if localmodule not in sys.path:
+    sys.path.insert(0, localmodule)
+
+import fdroidserver.common  # noqa: E402
+
+logging.basicConfig(level=logging.CRITICAL)
+fdroidserver.common.options = type('', (), {'verbose': False})()
+fdroidserver.common.config = dict()
+fdroidserver.common.fill_config_defaults(fdroidserver.common.config)
+
+
+def run(verify, apkfiles, use_worker):
+    fdroidserver.common.stop_verify_workers()
+    fdroidserver.common.config['verify_worker'] = use_worker
+    start = time.time()
+    results = [verify(apkfile) for apkfile in apkfiles]
+    seconds = time.time() - start
+    fdroidserver.common.stop_verify_workers()
+    return seconds, results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    apkfiles = sys.argv[2:] or sorted(glob.glob('repo/*.apk'))
+    apkfiles = list(itertools.islice(itertools.cycle(apkfiles), count))
+    if 'jarsigner' not in fdroidserver.common.config:
+        print('ERROR: this benchmark requires Java')
+        sys.exit(1)
+
+    verifiers = [('verify_old_apk_signature', 'jarsigner',
+                  fdroidserver.common.verify_old_apk_signature)]
+    if fdroidserver.common.set_command_in_config('apksigner'):
+        verifiers.append(('verify_apk_signature', 'apksigner',
+                          fdroidserver.common.verify_apk_signature))
+
+    print('%d APKs' % len(apkfiles))
+    for name, mode, verify in verifiers:
+        fdroidserver.common.config['verify_worker'] = True
+        if not fdroidserver.common._get_verify_worker(mode):
+            print('%-26s the %s worker could not be started, it needs Java 11 or newer'
+                  % (name, mode))
+            continue
+        per_call, expected = run(verify, apkfiles, False)
+        worker, results = run(verify, apkfiles, True)
+        print('%-26s per call %8.3f s   worker %8.3f s   %s'
+              % (name, per_call, worker, 'same results' if results == expected else 'DIFFERENT RESULTS'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#
+# Compare the time and memory it takes to write index.xml with
+# index.XMLStreamWriter and with a complete xml.dom.minidom Document
+# like it used to be, on a synthetic repo with count apps that have
+# three APKs each.  Run it from tests/:
+#
+#   ./benchmark-index-xml.py [count]
+
+import collections
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from xml.dom.minidom import Document
+
+localmodule = os.path.realpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+if localmodule not in sys.path:
+    sys.path.insert(0, localmodule)
+
+import fdroidserver.common  # noqa: E402
+import fdroidserver.index  # noqa: E402
+import fdroidserver.metadata  # noqa: E402
+
+logging.basicConfig(level=logging.CRITICAL)
+fdroidserver.common.config = dict()
+fdroidserver.common.fill_config_defaults(fdroidserver.common.config)
+fdroidserver.common.config['make_current_version_link'] = False
+fdroidserver.common.config['repo_icon'] = os.path.join(localmodule, 'tests', 'corrupt-featureGraphic.png')
+fdroidserver.common.config['repo_pubkey'] = '00' * 1300
+
+
+class MinidomWriter:
+    """the same API as index.XMLStreamWriter, but with a minidom Document"""
+
+    def __init__(self, fp, pretty=False):
+        self.fp = fp
+        self.pretty = pretty
+        self.doc = Document()
+        self.stack = [self.doc]
+
+    def _create(self, name, attrs):
+        el = self.doc.createElement(name)
+        for k, v in (attrs or {}).items():
+            el.setAttribute(k, v)
+        self.stack[-1].appendChild(el)
+        return el
+
+    def start(self, name, attrs=None):
+        self.stack.append(self._create(name, attrs))
+
+    def element(self, name, text=None, attrs=None):
+        el = self._create(name, attrs)
+        if text is not None:
+            el.appendChild(self.doc.createTextNode(str(text)))
+
+    def end(self):
+        self.stack.pop()
+        if len(self.stack) == 1:
+            if self.pretty:
+                output = self.doc.toprettyxml(encoding='utf-8')
+            else:
+                output = self.doc.toxml(encoding='utf-8')
+            self.fp.write(output.decode('utf-8'))
+
+
+def make_repo(count):
+    added = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    apps = collections.OrderedDict()
+    apks = []
+    for i in range(count):
+        app = fdroidserver.metadata.App()
+        app.id = 'org.example.app%d' % i
+        app.Name = 'App & Co. #%d' % i
+        app.Summary = 'A <synthetic> app for the benchmark'
+        app.Description = '<p>' + 'This is a "long" description. ' * 20 + '</p>'
+        app.License = 'GPL-3.0-or-later'
+        app.Categories = ['System', 'Development']
+        app.WebSite = 'https://example.org/%d' % i
+        app.SourceCode = 'https://example.org/%d/source' % i
+        app.IssueTracker = 'https://example.org/%d/issues' % i
+        app.CurrentVersion = '1.2'
+        app.CurrentVersionCode = '3'
+        app.added = added
+        app.lastUpdated = added
+        app.icon = app.id + '.3.png'
+        apps[app.id] = app
+        for versionCode in range(1, 4):
+            apks.append({
+                'packageName': app.id,
+                'apkName': '%s_%d.apk' % (app.id, versionCode),
+                'versionCode': versionCode,
+                'versionName': '1.%d' % (versionCode - 1),
+                'hash': '%064x' % (i * 10 + versionCode),
+                'hashType': 'sha256',
+                'sig': '%032x' % i,
+                'signer': '%064x' % i,
+                'size': 1234567,
+                'minSdkVersion': 14,
+                'targetSdkVersion': 28,
+                'added': added,
+                'uses-permission': [['android.permission.INTERNET', None],
+                                    ['android.permission.READ_EXTERNAL_STORAGE', 18],
+                                    ['android.permission.WRITE_EXTERNAL_STORAGE', None]],
+                'uses-permission-sdk-23': [],
+                'nativecode': ['arm64-v8a', 'armeabi-v7a'],
+                'features': [],
+            })
+    return apps, apks
+
+
+def run(writer, count, pretty, trace):
+    apps, apks = make_repo(count)
+    repodict = collections.OrderedDict()
+    repodict['timestamp'] = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    repodict['version'] = 21
+    repodict['name'] = 'Benchmark'
+    repodict['icon'] = 'fdroid-icon.png'
+    repodict['address'] = 'https://example.org/fdroid/repo'
+    repodict['description'] = 'Benchmark'
+    requestsdict = {'install': [], 'uninstall': []}
+    fdroidserver.common.options = type('', (), {'nosign': True, 'pretty': pretty})()
+    fdroidserver.index.XMLStreamWriter = writer
+    with tempfile.TemporaryDirectory() as repodir:
+        os.mkdir(os.path.join(repodir, 'icons'))
+        if trace:
+            tracemalloc.start()
+        start = time.time()
+        fdroidserver.index.make_v0(apps, apks, repodir, repodict, requestsdict, {})
+        seconds = time.time() - start
+        peak = 0
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        with open(os.path.join(repodir, 'index.xml'), 'rb') as fp:
+            output = fp.read()
+    return seconds, peak, output
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print('%d apps, %d APKs' % (count, count * 3))
+    streamwriter = fdroidserver.index.XMLStreamWriter
+    for pretty in (False, True):
+        results = dict()
+        for name, writer in (('minidom', MinidomWriter), ('XMLStreamWriter', streamwriter)):
+            seconds, _, output = run(writer, count, pretty, False)
+            _, peak, _ = run(writer, count, pretty, True)
+            results[name] = output
+            print('%-8s %-16s %8.3f s   peak %8.1f MiB   %d bytes'
+                  % ('pretty' if pretty else 'compact', name, seconds, peak / 1024 / 1024, len(output)))
+        print('%-8s %s' % ('', 'same output' if results['minidom'] == results['XMLStreamWriter']
+                           else 'DIFFERENT OUTPUT'))
+    fdroidserver.index.XMLStreamWriter = streamwriter
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+#
+# Compare the time it takes to run count tiny git commands through
+# common.FDroidPopen, through the old FDroidPopenBytes that polled the
+# output of the process every 0.1 seconds, and through plain
+# subprocess.run as the lower bound.  Run it from tests/:
+#
+#   ./benchmark-popen.py [count]
+
+import io
+import logging
+import os
+import subprocess
+import sys
+import time
+from queue import Queue
+
+localmodule = os.path.realpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+if localmodule not in sys.path:
+    sys.path.insert(0, localmodule)
+
+import fdroidserver.common  # noqa: E402
+from fdroidserver.asynchronousfilereader import AsynchronousFileReader  # noqa: E402
+
+logging.basicConfig(level=logging.CRITICAL)
+fdroidserver.common.options = type('', (), {'verbose': False})()
+fdroidserver.common.config = dict()
+fdroidserver.common.fill_config_defaults(fdroidserver.common.config)
+
+COMMAND = ['git', '--version']
+
+
+def polling_popen(commands):
+    """the stdout handling of FDroidPopenBytes like it used to be"""
+    p = subprocess.Popen(commands, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    stdout_queue = Queue()
+    stdout_reader = AsynchronousFileReader(p.stdout, stdout_queue)
+    buf = io.BytesIO()
+    while not stdout_reader.eof():
+        while not stdout_queue.empty():
+            buf.write(stdout_queue.get())
+        time.sleep(0.1)
+    p.wait()
+    p.stdout.close()
+    return buf.getvalue()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    print('%d x %s' % (count, ' '.join(COMMAND)))
+    expected = subprocess.check_output(COMMAND)
+    for name, run in (('subprocess.run', lambda: subprocess.run(COMMAND, stdout=subprocess.PIPE).stdout),
+                      ('polling Popen', lambda: polling_popen(COMMAND)),
+                      ('FDroidPopen', lambda: fdroidserver.common.FDroidPopenBytes(COMMAND).output)):
+        start = time.time()
+        outputs = [run() for i in range(count)]
+        seconds = time.time() - start
+        print('%-16s %8.3f s   %6.2f ms per call   %s'
+              % (name, seconds, seconds * 1000 / count,
+                 'same output' if all(o == expected for o in outputs) else 'DIFFERENT OUTPUT'))
+
+
+if __name__ == "__main__":
+    main()